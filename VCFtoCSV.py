@@ -1,14 +1,235 @@
 #!/usr/bin/env python
-import argparse, sys
-from genome_utils import standardizeChromosome, vcfLine, infoDetails
+import argparse, multiprocessing, os, sys
+from genome_utils import standardizeChromosome, vcfLine, infoDetails, genomeException, parsePopulations, plinkRecords, plinkWriter, metaID, readHeader, pragmaNumber, iterateChunks, CHUNK_BYTES
+
+MAX_OPEN_SHARDS = 256
+
+class csvSchema:
+    # Everything about the column layout that's decided before any rows are written; worker processes get a copy,
+    # so their rows line up with the header
+    def __init__(self, separateInfoFields, numberAlleles, includeGenotypes, includeGenotypeAttributes, numAltAlleles, numFilters,
+                 infoOrder, infoHeaders, peopleOrder, formatOrder, formatHeaders, ignoreFields, shards=None, plink=False):
+        self.separateInfoFields = separateInfoFields
+        self.numberAlleles = numberAlleles
+        self.includeGenotypes = includeGenotypes
+        self.includeGenotypeAttributes = includeGenotypeAttributes
+        self.numAltAlleles = numAltAlleles
+        self.numFilters = numFilters
+        self.infoOrder = infoOrder
+        self.infoHeaders = infoHeaders
+        self.peopleOrder = peopleOrder
+        self.formatOrder = formatOrder
+        self.formatHeaders = formatHeaders
+        self.ignoreFields = ignoreFields
+        self.shards = shards    # sample index : list of --long_genotypes files (by shard name) it goes in, or None for no long output
+        self.plink = plink
+
+def splitValues(values, width, separate):
+    # The cells for one INFO or FORMAT value: padded out to width if separate, otherwise a single comma-joined cell
+    if not separate:
+        return [','.join(values)]
+    return values + ['']*(width - len(values))
+
+def csvRow(line, schema, skippedFields):
+    # Returns the whole .csv row for a vcfLine; INFO fields without a column are added to skippedFields
+    separate = schema.separateInfoFields
+    line.extractChrAndPos()
+    line.extractAlleles()
+    line.extractQual()
+    line.extractFilters()
+    cells = [line.chromosome,str(line.position),line.name,line.alleles[0]]
+    cells.extend(splitValues(line.alleles[1:], schema.numAltAlleles, separate))
+    cells.append("%f" % line.qual)
+    cells.extend(splitValues(line.filters, schema.numFilters, separate))
+    
+    line.extractInfo()
+    if not separate:
+        for k in line.info.iterkeys():
+            if not schema.infoHeaders.has_key(k) and not k in schema.ignoreFields:
+                skippedFields.add(k)
+    for i in schema.infoOrder:
+        width = schema.infoHeaders[i]
+        if not line.info.has_key(i):
+            cells.extend(['']*(width if separate else 1))
+            continue
+        values = line.info[i]
+        if not isinstance(values,list):
+            values = [values]
+        values = [i if v == None else v for v in values]
+        if separate and len(values) > width:
+            raise genomeException("%s has more values at %s:%i than its ##INFO line allows; try again with --scan_widths" % (i,line.chromosome,line.position))
+        cells.extend(splitValues(values, width, separate))
+    
+    if schema.includeGenotypes:
+        line.extractFormat()
+        line.extractGenotypes()
+        for i,p in enumerate(schema.peopleOrder):
+            cells.extend(genotypeCells(line, i, schema, schema.includeGenotypeAttributes))
+    return '\t'.join(cells) + '\n'
+
+def genotypeCells(line, i, schema, includePhased):
+    # The allele, phasing, and (with --include_genotype_attributes) FORMAT cells for sample i of a vcfLine
+    separate = schema.separateInfoFields
+    allele0,allele1,phased,attrs = line.genotypes[i]
+    if allele0 == None:
+        allele0 = '.'
+    elif not schema.numberAlleles:
+        allele0 = line.alleles[allele0]
+    if allele1 == None:
+        allele1 = '.'
+    elif not schema.numberAlleles:
+        allele1 = line.alleles[allele1]
+    cells = [str(allele0),str(allele1)]
+    if includePhased:
+        cells.append('Y' if phased else 'N')
+    if schema.includeGenotypeAttributes:
+        for f in schema.formatOrder:
+            width = schema.formatHeaders[f]
+            attrIndex = line.format.index(f)-1 if f in line.format else len(attrs)
+            if attrIndex >= len(attrs):
+                cells.extend(['']*(width if separate else 1))
+                continue
+            values = attrs[attrIndex].split(',')
+            if separate and len(values) > width:
+                raise genomeException("%s has more values at %s:%i than its ##FORMAT line allows; try again with --scan_widths" % (f,line.chromosome,line.position))
+            cells.extend(splitValues(values, width, separate))
+    return cells
+
+def longRows(line, schema, shardRows):
+    # Adds one row per sample to shardRows (shard name : list of rows) for --long_genotypes
+    line.extractFormat()
+    line.extractGenotypes()
+    prefix = "%s\t%i" % (line.chromosome,line.position)
+    for i,p in enumerate(schema.peopleOrder):
+        names = schema.shards[i]
+        if len(names) == 0:
+            continue
+        row = '\t'.join([prefix,p] + genotypeCells(line, i, schema, True)) + '\n'
+        for n in names:
+            if not shardRows.has_key(n):
+                shardRows[n] = []
+            shardRows[n].append(row)
+
+class shardWriter:
+    # Appends to any number of files at once without running out of file handles: at most maxOpen stay open, and
+    # the others are reopened as needed
+    def __init__(self, paths, header, maxOpen=MAX_OPEN_SHARDS):
+        self.paths = paths
+        self.maxOpen = maxOpen
+        self.files = {}
+        for path in paths.itervalues():
+            outfile = open(path,'wb')
+            outfile.write(header)
+            outfile.close()
+    
+    def write(self, name, text):
+        if not self.files.has_key(name):
+            if len(self.files) >= self.maxOpen:
+                self.files.popitem()[1].close()
+            self.files[name] = open(self.paths[name],'ab')
+        self.files[name].write(text)
+    
+    def close(self):
+        for outfile in self.files.itervalues():
+            outfile.close()
+        self.files = {}
+
+def shardPaths(path, names):
+    # myFile.csv becomes myFile_NA12878.csv, myFile_CEU.csv, etc.; one unsharded file keeps the original path
+    if names == ['']:
+        return {'':path}
+    root,extension = os.path.splitext(path)
+    return dict([(n,"%s_%s%s" % (root,n.replace(os.sep,'_'),extension)) for n in names])
+
+def initWorker(schema):
+    global workerSchema
+    workerSchema = schema
+
+def formatChunk(lines):
+    skippedFields = set()
+    rows = []
+    shardRows = {}
+    plinkRows = []
+    indices = range(len(workerSchema.peopleOrder))
+    for line in lines:
+        line = line.strip()
+        if len(line) <= 1 or line.startswith("#"):
+            continue
+        line = vcfLine(line.split('\t'))
+        rows.append(csvRow(line, workerSchema, skippedFields))
+        if workerSchema.shards != None:
+            longRows(line, workerSchema, shardRows)
+        if workerSchema.plink:
+            plinkRows.extend(plinkRecords(line, indices))
+    return (''.join(rows),skippedFields,dict([(n,''.join(r)) for n,r in shardRows.iteritems()]),plinkRows)
+
+def fieldWidth(number, numAltAlleles, measured):
+    # How many columns an INFO or FORMAT field needs when its values are split, based on its ##INFO/##FORMAT Number=
+    if number == 'A':
+        return numAltAlleles
+    elif number == 'R':
+        return numAltAlleles + 1
+    elif number == 'G':
+        return (numAltAlleles + 1)*(numAltAlleles + 2)/2
+    elif number.isdigit():
+        return max(1,int(number))
+    else:
+        return measured
+
+def measureWidths(path, infoWidths, formatWidths, declared, ignoreFields):
+    # A quick scan that only tokenizes what the header can't tell us: the ALT and FILTER counts, the INFO fields in
+    # infoWidths and the FORMAT fields in formatWidths (both are updated in place), and INFO fields that have no ##INFO
+    # line at all (these are returned in the order they're found)
+    numAltAlleles = 1
+    numFilters = 1
+    undeclared = []
+    infile = open(path,'r')
+    for line in infile:
+        line = line.strip()
+        if len(line) <= 1 or line.startswith("#"):
+            continue
+        if len(formatWidths) > 0:
+            columns = line.split('\t')
+        else:
+            columns = line.split('\t',8)
+        numAltAlleles = max(numAltAlleles,columns[4].count(',')+1)
+        numFilters = max(numFilters,columns[6].count(';')+1)
+        
+        for field in columns[7].split(';'):
+            key,equals,value = field.partition('=')
+            if infoWidths.has_key(key):
+                infoWidths[key] = max(infoWidths[key],value.count(',')+1)
+            elif not key in declared and not key in ignoreFields and key != "":
+                declared.add(key)
+                undeclared.append(key)
+                infoWidths[key] = value.count(',')+1
+        
+        if len(formatWidths) > 0 and len(columns) > 9:
+            indices = [(j,f) for j,f in enumerate(columns[8].split(':')) if formatWidths.has_key(f)]
+            for genotype in columns[9:]:
+                attrs = genotype.split(':')
+                for j,f in indices:
+                    if j < len(attrs):
+                        formatWidths[f] = max(formatWidths[f],attrs[j].count(',')+1)
+    infile.close()
+    return (numAltAlleles,numFilters,undeclared)
 
 def run(args):
     separateInfoFields = args.separate_info_fields.strip().lower() == "true"
     numberAlleles = args.numbered_alleles.strip().lower() == "true"
     includeGenotypes = args.include_genotypes.strip().lower() == "true"
     includeGenotypeAttributes = args.include_genotype_attributes.strip().lower() == "true"
+    scanWidths = args.scan_widths.strip().lower() == "true"
     if includeGenotypeAttributes:
         includeGenotypes = True
+    longPath = args.long_genotypes
+    if longPath != None:
+        # genotypes go in the long file(s) instead
+        includeGenotypes = False
+    if not args.shard_genotypes in ('none','sample','population'):
+        raise genomeException("--shard_genotypes should be none, sample, or population")
+    elif args.shard_genotypes == 'population' and args.popFile == "":
+        raise genomeException("--shard_genotypes population needs a --populations file")
     
     ignoreFields = args.ignore_fields
     if ignoreFields == None:
@@ -18,61 +239,54 @@ def run(args):
     numAltAlleles = 1
     numFilters = 1
     infoOrder = []
+    infoNumbers = {}
     infoHeaders = {}
-    peopleOrder = []
     formatOrder = []
+    formatNumbers = {}
     formatHeaders = {}
     
+    # The column layout comes from the header wherever Number= pins it down
     infile = open(args.infile,'r')
-    for line in infile:
-        line = line.strip()
-        if len(line) <= 1:
-            continue
-        elif line.startswith("#"):
-            temp = line.lower()
-            if temp.startswith("##info"):
-                newTag = line[temp.find("id=")+3:]
-                newTag = newTag[:newTag.find(',')]
-                if not newTag in ignoreFields:
-                    if not infoHeaders.has_key(newTag):
-                        infoOrder.append(newTag)
-                    infoHeaders[newTag] = 1
-            elif temp.startswith("##format"):
-                newTag = line[temp.find("id=")+3:]
-                newTag = newTag[:newTag.find(',')]
-                if not newTag in ignoreFields and not newTag == 'GT':
-                    if not formatHeaders.has_key(newTag):
-                        formatOrder.append(newTag)
-                        formatHeaders[newTag] = 1
-            elif temp.startswith("#chrom"):
-                peopleOrder = line.split('\t')[9:]
-        else:
-            line = vcfLine(line.split('\t'))
-            
-            if separateInfoFields:
-                line.extractAlleles()
-                numAltAlleles = max(numAltAlleles,len(line.alleles)-1)  # don't include the REF allele
-                
-                line.extractFilters()
-                numFilters = max(numFilters,len(line.filters))
-            
-            line.extractInfo()
-            for k,v in line.info.iteritems():
-                if not infoHeaders.has_key(k):
-                    infoOrder.append(newTag)
-                    infoHeaders[k] = 1
-                if separateInfoFields and isinstance(v,list):
-                    infoHeaders[k] = max(infoHeaders[k],len(v))
-            
-            if includeGenotypeAttributes:
-                line.extractFormat()
-                line.extractGenotypes()
-                for i,p in enumerate(peopleOrder):
-                    allele0,allele1,phased,attrs = line.genotypes[i]  # @UnusedVariable
-                    for j,f in enumerate(line.format[1:]):
-                        if len(attrs) > j:
-                            formatHeaders[f] = max(formatHeaders[f],len(attrs[j].split(',')))
+    metaLines,headerline = readHeader(infile)
     infile.close()
+    peopleOrder = headerline.strip().split('\t')[9:]
+    declared = set()
+    for line in metaLines:
+        key = metaID(line)
+        if key == None or not key[0] in ('INFO','FORMAT'):
+            continue
+        pragma,newTag = key
+        number = pragmaNumber(line) if 'Number=' in line else '.'
+        if scanWidths:
+            number = '.'
+        if pragma == 'INFO':
+            declared.add(newTag)
+            if not newTag in ignoreFields and not infoNumbers.has_key(newTag):
+                infoOrder.append(newTag)
+                infoNumbers[newTag] = number
+        elif not newTag in ignoreFields and not newTag == 'GT' and not formatNumbers.has_key(newTag):
+            formatOrder.append(newTag)
+            formatNumbers[newTag] = number
+    
+    # ... and the data is only scanned when split columns need counts that the header doesn't declare
+    if separateInfoFields:
+        infoWidths = dict([(f,1) for f,n in infoNumbers.iteritems() if fieldWidth(n,1,None) == None])
+        formatWidths = {}
+        if includeGenotypeAttributes:
+            formatWidths = dict([(f,1) for f,n in formatNumbers.iteritems() if fieldWidth(n,1,None) == None])
+        numAltAlleles,numFilters,undeclared = measureWidths(args.infile, infoWidths, formatWidths, declared, ignoreFields)
+        for f in undeclared:
+            infoOrder.append(f)
+            infoNumbers[f] = '.'
+        for f in infoOrder:
+            infoHeaders[f] = fieldWidth(infoNumbers[f], numAltAlleles, infoWidths.get(f,1))
+        for f in formatOrder:
+            formatHeaders[f] = fieldWidth(formatNumbers[f], numAltAlleles, formatWidths.get(f,1))
+    else:
+        for f in infoOrder:
+            infoHeaders[f] = 1
+        for f in formatOrder:
+            formatHeaders[f] = 1
     
     print "Creating file..."
     outfile = open(args.outfile, 'w')
@@ -112,112 +326,81 @@ def run(args):
                         outfile.write('\t%s_%s' % (p,f))
     outfile.write('\n')
     
-    infile = open(args.infile,'r')
-    for line in infile:
-        line = line.strip()
-        if len(line) <= 1 or line.startswith("#"):
-            continue
-        line = vcfLine(line.split('\t'))
-        
-        line.extractChrAndPos()
-        outfile.write("%s\t%i\t%s" % (line.chromosome,line.position,line.name))
-        
-        line.extractAlleles()
-        outfile.write('\t%s' % line.alleles[0])
-        if separateInfoFields:
-            for a in line.alleles[1:]:
-                outfile.write('\t%s' % a)
-            x = len(line.alleles)-1
-            while x < numAltAlleles:
-                outfile.write('\t')
-                x += 1
-        else:
-            outfile.write('\t%s' % ','.join(line.alleles[1:]))
-        
-        line.extractQual()
-        outfile.write("\t%f" % line.qual)
-        
-        line.extractFilters()
-        if separateInfoFields:
-            for f in line.filters:
-                outfile.write('\t%s' % f)
-            x = len(line.filters)
-            while x < numFilters:
-                outfile.write('\t')
-                x += 1
+    # Rows are formatted in chunks, optionally spread across --workers processes (imap keeps them in order)
+    shards = None
+    longFiles = None
+    if longPath != None:
+        if args.shard_genotypes == 'sample':
+            shards = [[p] for p in peopleOrder]
+        elif args.shard_genotypes == 'population':
+            populations = sorted(parsePopulations(args.popFile)[0].iteritems())
+            shards = [[name for name,samples in populations if p in samples] for p in peopleOrder]
+            missing = [p for i,p in enumerate(peopleOrder) if len(shards[i]) == 0]
+            if len(missing) > 0:
+                sys.stderr.write("WARNING: %i samples aren't in any population in %s, so they were left out of the long output\n" % (len(missing),args.popFile))
         else:
-            outfile.write('\t%s' % ','.join(line.filters))
-        
-        line.extractInfo()
-        for i in infoOrder:
-            if not line.info.has_key(i):
-                if separateInfoFields:
-                    for x in xrange(infoHeaders[i]):
-                        outfile.write('\t')
+            shards = [['']]*len(peopleOrder)
+        names = sorted(set([n for s in shards for n in s]))
+        header = ['Chromosome','Position','Sample','Allele_1','Allele_2','Phased']
+        if includeGenotypeAttributes:
+            for f in formatOrder:
+                if separateInfoFields and formatHeaders[f] > 1:
+                    header.extend(['%s_%i' % (f,x+1) for x in xrange(formatHeaders[f])])
                 else:
-                    outfile.write('\t')
-            else:
-                values = line.info[i]
-                if not isinstance(values,list):
-                    values = [values]
-                for j,v in enumerate(values):
-                    if v == None:
-                        values[j] = i
-                if separateInfoFields:
-                    for v in values:
-                        outfile.write('\t%s' % v)
-                    x = len(values)
-                    while x < infoHeaders[i]:
-                        outfile.write('\t')
-                        x += 1
-                else:
-                    outfile.write('\t%s' % ','.join(values))
-        
-        if includeGenotypes:
-            line.extractFormat()
-            line.extractGenotypes()
-            for i,p in enumerate(peopleOrder):
-                allele0,allele1,phased,attrs = line.genotypes[i]
-                if allele0 == None:
-                    allele0 = '.'
-                elif not numberAlleles:
-                    allele0 = line.alleles[allele0]
-                if allele1 == None:
-                    allele1 = '.'
-                elif not numberAlleles:
-                    allele1 = line.alleles[allele1]
-                outfile.write('\t%s\t%s' % (allele0,allele1))
-                if includeGenotypeAttributes:
-                    outfile.write('\t%s' % ('Y' if phased else 'N'))
-                    for j,f in enumerate(formatOrder):
-                        if not f in line.format:
-                            if separateInfoFields:
-                                for x in xrange(formatHeaders[f]):
-                                    outfile.write('\t')
-                            else:
-                                outfile.write('\t')
-                        else:
-                            attrIndex = line.format.index(f)-1
-                            if attrIndex >= len(attrs):
-                                if separateInfoFields:
-                                    for x in xrange(formatHeaders[f]):
-                                        outfile.write('\t')
-                                else:
-                                    outfile.write('\t')
-                            else:
-                                values = attrs[attrIndex].split(',')
-                                if separateInfoFields:
-                                    for v in values:
-                                        outfile.write('\t%s' % v)
-                                    x = len(values)
-                                    while x < formatHeaders[f]:
-                                        outfile.write('\t')
-                                        x += 1
-                                else:
-                                    outfile.write('\t%s' % ','.join(values))
-        outfile.write("\n")
+                    header.append(f)
+        longFiles = shardWriter(shardPaths(longPath, names), '\t'.join(header) + '\n')
+    
+    schema = csvSchema(separateInfoFields, numberAlleles, includeGenotypes, includeGenotypeAttributes, numAltAlleles, numFilters,
+                       infoOrder, infoHeaders, peopleOrder, formatOrder, formatHeaders, ignoreFields, shards, args.plink != None)
+    plinkFiles = None
+    if args.plink != None:
+        plinkFiles = plinkWriter(args.plink, peopleOrder)
+    skippedFields = set()
+    infile = open(args.infile,'rb')
+    readHeader(infile)
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers,initWorker,(schema,))
+        chunks = pool.imap(formatChunk,iterateChunks(infile))
+    else:
+        initWorker(schema)
+        chunks = (formatChunk(lines) for lines in iterateChunks(infile))
+    try:
+        for text,skipped,shardText,plinkRows in chunks:
+            outfile.write(text)
+            skippedFields.update(skipped)
+            for n,t in shardText.iteritems():
+                longFiles.write(n,t)
+            if plinkFiles != None:
+                plinkFiles.write(plinkRows)
+    except:
+        # e.g. a genomeException from a malformed row; don't leave truncated files that look finished
+        if args.workers > 1:
+            pool.terminate()
+        infile.close()
+        outfile.close()
+        partialPaths = [args.outfile]
+        if longFiles != None:
+            longFiles.close()
+            partialPaths.extend(longFiles.paths.itervalues())
+        if plinkFiles != None:
+            plinkFiles.close()
+            partialPaths.extend([args.plink + extension for extension in ('.bed','.bim','.fam')])
+        for path in partialPaths:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    if args.workers > 1:
+        pool.close()
+        pool.join()
     infile.close()
     outfile.close()
+    if longFiles != None:
+        longFiles.close()
+    if plinkFiles != None:
+        plinkFiles.close()
+    
+    if len(skippedFields) > 0:
+        sys.stderr.write("WARNING: These INFO fields don't have ##INFO lines, so they were left out: %s\n" % ", ".join(sorted(skippedFields)))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Creates a .csv file from the CHROM, POS, ID, REF, ALT, QUAL, FILTER, and INFO fields of a .vcf file. Also optionally includes columns for genotypes, or even their attributes.')
@@ -233,8 +416,24 @@ if __name__ == '__main__':
                         help='When an INFO field has multiple comma-delimited values, split them into separate columns.')
     parser.add_argument('--numbered_alleles', type=str, dest="numbered_alleles", nargs="?", const="True", default="False",
                         help='Use the original numbered alleles .vcf-style instead of letters.')
+    parser.add_argument('--scan_widths', type=str, dest="scan_widths", nargs="?", const="True", default="False",
+                        help='With --separate_info_fields, count how many columns every field needs from the data instead of trusting Number= in the '+
+                        '##INFO and ##FORMAT lines (slower; only needed if the file doesn\'t agree with its own header).')
     parser.add_argument('--ignore', type=str, dest="ignore_fields", nargs="+",
                         help='Explicitly remove specific columns from the output.')
+    parser.add_argument('--long_genotypes', type=str, dest="long_genotypes",
+                        help='Write genotypes to this .csv file instead, one row per variant and sample (Chromosome, Position, Sample, both alleles, '+
+                        'phasing, and with --include_genotype_attributes, the FORMAT values), rather than as columns in --out.')
+    parser.add_argument('--shard_genotypes', type=str, dest="shard_genotypes", nargs="?", const="sample", default="none",
+                        help='Split --long_genotypes into one file per sample ("sample") or per population in --populations ("population"); '+
+                        'e.g. myFile.csv becomes myFile_NA12878.csv, etc. All the files are written in the same pass. Default is "none".')
+    parser.add_argument('--populations', type=str, dest="popFile", nargs="?", const="", default="",
+                        help='Population file describing the samples in --in (see KGP_populations.txt); needed for --shard_genotypes population.')
+    parser.add_argument('--plink', type=str, dest="plink",
+                        help='Also write the genotypes as PLINK binary files named with this prefix (prefix.bed, prefix.bim, and prefix.fam), '+
+                        'which take a fraction of the space and can be memory-mapped. Variants with more than one ALT allele are split into one line per ALT allele.')
+    parser.add_argument('--workers', type=int, dest="workers", nargs="?", default=1,
+                        help='Number of processes to use for writing rows (the file is split into chunks of about %iMB). Default is 1.' % (CHUNK_BYTES/(1024*1024)))
     
     args = parser.parse_args()
     run(args)
\ No newline at end of file
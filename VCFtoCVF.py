@@ -1,27 +1,48 @@
 #!/usr/bin/env python
-import argparse, datetime, sys
-from genome_utils import standardizeChromosome, vcfLine, infoDetails, MAX_INFO_STRINGS
+import argparse, datetime, os, sys, tempfile
+from genome_utils import standardizeChromosome, vcfLine, infoDetails, profileCache, appendFile, MAX_INFO_STRINGS
 
-def run(args):
-    
-    separateInfoFields = args.separate_info_fields.strip().lower() == "true"
-    countSeparate = args.count_separate.strip().lower() == "true"
-    
-    ignoreFields = args.ignore_fields
-    if ignoreFields == None:
-        ignoreFields = []
-    ignoreFields = set(ignoreFields)
+def cvfRow(line, fieldOrder, separateInfoFields):
+    # line should already be a vcfLine with its chromosome, position, INFO, alleles, QUAL, and filters extracted
+    line.info["Ref/Alt"] = line.alleles
+    line.info["QUAL"] = str(line.qual)
+    line.info["FILTER"] = line.filters
+    row = ["%s\t%i\t%s" % (line.chromosome,line.position,line.name)]
+    for f in fieldOrder:
+        values = line.info[f]
+        if isinstance(values,list):
+            if separateInfoFields:
+                values = "\t".join(values)
+            else:
+                values = ",".join(values)
+        row.append("\t%s" % values)
+    row.append("\n")
+    return "".join(row)
+
+def profileCacheKey(max_strings, separateInfoFields, countSeparate):
+    return ('cvf',max_strings,separateInfoFields,countSeparate)
+
+def profileVcf(path, max_strings, separateInfoFields, countSeparate, rowFile=None):
+    # Scans the whole file for chromosome lengths and every column's ranges and categories; the result is saved
+    # next to the file (see profileCache), so converting the same file again skips this. If rowFile is supplied,
+    # each variant's .cvf row is written to it during the same scan
+    cacheKey = profileCacheKey(max_strings, separateInfoFields, countSeparate)
+    if rowFile == None:
+        profile = profileCache.load(path, cacheKey)
+        if profile != None:
+            return profile
+    fieldOrder = None
     
     posLengthWarned = False
     allChrs = []
     positions = []
     alleleColumn = infoDetails("Ref/Alt", 1, False)
     qualColumn = infoDetails("QUAL", 1, False)
-    filterColumn = infoDetails("FILTER", args.max_strings, False)
+    filterColumn = infoDetails("FILTER", max_strings, False)
     infoFields = {"Ref/Alt":alleleColumn,"QUAL":qualColumn,"FILTER":filterColumn}
     # TODO: get the numeric ranges, all valid categorical values
     
-    infile = open(args.infile,'r')
+    infile = open(path,'r')
     for line in infile:
         line = line.strip()
         if len(line) <= 1:
@@ -33,9 +54,7 @@ def run(args):
                 newTag = newTag[:newTag.find(',')]
                 if infoFields.has_key(newTag):
                     raise Exception("Duplicate INFO ID or use of reserved ID:\t%s" % newTag)
-                infoFields[newTag] = infoDetails(newTag, args.max_strings, countSeparate)
-                if newTag in ignoreFields:
-                    infoFields[newTag].maxedOut = True
+                infoFields[newTag] = infoDetails(newTag, max_strings, countSeparate)
             elif temp.startswith("##filter"):
                 newTag = line[temp.find("id=")+3:]
                 newTag = newTag[:newTag.find(',')]
@@ -90,8 +109,44 @@ def run(args):
                 if separateInfoFields:
                     v = ",".split(v)
                 infoFields[k].addArbitraryValue(v)
+            
+            if rowFile != None:
+                if fieldOrder == None:
+                    # every column has a ##INFO line by now
+                    fieldOrder = sorted(infoFields.iterkeys())
+                rowFile.write(cvfRow(line, fieldOrder, separateInfoFields))
     infile.close()
     
+    profile = (allChrs,positions,infoFields)
+    profileCache.save(path, cacheKey, profile)
+    if not separateInfoFields and not countSeparate:
+        # The ##INFO columns were counted exactly the way cleanVCF.extractInfoFields counts them, so save them
+        # where it (and VCF Cleaner) will look
+        profileCache.save(path, profileCache.infoKey(max_strings), dict((k,v) for k,v in infoFields.iteritems() if k not in ("Ref/Alt","QUAL","FILTER")))
+    return profile
+
+def run(args):
+
+    separateInfoFields = args.separate_info_fields.strip().lower() == "true"
+    countSeparate = args.count_separate.strip().lower() == "true"
+    
+    ignoreFields = args.ignore_fields
+    if ignoreFields == None:
+        ignoreFields = []
+    ignoreFields = set(ignoreFields)
+    
+    # Only one pass over the .vcf file: if it hasn't been profiled before, rows are spilled to a temporary file
+    # while the header statistics are collected, and appended after the header
+    rowFile = None
+    profile = profileCache.load(args.infile, profileCacheKey(args.max_strings, separateInfoFields, countSeparate))
+    if profile == None:
+        rowFile = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(args.outfile)))
+        profile = profileVcf(args.infile, args.max_strings, separateInfoFields, countSeparate, rowFile)
+    allChrs,positions,infoFields = profile
+    for k in ignoreFields:
+        if infoFields.has_key(k):
+            infoFields[k].maxedOut = True
+    
     print "Creating file..."
     outfile = open(args.outfile, 'w')
     
@@ -111,31 +166,24 @@ def run(args):
     
     outfile.write('Chromosome\tPosition\tID\t%s\n' % ("\t".join(headers)))
     
-    infile = open(args.infile,'r')
-    for line in infile:
-        line = line.strip()
-        if len(line) <= 1 or line.startswith("#"):
-            continue
-        line = vcfLine(line.split('\t'))
-        line.extractChrAndPos()
-        line.extractInfo()
-        line.extractAlleles()
-        line.info["Ref/Alt"] = line.alleles
-        line.extractQual()
-        line.info["QUAL"] = str(line.qual)
-        line.extractFilters()
-        line.info["FILTER"] = line.filters
-        outfile.write("%s\t%i\t%s" % (line.chromosome,line.position,line.name))
-        for f in fieldOrder:
-            values = line.info[f]
-            if isinstance(values,list):
-                if separateInfoFields:
-                    values = "\t".join(values)
-                else:
-                    values = ",".join(values)
-            outfile.write("\t%s" % values)
-        outfile.write("\n")
-    infile.close()
+    if rowFile != None:
+        rowFile.seek(0)
+        appendFile(rowFile, outfile)
+        rowFile.close()
+    else:
+        infile = open(args.infile,'r')
+        for line in infile:
+            line = line.strip()
+            if len(line) <= 1 or line.startswith("#"):
+                continue
+            line = vcfLine(line.split('\t'))
+            line.extractChrAndPos()
+            line.extractInfo()
+            line.extractAlleles()
+            line.extractQual()
+            line.extractFilters()
+            outfile.write(cvfRow(line, fieldOrder, separateInfoFields))
+        infile.close()
     outfile.close()
 
 if __name__ == '__main__':
@@ -1,69 +1,79 @@
 #!/usr/bin/env python
 import argparse
-from genome_utils import vcfLine, bedLine, genomeException
+from genome_utils import vcfLine, bedLine, bedIndex, bedSweep, vcfStage, streamVcf, genomeException, fileSignature
 
-def sniffBed(path):
-    scoreNames = set()
-    bedRegions = []
+def iterateBed(path, names=None):
+    # Unnamed/unscored features are always skipped
     tempfile = open(path, 'r')
     for line in tempfile:
+        if len(line.strip()) == 0:
+            continue
         line = bedLine(line.split())
         if not hasattr(line,'name') or not hasattr(line,'score'):
             continue
-        bedRegions.append(line)
-        scoreNames.add(line.name)
+        if names != None and line.name not in names:
+            continue
+        yield line
     tempfile.close()
+
+def sniffBed(path, names=None):
+    scoreNames = set()
+    bedRegions = bedIndex()
+    for line in iterateBed(path, names):
+        bedRegions.add(line)
+        scoreNames.add(line.name)
+    bedRegions.index()
     return (scoreNames,bedRegions)
 
-def run(args):
-    scoreNames,bedRegions = sniffBed(args.bedfile)
-    
-    if args.names != None:
-        scoreNames.difference_update(args.names)
-        regionsToRemove = set()
-        for i,r in bedRegions:
-            if r.name not in scoreNames:
-                regionsToRemove.add(i)
-        for i in regionsToRemove:
-            del bedRegions[i]
-    
-    vcffile = open(args.infile,'r')
-    outfile = open(args.outfile,'w')
-    
-    takenTags = set()
+class bedStage(vcfStage):
+    ''' Adds the score of every .bed region that a variant lies in as an INFO field '''
+    def __init__(self, bedPath, names=None, isSorted=False):
+        self.settings = (fileSignature(bedPath),sorted(names) if names != None else None)
+        if isSorted:
+            # Both files are sorted, so we can sweep through the .bed file alongside the .vcf file instead of loading it
+            if names != None:
+                self.scoreNames = set(names)
+            else:
+                self.scoreNames = set(line.name for line in iterateBed(bedPath))
+            self.bedRegions = bedSweep(iterateBed(bedPath, names))
+        else:
+            self.scoreNames,self.bedRegions = sniffBed(bedPath,names)
     
-    for line in vcffile:
-        if len(line) <= 1:
-            continue
-        elif line.startswith('##'):
+    def header(self, metaLines, headerline):
+        takenTags = set()
+        for line in metaLines:
             if line.startswith("##INFO"):
                 newTag = line[line.find("ID=")+3:]
                 newTag = newTag[:newTag.find(',')]
                 takenTags.add(newTag)
-            outfile.write(line)
-        elif line.startswith('#'):
-            for n in scoreNames:
-                dupCount = 2
-                newTag = n
-                while newTag in takenTags:
-                    newTag = n + str(dupCount)
-                    dupCount += 1
-                takenTags.add(newTag)
-                outfile.write("##INFO=<ID=%s,Number=.,Type=Float,Description=\"User column added with addBEDtoVCF.py\">\n" % newTag)
-            outfile.write(line)
-        else:
-            line = vcfLine(line.strip().split('\t'))
+        metaLines = list(metaLines)
+        for n in self.scoreNames:
+            dupCount = 2
+            newTag = n
+            while newTag in takenTags:
+                newTag = n + str(dupCount)
+                dupCount += 1
+            takenTags.add(newTag)
+            metaLines.append("##INFO=<ID=%s,Number=.,Type=Float,Description=\"User column added with addBEDtoVCF.py\">\n" % newTag)
+        return (metaLines,headerline)
+    
+    def configuration(self):
+        return self.settings
+    
+    def process(self, records):
+        for line in records:
             line.extractChrAndPos()
             
-            for b in bedRegions:
-                if b.contains(line.chromosome, line.position):
-                    line.extractInfo()
-                    line.info[b.name] = str(b.score)
-            
-            outfile.write(str(line))
+            for b in self.bedRegions.overlapping(line.chromosome, line.position):
+                line.extractInfo()
+                line.info[b.name] = str(b.score)
             
-    vcffile.close()
-    outfile.close()
+            yield line
+
+def run(args):
+    stage = bedStage(args.bedfile, args.names, args.sorted.strip().lower() == "true")
+    streamVcf(args.infile, args.outfile, [stage],
+              checkpointPath=args.outfile + '.checkpoint', resume=args.resume.strip().lower() == "true")
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Attempts to incorporate .bed data as INFO fields in a .vcf file; '+
@@ -80,6 +90,11 @@ if __name__ == '__main__':
                         help='output .vcf file')
     parser.add_argument('--names', type=str, dest="names", nargs="+",
                         help='List of .bed region names to use (all others will be ignored). If unspecified, all features will be used. Unnamed/unscored features will always be ignored.')
+    parser.add_argument('--sorted', type=str, dest="sorted", nargs="?", const="True", default="False",
+                        help='Both --in and --bed have already been sorted with sort.py; the .bed file will be streamed alongside the .vcf file instead of being loaded into memory.')
+    
+    parser.add_argument('--resume', type=str, dest="resume", nargs="?", const="True", default="False",
+                        help='Pick up where an interrupted run with the same --in and --out left off (progress is saved to a .checkpoint file next to --out every couple of minutes).')
     
     args = parser.parse_args()
     run(args)
\ No newline at end of file
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 import argparse, csv, gzip, os
-from genome_utils import vcfLine, genomeException, standardizeChromosome, chromosomeOrder
+from genome_utils import vcfLine, vcfStage, streamVcf, genomeException, standardizeChromosome, chromosomeOrder, fileSignature
 
 class csvLine:
     def __init__(self, columns, chrColumn, posColumn, idColumn=None):
@@ -43,185 +43,152 @@ def sniffCsv(path):
     
     return (scent.delimiter,headers,chromColumn,posColumn,idColumn)
 
-def run(args):
-    delimiter,headers,chromColumn,posColumn,idColumn = sniffCsv(args.csvfile)
-    if args.exact == None and args.nearest == None and args.interpolate == None:
-        temp = headers
-        temp.remove('CHROM')
-        temp.remove('POS')
-        args.exact = temp
-    
-    exact = {}
-    nearest = {}
-    interpolate = {}
-    
-    vcffile = open(args.infile,'r')
-    csvfile = open(args.csvfile,'r')
-    outfile = open(args.outfile,'w')
-    
-    csvbasename = os.path.split(args.csvfile)[1]
-    
-    takenTags = set()
-    vcfHeaderLine = ""
+class csvStage(vcfStage):
+    ''' Copies .csv columns into INFO fields (see --help for the --exact, --nearest, and --interpolate modes) '''
+    def __init__(self, csvPath, exact=None, nearest=None, interpolate=None, omitMismatches=False):
+        self.csvPath = csvPath
+        self.delimiter,self.headers,self.chromColumn,self.posColumn,self.idColumn = sniffCsv(csvPath)
+        if exact == None and nearest == None and interpolate == None:
+            exact = list(self.headers)
+            exact.remove('CHROM')
+            exact.remove('POS')
+        self.requested = (exact,nearest,interpolate)
+        self.omitMismatches = omitMismatches
+        
+        self.exact = {}
+        self.nearest = {}
+        self.interpolate = {}
     
-    while True:
-        line = vcffile.readline()
-        if len(line) <= 1:
-            continue
-        elif line.startswith("##"):
+    def header(self, metaLines, headerline):
+        csvbasename = os.path.split(self.csvPath)[1]
+        
+        takenTags = set()
+        for line in metaLines:
             if line.startswith("##INFO"):
                 newTag = line[line.find("ID=")+3:]
                 newTag = newTag[:newTag.find(',')]
                 takenTags.add(newTag)
-            outfile.write(line)
-        elif line.startswith("#"):
-            vcfHeaderLine = line
-            break
-        else:
-            raise Exception("Missing a header line or something else is wrong...")
-    
-    if args.exact != None:
-        for x in args.exact:
-            if not x in headers:
-                raise Exception('Column header "%s" doesn\'t exist in %s' % (x,csvbasename))
-            temp = x
-            dupNumber = 2
-            while x in takenTags:
-                x = temp + str(dupNumber)
-                dupNumber += 1
-            takenTags.add(x)
-            outfile.write('##INFO=<ID=%s,Number=.,Type=String,Description=\"addCSVtoVCF.py: Column %s from %s in --exact match mode\">\n' % (x,temp,csvbasename))
-            exact[x] = headers.index(x)
-    
-    if args.nearest != None:
-        for x in args.nearest:
-            if not x in headers:
-                raise Exception('Column header "%s" doesn\'t exist in %s' % (x,args.csvfile))
-            temp = x
-            dupNumber = 2
-            while x in takenTags:
-                x = temp + str(dupNumber)
-                dupNumber += 1
-            takenTags.add(x)
-            outfile.write('##INFO=<ID=%s,Number=.,Type=String,Description=\"addCSVtoVCF.py: Column %s from %s in --nearest match mode\">\n' % (x,temp,csvbasename))
-            nearest[x] = headers.index(x)
-    
-    if args.interpolate != None:
-        for x in args.interpolate:
-            if not x in headers:
-                raise Exception('Column header "%s" doesn\'t exist in %s' % (x,args.csvfile))
-            temp = x
-            dupNumber = 2
-            while x in takenTags:
-                x = temp + str(dupNumber)
-                dupNumber += 1
-            takenTags.add(x)
-            outfile.write('##INFO=<ID=%s,Number=.,Type=String,Description=\"addCSVtoVCF.py: Column %s from %s in --interpolate match mode\">\n' % (x,temp,csvbasename))
-            interpolate[x] = headers.index(x)
-    
-    outfile.write(vcfHeaderLine)
-    
-    # grab our first lines  
-    vLine = vcffile.readline()
-    vLine = vcfLine(vLine.strip().split('\t'))
-    vLine.extractChrAndPos()
-    vLine.extractInfo()
-    
-    lastCline = None
-    csvfile.readline()  # skip the header
-    cLine = csvLine(csvfile.readline().strip().split(delimiter),chromColumn,posColumn,idColumn)
-    
-    while True:
-        speedAhead = cLine != None  # a flag that lets us just spit out .vcf lines because we know that either the .csv file has finished or there are no new .csv lines on the same chromosome
-        # ... Are we even on the same chromosome?
-        while speedAhead and cLine.chrom != vLine.chromosome:
-            # the .csv file is ahead by a whole chromosome at least... keep lastCline intact and just spew out .vcf lines until it catches up
-            if chromosomeOrder.index(cLine.chrom) > chromosomeOrder.index(vLine.chromosome):
-                speedAhead = False
-                break
-            else:
-                # okay, the .csv file is behind the .vcf file by at least a chromsome... speed ahead until we catch up or run out of .csv data
-                lastCline = cLine
-                cLine = csvfile.readline()
-                if not cLine:
-                    # shoot... we're out of .csv data. We already know that lastCline wasn't on the same chromosome as the current vLine, so make it None as well
-                    cLine = None
-                    lastCline = None
+        metaLines = list(metaLines)
+        
+        for columns,mode,target in zip(self.requested,('exact','nearest','interpolate'),(self.exact,self.nearest,self.interpolate)):
+            if columns == None:
+                continue
+            for x in columns:
+                if not x in self.headers:
+                    raise Exception('Column header "%s" doesn\'t exist in %s' % (x,csvbasename))
+                temp = x
+                dupNumber = 2
+                while x in takenTags:
+                    x = temp + str(dupNumber)
+                    dupNumber += 1
+                takenTags.add(x)
+                metaLines.append('##INFO=<ID=%s,Number=.,Type=String,Description=\"addCSVtoVCF.py: Column %s from %s in --%s match mode\">\n' % (x,temp,csvbasename,mode))
+                target[x] = self.headers.index(temp)
+        return (metaLines,headerline)
+    
+    def configuration(self):
+        return (fileSignature(self.csvPath),self.requested,self.omitMismatches)
+    
+    def iterateCsv(self):
+        csvfile = open(self.csvPath,'r')
+        csvfile.readline()  # skip the header
+        for line in csvfile:
+            if len(line.strip()) == 0:
+                continue
+            yield csvLine(line.strip().split(self.delimiter),self.chromColumn,self.posColumn,self.idColumn)
+        csvfile.close()
+    
+    def process(self, records):
+        exact = self.exact
+        nearest = self.nearest
+        interpolate = self.interpolate
+        
+        csvLines = self.iterateCsv()
+        lastCline = None
+        cLine = next(csvLines,None)
+        
+        for vLine in records:
+            vLine.extractChrAndPos()
+            vLine.extractInfo()
+            
+            speedAhead = cLine != None  # a flag that lets us just spit out .vcf lines because we know that either the .csv file has finished or there are no new .csv lines on the same chromosome
+            # ... Are we even on the same chromosome?
+            while speedAhead and cLine.chrom != vLine.chromosome:
+                # the .csv file is ahead by a whole chromosome at least... keep lastCline intact and just spew out .vcf lines until it catches up
+                if chromosomeOrder.index(cLine.chrom) > chromosomeOrder.index(vLine.chromosome):
                     speedAhead = False
                     break
                 else:
-                    cLine = csvLine(cLine.strip().split(delimiter),chromColumn,posColumn,idColumn)
-        # Okay, now we're on the same chromosome... zip ahead until cLine and lastCline are straddling vLine
-        while speedAhead and cLine.pos < vLine.position:
-            lastCline = cLine
-            cLine = csvfile.readline()
-            if not cLine:
-                # shoot... out of .csv data. We know lastCline is still on the same chromosome, so preserve that, but make cLine None so we know nothing is left
-                cLine = None
-                break
-            else:
-                cLine = csvLine(cLine.strip().split(delimiter),chromColumn,posColumn,idColumn)
-        
-        # Whew! We're finally straddling the vLine...
-        
-        # Check the super-special case first (exact match)
-        if cLine != None and cLine.pos == vLine.position:
-            for x,i in exact.iteritems():
-                vLine.info[x] = cLine.columns[i]
-            for x,i in nearest.iteritems():
-                vLine.info[x] = cLine.columns[i]
-            for x,i in interpolate.iteritems():
-                vLine.info[x] = cLine.columns[i]
-        elif cLine != None: # cLine.pos will be > vLine.position
-            if not args.omit_mismatches:
+                    # okay, the .csv file is behind the .vcf file by at least a chromsome... speed ahead until we catch up or run out of .csv data
+                    lastCline = cLine
+                    cLine = next(csvLines,None)
+                    if cLine == None:
+                        # shoot... we're out of .csv data. We already know that lastCline wasn't on the same chromosome as the current vLine, so make it None as well
+                        lastCline = None
+                        speedAhead = False
+                        break
+            # Okay, now we're on the same chromosome... zip ahead until cLine and lastCline are straddling vLine
+            while speedAhead and cLine.pos < vLine.position:
+                lastCline = cLine
+                cLine = next(csvLines,None)
+                if cLine == None:
+                    # shoot... out of .csv data. We know lastCline is still on the same chromosome, so preserve that, but cLine stays None so we know nothing is left
+                    break
+            
+            # Whew! We're finally straddling the vLine...
+            
+            # Check the super-special case first (exact match)
+            if cLine != None and cLine.pos == vLine.position:
                 for x,i in exact.iteritems():
-                    vLine.info[x] = "."
-            if lastCline == None:
+                    vLine.info[x] = cLine.columns[i]
                 for x,i in nearest.iteritems():
                     vLine.info[x] = cLine.columns[i]
                 for x,i in interpolate.iteritems():
                     vLine.info[x] = cLine.columns[i]
-            else:
-                closestLine = lastCline if vLine.position - lastCline.pos <= cLine.pos - vLine.position else cLine
-                for x,i in nearest.iteritems():
-                    vLine.info[x] = closestLine.columns[i]
-                for x,i in interpolate.iteritems():
-                    try:
-                        lastVal = float(lastCline.columns[i])
-                        nextVal = float(cLine.columns[i])
-                        vLine.info[x] = str(lastVal + (nextVal - lastVal)*(vLine.position - lastCline.pos)/(cLine.pos - lastCline.pos))
-                    except ValueError:
-                        vLine.info[x] = closestLine.columns[i]
-        else: # cLine == None
-            if lastCline == None:
-                if not args.omit_mismatches:
+            elif cLine != None: # cLine.pos will be > vLine.position
+                if not self.omitMismatches:
                     for x,i in exact.iteritems():
                         vLine.info[x] = "."
+                if lastCline == None:
                     for x,i in nearest.iteritems():
-                        vLine.info[x] = "."
+                        vLine.info[x] = cLine.columns[i]
                     for x,i in interpolate.iteritems():
-                        vLine.info[x] = "."
-            else:
-                if not args.omit_mismatches:
-                    for x,i in exact.iteritems():
-                        vLine.info[x] = "."
-                for x,i in nearest.iteritems():
-                    vLine.info[x] = lastCline.columns[i]
-                for x,i in interpolate.iteritems():
-                    vLine.info[x] = lastCline.columns[i]
-        # Okay, we've copied over everything; write the line
-        outfile.write(str(vLine))
-        # Grab the next one
-        vLine = vcffile.readline()
-        if not vLine:
-            break   # No more variants - we're done!
-        vLine = vcfLine(vLine.strip().split('\t'))
-        vLine.extractChrAndPos()
-        vLine.extractInfo()
-    
-    csvfile.close()
-    vcffile.close()
-    outfile.close()
+                        vLine.info[x] = cLine.columns[i]
+                else:
+                    closestLine = lastCline if vLine.position - lastCline.pos <= cLine.pos - vLine.position else cLine
+                    for x,i in nearest.iteritems():
+                        vLine.info[x] = closestLine.columns[i]
+                    for x,i in interpolate.iteritems():
+                        try:
+                            lastVal = float(lastCline.columns[i])
+                            nextVal = float(cLine.columns[i])
+                            vLine.info[x] = str(lastVal + (nextVal - lastVal)*(vLine.position - lastCline.pos)/(cLine.pos - lastCline.pos))
+                        except ValueError:
+                            vLine.info[x] = closestLine.columns[i]
+            else: # cLine == None
+                if lastCline == None:
+                    if not self.omitMismatches:
+                        for x,i in exact.iteritems():
+                            vLine.info[x] = "."
+                        for x,i in nearest.iteritems():
+                            vLine.info[x] = "."
+                        for x,i in interpolate.iteritems():
+                            vLine.info[x] = "."
+                else:
+                    if not self.omitMismatches:
+                        for x,i in exact.iteritems():
+                            vLine.info[x] = "."
+                    for x,i in nearest.iteritems():
+                        vLine.info[x] = lastCline.columns[i]
+                    for x,i in interpolate.iteritems():
+                        vLine.info[x] = lastCline.columns[i]
+            # Okay, we've copied over everything; pass the line along
+            yield vLine
+
+def run(args):
+    stage = csvStage(args.csvfile, args.exact, args.nearest, args.interpolate, args.omit_mismatches)
+    streamVcf(args.infile, args.outfile, [stage],
+              checkpointPath=args.outfile + '.checkpoint', resume=args.resume.strip().lower() == "true")
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Attempts to incorporate .csv data as INFO fields in a .vcf file. Unless --exact, --nearest, or --interpolate are specified, '+
@@ -258,5 +225,8 @@ if __name__ == '__main__':
                         help='Performs linear interpolation for each column listed as an argument. Every variant will be assigned an interpolated value from the nearest .csv lines ' +
                             'in either direction. Variants beyond .csv endpoints or .csv values that can\'t be converted to numbers will revert to --nearest matching behavior.')
     
+    parser.add_argument('--resume', type=str, dest="resume", nargs="?", const="True", default="False",
+                        help='Pick up where an interrupted run with the same --in and --out left off (progress is saved to a .checkpoint file next to --out every couple of minutes).')
+    
     args = parser.parse_args()
     run(args)
\ No newline at end of file
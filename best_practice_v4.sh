@@ -684,50 +684,23 @@ then
 	
 	if [ "$EXOME_OR_GENOME" == "exome" ]
 	then
-		echo "...GATK SelectVariants (remove off-target variants)"
-		$RUN_JAVA -jar $GATK_DIR/GenomeAnalysisTK.jar \
-			-T SelectVariants \
-			--variant $TARGET_DIR/calls/all.$VCF_NAME.filtered.vcf \
-			-o $TARGET_DIR/calls/purged.$VCF_NAME.filtered.vcf \
-			-R $REF_FASTA \
-			-L $EXOME_TARGETS \
-			>$TARGET_DIR/calls/logs/purged.$VCF_NAME.selectVariants.log \
-			2>$TARGET_DIR/calls/logs/purged.$VCF_NAME.selectVariants.err.log &
-		waitForJobs
+		TARGETS_PARAMETER="--targets $EXOME_TARGETS"
 	else
-		cp $TARGET_DIR/calls/all.$VCF_NAME.filtered.vcf $TARGET_DIR/calls/purged.$VCF_NAME.filtered.vcf
+		TARGETS_PARAMETER=""
 	fi
 	
-	echo "...GATK SelectVariants (physically remove variants that didn't PASS)"
-	$RUN_JAVA -jar $GATK_DIR/GenomeAnalysisTK.jar \
-		-T SelectVariants \
-		--variant $TARGET_DIR/calls/purged.$VCF_NAME.filtered.vcf \
-		-o $TARGET_DIR/calls/pass.$VCF_NAME.filtered.vcf \
-		-R $REF_FASTA \
-		--excludeFiltered \
-		>$TARGET_DIR/calls/logs/pass.$VCF_NAME.selectVariants.log \
-		2>$TARGET_DIR/calls/logs/pass.$VCF_NAME.selectVariants.err.log &
-	waitForJobs
-	
-	echo "...dpFilter.py (manual, std-dev-based filter that remains in the .vcf)"
+	echo "...dpFilter.py (manual, std-dev-based filter that remains in the .vcf; also removes off-target variants for PURGED,"
+	echo "   variants that didn't PASS for PASS, and alternate contigs from all three in a single pass)"
 	python ${0%best_practice_v4.sh}dpFilter.py \
 		--stddev 5 \
 		--in $TARGET_DIR/calls/all.$VCF_NAME.filtered.vcf \
 		--out $TARGET_DIR/calls/ALL.$VCF_NAME.vcf \
+		--purged_out $TARGET_DIR/calls/PURGED.$VCF_NAME.vcf \
+		--pass_out $TARGET_DIR/calls/PASS.$VCF_NAME.vcf \
+		$TARGETS_PARAMETER \
+		--basic_contigs \
 		>$TARGET_DIR/calls/logs/all.$VCF_NAME.dpFilter.log \
 		2>$TARGET_DIR/calls/logs/all.$VCF_NAME.dpFilter.err.log &
-	python ${0%best_practice_v4.sh}dpFilter.py \
-		--stddev 5 \
-		--in $TARGET_DIR/calls/purged.$VCF_NAME.filtered.vcf \
-		--out $TARGET_DIR/calls/PURGED.$VCF_NAME.vcf \
-		>$TARGET_DIR/calls/logs/purged.$VCF_NAME.dpFilter.log \
-		2>$TARGET_DIR/calls/logs/purged.$VCF_NAME.dpFilter.err.log &
-	python ${0%best_practice_v4.sh}dpFilter.py \
-		--stddev 5 \
-		--in $TARGET_DIR/calls/pass.$VCF_NAME.filtered.vcf \
-		--out $TARGET_DIR/calls/PASS.$VCF_NAME.vcf \
-		>$TARGET_DIR/calls/logs/pass.$VCF_NAME.dpFilter.log \
-		2>$TARGET_DIR/calls/logs/pass.$VCF_NAME.dpFilter.err.log &
 	waitForJobs
 	export PHASE_START="annotate"
 fi
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 import argparse, sys, os, gzip, math
-from genome_utils import kgpInterface, countingDict, parsePopulations
+from genome_utils import kgpInterface, countingDict, parsePopulations, vcfStage, streamVcf, fileSignature
 
 class allStats:
     AF = 0
@@ -54,7 +54,7 @@ class allStats:
             return [float('Inf') for a in alleles]
         else:
             return [matches.get(i,0)/count for i,a in enumerate(alleles)]
-        
+    
     @staticmethod
     def calcCarriage(vcfLine,vcfIndices,kgpLine,kgpIndices,alleles):
         if len(vcfIndices) > 0:
@@ -86,7 +86,7 @@ class allStats:
                     counts[allele0] += 1
                     counts[allele1] += 1
         return [counts.get(i,0) for i,a in enumerate(alleles)]
-        
+    
     @staticmethod
     def calcSamples_w_calls(vcfLine,vcfIndices,kgpLine,kgpIndices,alleles):
         if len(vcfIndices) > 0:
@@ -109,19 +109,38 @@ def tick():
     count += 1
     return True
 
-def parseVcfHeader(path, outpath=None, popFile=""):
-    # This is pretty ugly - it should probably be broken into several parts and called separately, but I didn't have time to do this right...
-    # Essentially this pulls a lot of crap out of the vcf header, possibly in conjunction with a population file (see KGP_populations.txt or
-    # a VCF Cleaner log file)
+def parseHeaderLines(metaLines, headerline, popFile="", popName=""):
+    # Pulls the existing INFO tags out of a .vcf header, and works out where each population's samples are, possibly in conjunction
+    # with a population file (see KGP_populations.txt or a VCF Cleaner log file). Without one, all the samples are in one population
+    # called popName
     if popFile != "":
         populations = parsePopulations(popFile)[0]
     else:
-        popName = os.path.split(path)[1]
         populations = {popName:[]}
     populationIndices = {}
     
     infoTags = set()
+    for line in metaLines:
+        if line.startswith("##INFO"):
+            newTag = line[line.find("ID=")+3:]
+            newTag = newTag[:newTag.find(',')]
+            infoTags.add(newTag)
     
+    columns = headerline.strip().split('\t')
+    if popFile == "":
+        populations[popName] = columns[9:]
+    for p,individuals in populations.iteritems():
+        populationIndices[p] = []
+        for i in individuals:
+            if i in columns[9:]:
+                populationIndices[p].append(columns.index(i)-9)
+            else:
+                populationIndices[p].append(i)   # this only happens if one of the names in the population file doesn't exist in the .vcf file... I assume it's someone from KGP and raise an Exception later if they're not
+    return (infoTags,populations,populationIndices)
+
+def parseVcfHeader(path, outpath=None, popFile=""):
+    # This is pretty ugly - it should probably be broken into several parts and called separately, but I didn't have time to do this right...
+    # Essentially this pulls a lot of crap out of the vcf header (see parseHeaderLines)
     if path.endswith('.gz'):
         infile = gzip.open(path,'rb')
     else:
@@ -134,103 +153,102 @@ def parseVcfHeader(path, outpath=None, popFile=""):
         else:
             outfile = open(outpath, 'wb')
     
+    metaLines = []
     for line in infile:
         if len(line) <= 1:
             continue
         elif line.startswith("##"):
-            if line.startswith("##INFO"):
-                newTag = line[line.find("ID=")+3:]
-                newTag = newTag[:newTag.find(',')]
-                infoTags.add(newTag)
+            metaLines.append(line)
             if outpath != None:
                 outfile.write(line)
         elif line.startswith("#"):
-            headerline = line
-            columns = line.strip().split('\t')
-            if popFile == "":
-                populations[popName] = columns[9:]
-            for p,individuals in populations.iteritems():
-                populationIndices[p] = []
-                for i in individuals:
-                    if i in columns[9:]:
-                        populationIndices[p].append(columns.index(i)-9)
-                    else:
-                        populationIndices[p].append(i)   # this only happens if one of the names in the population file doesn't exist in the .vcf file... I assume it's someone from KGP and raise an Exception later if they're not
             infile.close()
+            infoTags,populations,populationIndices = parseHeaderLines(metaLines,line,popFile,os.path.split(path)[1])
             if outfile != None:
-                return (outfile,infoTags,headerline,populations,populationIndices)
-            return (infoTags,headerline,populations,populationIndices)
+                return (outfile,infoTags,line,populations,populationIndices)
+            return (infoTags,line,populations,populationIndices)
         else:
             raise Exception("Missing a header line or something else is wrong...")
     infile.close()
 
-def run(args, tickFunction=tick, numTicks=100):
-    kgp = kgpInterface(args.data,sys.path[0] + "/KGP_populations.txt")
-    outfile,takenTags,headerline,myPopulations,myPopulationIndices = parseVcfHeader(args.infile,args.outfile,args.popFile)
-    
-    statsToCalculate = {}   # {INFO tag : (allStats.statistic,targetPop,backgroundPop,"ASC"/"DEC",REF/ALT hack: True/False,backTag))}
-    alleleOrders = {}
+class statsStage(vcfStage):
+    ''' Adds the statistics requested in args (see --help) as INFO fields '''
+    def __init__(self, args):
+        self.args = args
+        self.kgp = kgpInterface(args.data,sys.path[0] + "/KGP_populations.txt")
+        self.cursor = None
+        self.statsToCalculate = {}   # {INFO tag : (allStats.statistic,targetPop,backgroundPop,"ASC"/"DEC",REF/ALT hack: True/False,backTag))}
+        self.alleleOrders = {}
     
-    def storeCalcDetails(stat,calculation):
-        if not len(calculation) > 0:
-            raise Exception('Must specify a target population!')
-        target = calculation[0]
-        background = calculation[1] if len(calculation) > 1 else None
-        direction = calculation[2] if len(calculation) > 2 else 'ASC'
-        hack = len(calculation) > 3 and calculation[3].strip().lower().startswith('t')
-        tag = "%s_%s_" % (target,allStats.STAT_NAMES[stat])
-        if background == None:
-            backTag = "ALT"
-            tag += backTag
-            infoLine = "##INFO=<ID=%s,Number=A,Type=Float,Description=\"calcStats.py: %s for the %s population\">\n" % (tag,allStats.STAT_NAMES[stat],target)
-        else:
-            backTag = "%s_%s_AO" % (direction,background)
-            temp = backTag
+    def header(self, metaLines, headerline):
+        args = self.args
+        kgp = self.kgp
+        statsToCalculate = self.statsToCalculate
+        alleleOrders = self.alleleOrders
+        takenTags,myPopulations,self.myPopulationIndices = parseHeaderLines(metaLines,headerline,args.popFile,os.path.split(args.infile)[1])
+        metaLines = list(metaLines)
+        
+        def storeCalcDetails(stat,calculation):
+            if not len(calculation) > 0:
+                raise Exception('Must specify a target population!')
+            target = calculation[0]
+            background = calculation[1] if len(calculation) > 1 else None
+            direction = calculation[2] if len(calculation) > 2 else 'ASC'
+            hack = len(calculation) > 3 and calculation[3].strip().lower().startswith('t')
+            tag = "%s_%s_" % (target,allStats.STAT_NAMES[stat])
+            if background == None:
+                backTag = "ALT"
+                tag += backTag
+                infoLine = "##INFO=<ID=%s,Number=A,Type=Float,Description=\"calcStats.py: %s for the %s population\">\n" % (tag,allStats.STAT_NAMES[stat],target)
+            else:
+                backTag = "%s_%s_AO" % (direction,background)
+                temp = backTag
+                dupNumber = 2
+                while backTag in takenTags or backTag in myPopulations.iterkeys() or backTag in kgp.populations.iterkeys():
+                    backTag = temp + str(dupNumber)
+                    dupNumber += 1
+                alleleOrders[backTag] = (direction,background)
+                tag += backTag
+                if hack:
+                    tag += "_rHack"
+                infoLine = "##INFO=<ID=%s,Number=.,Type=Float,Description=\"calcStats.py: %s for the %s population, with alleles ordered by %s AF in the %s population (%s).%s\">\n" % (tag,
+                           allStats.STAT_NAMES[stat],
+                           target,
+                           "ascending" if direction == 'ASC' else "descending",
+                           background,
+                           backTag,
+                           " When %s has no data, the REF/ALT allele order is used." % background if hack else "")
             dupNumber = 2
-            while backTag in takenTags or backTag in myPopulations.iterkeys() or backTag in kgp.populations.iterkeys():
-                backTag = temp + str(dupNumber)
+            temp = tag
+            while tag in takenTags:
+                tag = temp + str(dupNumber)
                 dupNumber += 1
-            alleleOrders[backTag] = (direction,background)
-            tag += backTag
-            if hack:
-                tag += "_rHack"
-            infoLine = "##INFO=<ID=%s,Number=.,Type=Float,Description=\"calcStats.py: %s for the %s population, with alleles ordered by %s AF in the %s population (%s).%s\">\n" % (tag,
-                       allStats.STAT_NAMES[stat],
-                       target,
-                       "ascending" if direction == 'ASC' else "descending",
-                       background,
-                       backTag,
-                       " When %s has no data, the REF/ALT allele order is used." % background if hack else "")
-        dupNumber = 2
-        temp = tag
-        while tag in takenTags:
-            tag = temp + str(dupNumber)
-            dupNumber += 1
-        statsToCalculate[tag] = (stat,target,background,direction,hack,backTag)
-        return infoLine
-    
-    if args.calculate_AF != None:
-        for calculation in args.calculate_AF:
-            outfile.write(storeCalcDetails(allStats.AF,calculation))
-    if args.calculate_Carriage != None:
-        for calculation in args.calculate_Carriage:
-            outfile.write(storeCalcDetails(allStats.Carriage,calculation))
-    if args.calculate_Samples_w_calls != None:
-        for calculation in args.calculate_Samples_w_calls:
-            assert len(calculation) == 1
-            outfile.write(storeCalcDetails(allStats.Samples_w_calls,calculation))
-    
-    for popTag,(direction,background) in alleleOrders.iteritems():
-        outfile.write("##INFO=<ID=%s,Number=.,Type=String,Description=\"calcStats.py: All observed alleles for each locus, ordered by %s AF in the %s population.\">\n" % (popTag,
-                      "ascending" if direction == 'ASC' else "descending",
-                      background))
-    outfile.write(headerline)
+            statsToCalculate[tag] = (stat,target,background,direction,hack,backTag)
+            return infoLine
+        
+        if args.calculate_AF != None:
+            for calculation in args.calculate_AF:
+                metaLines.append(storeCalcDetails(allStats.AF,calculation))
+        if args.calculate_Carriage != None:
+            for calculation in args.calculate_Carriage:
+                metaLines.append(storeCalcDetails(allStats.Carriage,calculation))
+        if args.calculate_Samples_w_calls != None:
+            for calculation in args.calculate_Samples_w_calls:
+                assert len(calculation) == 1
+                metaLines.append(storeCalcDetails(allStats.Samples_w_calls,calculation))
+        
+        for popTag,(direction,background) in alleleOrders.iteritems():
+            metaLines.append("##INFO=<ID=%s,Number=.,Type=String,Description=\"calcStats.py: All observed alleles for each locus, ordered by %s AF in the %s population.\">\n" % (popTag,
+                             "ascending" if direction == 'ASC' else "descending",
+                             background))
+        return (metaLines,headerline)
     
-    def getPopIndices(pop):
-        if myPopulationIndices.has_key(pop):
+    def getPopIndices(self, pop):
+        kgp = self.kgp
+        if self.myPopulationIndices.has_key(pop):
             vcfIndices = []
             kgpIndices = []
-            for i in myPopulationIndices[pop]:
+            for i in self.myPopulationIndices[pop]:
                 if isinstance(i,str):
                     if not i in kgp.header[9:]:
                         raise Exception("Unknown sample (not in your .vcf or the KGP): %s" % i)
@@ -243,54 +261,69 @@ def run(args, tickFunction=tick, numTicks=100):
             kgpIndices = kgp.populationIndices[pop]
         return (vcfIndices,kgpIndices)
     
-    for vcfLine,kgpLine in kgp.iterateVcf(args.infile,tickFunction=tickFunction,numTicks=numTicks):
-        # first get the allele orders we need, add them as INFO fields
-        alleleLists = {}    # popTag : []
-        vcfLine.extractAlleles()
-        vcfLine.extractInfo()
-        if kgpLine != None:
-            kgpLine.extractAlleles()
-        
-        for popTag,(direction,background) in alleleOrders.iteritems():
-            vcfIndices,kgpIndices = getPopIndices(background)
-            tempAlleles = set(vcfLine.alleles)
+    def process(self, records):
+        for vcfLine,kgpLine in self.kgp.iterateRecords(records,self.cursor):
+            # first get the allele orders we need, add them as INFO fields
+            alleleLists = {}    # popTag : []
+            vcfLine.extractAlleles()
+            vcfLine.extractInfo()
             if kgpLine != None:
-                tempAlleles.update(kgpLine.alleles)
-            tempAlleles = list(tempAlleles)
-            tempFreqs = allStats.calculate(allStats.AF,vcfLine,vcfIndices,kgpLine,kgpIndices,tempAlleles)
-            if len(tempFreqs) < 1 or math.isinf(tempFreqs[0]):
-                vcfLine.info[popTag] = "."
-                alleleLists[popTag] = None
-            else:
-                if direction == 'ASC':
-                    alleleLists[popTag] = sorted(tempAlleles,key=lambda i:tempFreqs[tempAlleles.index(i)])
+                kgpLine.extractAlleles()
+            
+            for popTag,(direction,background) in self.alleleOrders.iteritems():
+                vcfIndices,kgpIndices = self.getPopIndices(background)
+                tempAlleles = set(vcfLine.alleles)
+                if kgpLine != None:
+                    tempAlleles.update(kgpLine.alleles)
+                tempAlleles = list(tempAlleles)
+                tempFreqs = allStats.calculate(allStats.AF,vcfLine,vcfIndices,kgpLine,kgpIndices,tempAlleles)
+                if len(tempFreqs) < 1 or math.isinf(tempFreqs[0]):
+                    vcfLine.info[popTag] = "."
+                    alleleLists[popTag] = None
                 else:
-                    alleleLists[popTag] = sorted(tempAlleles,key=lambda i:tempFreqs[tempAlleles.index(i)],reverse=True)
-                vcfLine.info[popTag] = ",".join(alleleLists[popTag])
-        
-        # now calculate based on those allele orders
-        for tag,(stat,target,background,direction,hack,backTag) in statsToCalculate.iteritems():
-            vcfIndices,kgpIndices = getPopIndices(target)
-            if backTag == 'ALT':
-                alleles = vcfLine.alleles
-            else:
-                alleles = alleleLists[backTag]
-            if alleles == None:
-                if hack:
+                    if direction == 'ASC':
+                        alleleLists[popTag] = sorted(tempAlleles,key=lambda i:tempFreqs[tempAlleles.index(i)])
+                    else:
+                        alleleLists[popTag] = sorted(tempAlleles,key=lambda i:tempFreqs[tempAlleles.index(i)],reverse=True)
+                    vcfLine.info[popTag] = ",".join(alleleLists[popTag])
+            
+            # now calculate based on those allele orders
+            for tag,(stat,target,background,direction,hack,backTag) in self.statsToCalculate.iteritems():
+                vcfIndices,kgpIndices = self.getPopIndices(target)
+                if backTag == 'ALT':
                     alleles = vcfLine.alleles
                 else:
-                    vcfLine.info[tag] = "."
-                    continue
-            result = allStats.calculate(stat,vcfLine,vcfIndices,kgpLine,kgpIndices,alleles)
-            if isinstance(result,list):
-                result = ",".join([str(r) for r in result])
-            else:
-                result = str(result)
-            vcfLine.info[tag] = result
-        
-        outfile.write(str(vcfLine))
+                    alleles = alleleLists[backTag]
+                if alleles == None:
+                    if hack:
+                        alleles = vcfLine.alleles
+                    else:
+                        vcfLine.info[tag] = "."
+                        continue
+                result = allStats.calculate(stat,vcfLine,vcfIndices,kgpLine,kgpIndices,alleles)
+                if isinstance(result,list):
+                    result = ",".join([str(r) for r in result])
+                else:
+                    result = str(result)
+                vcfLine.info[tag] = result
+            
+            yield vcfLine
     
-    outfile.close()
+    def configuration(self):
+        args = self.args
+        popFile = fileSignature(args.popFile) if args.popFile else None
+        return (args.data,popFile,args.calculate_AF,args.calculate_Carriage,args.calculate_Samples_w_calls)
+    
+    def checkpoint(self):
+        # Saving where we are in each KGP file means a resumed run can seek straight there instead of re-reading it
+        return self.kgp.cursor()
+    
+    def restore(self, state):
+        self.cursor = state
+
+def run(args, tickFunction=tick, numTicks=100):
+    streamVcf(args.infile, args.outfile, [statsStage(args)], tickFunction, numTicks,
+              checkpointPath=args.outfile + '.checkpoint', resume=args.resume.strip().lower() == "true")
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Add some calculated statistics to a .vcf file\'s INFO column. For each --calculate parameter, '+
@@ -317,5 +350,8 @@ if __name__ == '__main__':
     parser.add_argument('--calculate_Samples_w_calls', type=str, dest="calculate_Samples_w_calls", nargs="+", action="append",
                         help='Calculates the number of samples with calls, may be used multiple times. Exactly one argument is required. The argument should be the population in which to count samples with calls.')
     
+    parser.add_argument('--resume', type=str, dest="resume", nargs="?", const="True", default="False",
+                        help='Pick up where an interrupted run with the same --in and --out left off (progress is saved to a .checkpoint file next to --out every couple of minutes); the 1000 Genomes files are repositioned directly to where that run was.')
+    
     args = parser.parse_args()
     run(args)
\ No newline at end of file
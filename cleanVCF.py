@@ -1,8 +1,15 @@
 #!/usr/bin/env python
-import argparse, gzip, os
-from genome_utils import vcfLine, infoDetails, MAX_INFO_STRINGS
+import argparse, gzip, os, multiprocessing
+from genome_utils import vcfLine, infoDetails, vcfStage, profileCache, readHeader, iterateChunks, MAX_INFO_STRINGS, CHUNK_BYTES
 
-def extractInfoFields(path,max_strings=MAX_INFO_STRINGS,tickFunction=None,numTicks=1000):
+def extractInfoFields(path,max_strings=MAX_INFO_STRINGS,tickFunction=None,numTicks=1000,useCache=True):
+    # The scan is saved next to the file (see profileCache), so we only have to do this once per file
+    cacheKey = profileCache.infoKey(max_strings)
+    if useCache:
+        infoFields = profileCache.load(path, cacheKey)
+        if infoFields != None:
+            return infoFields
+    
     infoFields = {}
     
     tickInterval = os.path.getsize(path)/numTicks
@@ -39,8 +46,80 @@ def extractInfoFields(path,max_strings=MAX_INFO_STRINGS,tickFunction=None,numTic
                 else:
                     infoFields[k].addArbitraryValue(v)
     infile.close()
+    if useCache:
+        profileCache.save(path, cacheKey, infoFields)
     return infoFields
 
+def cleanInfo(info, validFields=None, removeFields=None):
+    # Filters key[=value] tokens straight out of a raw INFO string, without parsing any of the values
+    kept = []
+    for token in info.split(';'):
+        key = token.partition('=')[0]
+        if validFields != None and key not in validFields:
+            continue
+        if removeFields != None and key in removeFields:
+            continue
+        kept.append(token)
+    return ';'.join(kept)
+
+def cleanLine(line, validFields=None, removeFields=None):
+    # Only INFO changes; everything else (including the genotypes) is copied as-is
+    columns = line.split('\t',8)
+    if len(columns) < 8:
+        return line
+    elif len(columns) == 8:
+        columns[7] = (cleanInfo(columns[7].rstrip('\r\n'),validFields,removeFields) or '.') + '\n'
+    else:
+        columns[7] = cleanInfo(columns[7],validFields,removeFields) or '.'
+    return '\t'.join(columns)
+
+workerFields = (None,None)
+def initWorker(validFields, removeFields):
+    global workerFields
+    workerFields = (validFields,removeFields)
+
+def cleanChunk(lines):
+    validFields,removeFields = workerFields
+    return ''.join([cleanLine(line,validFields,removeFields) for line in lines if len(line) > 1])
+
+class cleanStage(vcfStage):
+    ''' Removes INFO fields (and their ##INFO lines) that aren't in validFields or that are in removeFields '''
+    def __init__(self, validFields=None, removeFields=None):
+        self.validFields = validFields
+        self.removeFields = removeFields
+    
+    def keep(self, tag):
+        if self.validFields != None and tag not in self.validFields:
+            return False
+        if self.removeFields != None and tag in self.removeFields:
+            return False
+        return True
+    
+    def configuration(self):
+        return tuple(sorted(fields) if fields != None else None for fields in (self.validFields,self.removeFields))
+    
+    def header(self, metaLines, headerline):
+        newLines = []
+        for line in metaLines:
+            if line.startswith("##INFO"):
+                newTag = line[line.find("ID=")+3:]
+                newTag = newTag[:newTag.find(',')]
+                if not self.keep(newTag):
+                    continue
+            newLines.append(line)
+        return (newLines,headerline)
+    
+    def process(self, records):
+        for line in records:
+            if hasattr(line,'info'):
+                for k in line.info.keys():
+                    if not self.keep(k):
+                        del line.info[k]
+            else:
+                # Nobody has parsed INFO yet, so don't bother
+                line.columns[7] = cleanInfo(line.columns[7],self.validFields,self.removeFields) or '.'
+            yield line
+
 def run(args):
     print 'Counting values...'
     max_strings = args.max_strings
@@ -61,29 +140,24 @@ def run(args):
         validFields.add(k)
     
     print 'Writing file...'
-    outfile = open(args.outfile, 'w')
-    infile = open(args.infile, 'r')
-    for line in infile:
-        line = line
-        if len(line) <= 1:
-            continue
-        elif line.startswith("##INFO"):
-            newTag = line[line.find("ID=")+3:]
-            newTag = newTag[:newTag.find(',')]
-            if not infoFields.has_key(newTag):
-                raise Exception("Second pass lost info tag:\t%s" % newTag)
-            if newTag in validFields:
-                outfile.write(line)
-        elif line.startswith("#"):
-            outfile.write(line)
-        else:
-            line = vcfLine(line.strip().split('\t'))
-            line.extractInfo()
-            keys = line.info.keys()
-            for k in keys:
-                if k not in validFields:
-                    del line.info[k]
-            outfile.write(str(line))
+    # The variants are never parsed: INFO tokens are filtered on the raw text and everything else is copied,
+    # in chunks that can be spread across --workers processes
+    infile = open(args.infile,'rb')
+    metaLines,headerline = readHeader(infile)
+    metaLines,headerline = cleanStage(validFields=validFields).header(metaLines,headerline)
+    outfile = open(args.outfile,'wb')
+    outfile.writelines(metaLines)
+    outfile.write(headerline)
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers,initWorker,(validFields,None))
+        for text in pool.imap(cleanChunk,iterateChunks(infile)):
+            outfile.write(text)
+        pool.close()
+        pool.join()
+    else:
+        initWorker(validFields,None)
+        for lines in iterateChunks(infile):
+            outfile.write(cleanChunk(lines))
     infile.close()
     outfile.close()
 
@@ -99,7 +173,8 @@ if __name__ == '__main__':
                         help='Remove specific field(s) from the .vcf file')
     parser.add_argument('--preserve_info', type=str, dest="preserve_info", nargs="+",
                         help='Only include the specified field(s) from the .vcf file (though they still can be excluded by --max_strings or --remove_info)')
+    parser.add_argument('--workers', type=int, dest="workers", nargs="?", default=1,
+                        help='Number of processes to use for writing the file (it\'s split into chunks of about %iMB). Default is 1.' % (CHUNK_BYTES/(1024*1024)))
     
     args = parser.parse_args()
     run(args)
-    
\ No newline at end of file
@@ -1,75 +1,380 @@
 #!/usr/bin/env python
-import argparse, math
+import argparse, math, gzip, mmap, tempfile
+from array import array
+from genome_utils import genomeException, regionSet, standardizeChromosome, chromosomesToKeep, COPY_BYTES
+try:
+    import numpy
+except ImportError:
+    numpy = None    # only needed for --sample_stddev and --min_gq
+
+FILTER_PRAGMA = "##FILTER=<ID=DP Filter,Description=\"Depth Filter; DP >= %i sigma\">\n"
+
+# Bits in depthScan.sets; each output set gets its own DP statistics
+ALL_SET = 1
+PURGED_SET = 2
+PASS_SET = 4
+ADD_CHR = 8     # the record's chromosome needs a "chr" prefix (with --basic_contigs)
+OUTPUT_SETS = (ALL_SET,PURGED_SET,PASS_SET)
+BLOCK_RECORDS = 1024    # records decoded into NumPy arrays at a time for --sample_stddev and --min_gq
+
+def formatValues(genotypes, index):
+    # One FORMAT value (as a float, NaN if it's missing) for each sample's split genotype column
+    return numpy.array([g[index] if len(g) > index and g[index] not in ('','.') else 'nan' for g in genotypes],dtype=float)
+
+def alleleDepths(genotypes, index):
+    # The total of each sample's AD values, for when there's no FORMAT DP
+    totals = []
+    for g in genotypes:
+        if len(g) > index:
+            values = [v for v in g[index].split(',') if v not in ('','.')]
+            if len(values) > 0:
+                totals.append(sum([float(v) for v in values]))
+                continue
+        totals.append(numpy.nan)
+    return numpy.array(totals,dtype=float)
+
+class sampleDepths:
+    '''
+    Per-sample FORMAT DP distributions: add() is given blocks of records in the first pass, and once finish() has
+    worked out each sample's mean and standard deviation, mask() says which called genotypes in a block are more than
+    stddev standard deviations from their sample's mean DP, or have a GQ below minGQ. A genotype without a DP is
+    judged by the total of its AD values instead; one without either is left alone.
+    '''
+    def __init__(self, numSamples, stddev=None, minGQ=None):
+        self.numSamples = numSamples
+        self.stddev = stddev
+        self.minGQ = minGQ
+        self.sums = numpy.zeros(numSamples)
+        self.squaresums = numpy.zeros(numSamples)
+        self.counts = numpy.zeros(numSamples)
+        self.means = None
+        self.sigmas = None
+    
+    def decode(self, lines):
+        ''' (DP,GQ,called) arrays with a row for each record and a column for each sample '''
+        depths = numpy.empty((len(lines),self.numSamples))
+        depths.fill(numpy.nan)
+        qualities = depths.copy()
+        called = numpy.zeros((len(lines),self.numSamples),dtype=bool)
+        for r,line in enumerate(lines):
+            columns = line.rstrip('\r\n').split('\t')
+            if len(columns) < 9 + self.numSamples:
+                continue
+            format = columns[8].split(':')
+            if format[0] != 'GT':
+                continue
+            genotypes = [g.split(':') for g in columns[9:9+self.numSamples]]
+            called[r] = [not g[0].startswith('.') for g in genotypes]
+            if 'DP' in format:
+                depths[r] = formatValues(genotypes, format.index('DP'))
+            elif 'AD' in format:
+                depths[r] = alleleDepths(genotypes, format.index('AD'))
+            if 'GQ' in format:
+                qualities[r] = formatValues(genotypes, format.index('GQ'))
+        return (depths,qualities,called)
+    
+    def add(self, lines):
+        depths = self.decode(lines)[0]
+        valid = ~numpy.isnan(depths)
+        depths = numpy.where(valid,depths,0.0)
+        self.sums += depths.sum(axis=0)
+        self.squaresums += (depths**2).sum(axis=0)
+        self.counts += valid.sum(axis=0)
+    
+    def finish(self):
+        counts = numpy.maximum(self.counts,1)
+        self.means = self.sums/counts
+        self.sigmas = numpy.sqrt(numpy.maximum(self.squaresums/counts - self.means**2,0.0))
+    
+    def mask(self, lines):
+        depths,qualities,called = self.decode(lines)
+        masked = numpy.zeros(depths.shape,dtype=bool)
+        with numpy.errstate(invalid='ignore',divide='ignore'):
+            if self.stddev != None:
+                # a sample whose depth never varies (sigma 0) gives inf or NaN here, so only genotypes that differ are masked
+                masked |= numpy.abs(depths - self.means)/self.sigmas >= self.stddev
+            if self.minGQ != None:
+                masked |= qualities < self.minGQ
+        return masked & called
+
+def maskGenotypes(line, masked):
+    # The genotype columns of a record (everything after FORMAT), with the masked ones' GT replaced by ./.
+    genotypes = line.rstrip('\r\n').split('\t')[9:]
+    for s in numpy.flatnonzero(masked):
+        g = genotypes[s]
+        colon = g.find(':')
+        gt = g if colon == -1 else g[:colon]
+        missing = './.' if ('/' in gt or '|' in gt) else '.'
+        genotypes[s] = missing if colon == -1 else missing + g[colon:]
+    return '\t'.join(genotypes)
+
+class depthScan:
+    '''
+    The first (and only) read of the input: the start of every record, its DP (-1 if it doesn't have one), and which
+    output sets it belongs in are kept in compact arrays, so that once each set's mean and sigma are known, everything
+    but the flagged records' FILTER columns can be copied straight from the memory-mapped input. A .gz file is
+    decompressed into a temporary file along the way, so it's only decompressed once. If samples is supplied (a
+    function that takes the number of samples and returns a sampleDepths), per-sample FORMAT DP is collected as well.
+    If stddev is supplied, the header gets a ##FILTER line describing the site-level filter.
+    
+    A record is in ALL_SET, in PURGED_SET if it's inside targets (or there aren't any), and in PASS_SET if it's in
+    PURGED_SET and its FILTER is PASS or "." (like GATK SelectVariants --excludeFiltered). With basicContigs, records
+    outside chromosomes 1-22,X,Y,M aren't in any set (see removeAlternateContigs.py), but they still count
+    towards the DP statistics, as they did when alternate contigs were only removed afterwards.
+    '''
+    def __init__(self, path, targets=None, basicContigs=False, stddev=None, samples=None):
+        self.lineStarts = array('l')
+        self.depths = array('i')
+        self.sets = array('B')
+        self.header = []
+        self.totals = dict([(s,0) for s in OUTPUT_SETS])
+        self.squaresums = dict([(s,0) for s in OUTPUT_SETS])
+        self.counts = dict([(s,0) for s in OUTPUT_SETS])
+        
+        if path.endswith('.gz'):
+            infile = gzip.open(path,'rb')
+            self.datafile = tempfile.TemporaryFile()
+        else:
+            infile = open(path,'rb')
+            self.datafile = None
+        
+        offset = 0
+        wrotePragma = False
+        self.headerSize = None
+        self.samples = None     # a sampleDepths, once we know how many samples there are
+        block = []
+        for line in infile:
+            if self.datafile != None:
+                self.datafile.write(line)
+            if self.headerSize == None:
+                if line.startswith("#"):
+                    if stddev != None and not wrotePragma and line.startswith("##FILTER"):
+                        # Stick our pragma line in before the other filters
+                        self.header.append(FILTER_PRAGMA % stddev)
+                        wrotePragma = True
+                    if samples != None and line.startswith("#CHROM"):
+                        self.samples = samples(len(line.rstrip('\r\n').split('\t')[9:]))
+                    if basicContigs and line.startswith("##contig"):
+                        renamed = renameContig(line)
+                        if renamed != None:
+                            self.header.append(renamed)
+                    else:
+                        self.header.append(line)
+                    offset += len(line)
+                    continue
+                self.headerSize = offset
+            
+            if len(line.strip()) > 1:
+                columns = line.split('\t',8)
+                sets = ALL_SET
+                if targets == None or targets.contains(standardizeChromosome(columns[0]),int(columns[1])):
+                    sets |= PURGED_SET
+                    if columns[6] in ('PASS','.'):
+                        sets |= PASS_SET
+                depth = -1
+                for i in columns[7].split(";"):
+                    if i.startswith('DP'):
+                        depth = int(i.split("=")[1])
+                        for s in OUTPUT_SETS:
+                            if sets & s:
+                                self.totals[s] += depth
+                                self.squaresums[s] += depth**2
+                                self.counts[s] += 1
+                        break
+                if basicContigs:
+                    if standardizeChromosome(columns[0]) not in chromosomesToKeep:
+                        sets = 0
+                    elif not columns[0].startswith('chr'):
+                        sets |= ADD_CHR
+                self.lineStarts.append(offset)
+                self.depths.append(depth)
+                self.sets.append(sets)
+                if self.samples != None:
+                    block.append(line)
+                    if len(block) >= BLOCK_RECORDS:
+                        self.samples.add(block)
+                        block = []
+            offset += len(line)
+        if self.samples != None:
+            if len(block) > 0:
+                self.samples.add(block)
+            self.samples.finish()
+        
+        if self.datafile != None:
+            infile.close()
+            self.datafile.flush()
+        else:
+            self.datafile = infile
+        self.size = offset
+        if self.headerSize == None:
+            self.headerSize = offset
+    
+    def statistics(self, s):
+        ''' (mean,sigma) of DP for an output set, or None if none of its records have a DP '''
+        if self.counts[s] == 0:
+            return None
+        return (float(self.totals[s])/self.counts[s],math.sqrt(float(self.squaresums[s])/self.counts[s]))
+    
+    def close(self):
+        self.datafile.close()
+
+def renameContig(line):
+    # Same as removeAlternateContigs.py: ##contig lines get a "chr" prefix, and are dropped if they aren't chromosomes 1-22,X,Y,M
+    contigID = line[line.find('ID=')+3:]
+    before = line[:line.find('ID=')+3]
+    after = contigID[contigID.find(','):]
+    contigID = contigID[:contigID.find(',')]
+    if not contigID.startswith('chr'):
+        contigID = 'chr' + contigID
+    if contigID in chromosomesToKeep:
+        return before + contigID + after
+    else:
+        return None
+
+class spanWriter:
+    # One output file, filled by copying spans of the memory-mapped input in pieces (so an unchanged stretch of a
+    # huge file isn't pulled into memory all at once)
+    def __init__(self, path, data, position):
+        self.outfile = open(path,'wb')
+        self.data = data
+        self.position = position
+    
+    def copyTo(self, end):
+        while self.position < end:
+            self.outfile.write(self.data[self.position:min(end,self.position+COPY_BYTES)])
+            self.position = min(end,self.position+COPY_BYTES)
+    
+    def close(self):
+        self.copyTo(len(self.data))
+        self.outfile.close()
+
+def filterSpan(data, lineStart):
+    # The start and end of a record's FILTER column (the seventh one)
+    start = lineStart
+    for i in xrange(6):
+        start = data.find('\t',start)+1
+    return (start,data.find('\t',start))
 
 def run(args):
-    total = 0
-    squaresum = 0
-    count = 0
+    outputs = [(ALL_SET,args.outfile,"ALL")]
+    if args.purged_outfile != None:
+        outputs.append((PURGED_SET,args.purged_outfile,"PURGED"))
+    if args.pass_outfile != None:
+        outputs.append((PASS_SET,args.pass_outfile,"PASS"))
+    if args.targets != None and len(outputs) == 1:
+        raise genomeException("--targets only affects --purged_out and --pass_out")
+    targets = None if args.targets == None else regionSet.fromBed(args.targets)
+    basicContigs = args.basic_contigs.strip().lower() == "true"
+    samples = None
+    if args.sample_stddev != None or args.min_gq != None:
+        if numpy == None:
+            raise genomeException("--sample_stddev and --min_gq need NumPy")
+        samples = lambda numSamples: sampleDepths(numSamples, args.sample_stddev, args.min_gq)
+    elif args.stddev == None:
+        raise genomeException("Nothing to do: supply --stddev, --sample_stddev, and/or --min_gq")
+    
     print "Calculating DP standard deviation"
     print "Reading..."
-    infile = open(args.infile,'r')
-    for line in infile:
-        if len(line.strip()) <= 1 or line.startswith("#"):
-            continue
-        columns = line.strip().split('\t')
-        info = columns[7].split(";")
-        for i in info:
-            if i.startswith('DP'):
-                dp = i.split("=")
-                depth = int(dp[1])
-                count += 1
-                total += depth
-                squaresum += depth**2
-                break
-    infile.close()
-    
-    mean = float(total)/count
-    sigma = math.sqrt(float(squaresum)/count)
-    print "Mean: %f Sigma: %f" % (mean,sigma)
+    scan = depthScan(args.infile, targets, basicContigs, args.stddev, samples)
+    stats = {}
+    for s,path,name in outputs:
+        stats[s] = scan.statistics(s)
+        if args.stddev == None:
+            stats[s] = None
+        elif stats[s] == None:
+            print "%s: no DP values, so nothing gets the DP Filter" % name
+        else:
+            print "%s: Mean: %f Sigma: %f" % ((name,) + stats[s])
     
     print "Writing..."
-    wrotePragma = False
-    
-    outfile = open(args.outfile,'w')
-    infile = open(args.infile,'r')
-    for line in infile:
-        if len(line.strip()) <= 1:
-            continue
-        if line.startswith("#"):
-            if not wrotePragma and line.startswith("##FILTER"):
-                # Stick our pragma line in before the other filters
-                outfile.write("##FILTER=<ID=DP Filter,Description=\"Depth Filter; DP >= %i sigma\">\n")
-                wrotePragma = True
-            outfile.write(line)
-        else:
-            columns = line.strip().split('\t')
-            filters = columns[6].split(";")
-            info = columns[7].split(";")
-            for i in info:
-                if i.startswith('DP'):
-                    dp = i.split("=")
-                    depth = int(dp[1])
-                    stddevs = abs(depth-mean)/sigma
-                    if stddevs >= args.stddev:
-                        if 'PASS' in filters:
-                            filters.remove('PASS')
-                        filters.append('DP Filter')
-                    break
-            columns[6] = ";".join(filters)
-            outfile.write('\t'.join(columns)+"\n")
-    infile.close()
-    outfile.close()
+    # Every output is written at the same time: each copies the spans of the input it needs, skipping records
+    # that aren't in its set, and only rewrites the FILTER column of records more than --stddev sigma from its mean
+    data = mmap.mmap(scan.datafile.fileno(),scan.size,access=mmap.ACCESS_READ)
+    header = ''.join(scan.header)
+    writers = []
+    for s,path,name in outputs:
+        writer = spanWriter(path, data, scan.headerSize)
+        writer.outfile.write(header)
+        writers.append((s,writer))
+    numRecords = len(scan.lineStarts)
+    numMasked = 0
+    masks = None
+    for r in xrange(numRecords):
+        lineStart = scan.lineStarts[r]
+        lineEnd = scan.lineStarts[r+1] if r+1 < numRecords else scan.size
+        sets = scan.sets[r]
+        depth = scan.depths[r]
+        filterColumn = None
+        genotypeColumns = None
+        if scan.samples != None:
+            # genotypes are masked a block of records at a time
+            if r % BLOCK_RECORDS == 0:
+                blockEnd = min(r+BLOCK_RECORDS,numRecords)
+                ends = list(scan.lineStarts[r+1:blockEnd]) + [scan.lineStarts[blockEnd] if blockEnd < numRecords else scan.size]
+                lines = [data[start:end] for start,end in zip(scan.lineStarts[r:blockEnd],ends)]
+                masks = scan.samples.mask(lines)
+            masked = masks[r % BLOCK_RECORDS]
+            if masked.any():
+                numMasked += masked.sum()
+                line = data[lineStart:lineEnd]
+                columns = line.split('\t',9)
+                start = lineStart + sum([len(c) for c in columns[:9]]) + 9
+                genotypeColumns = (start,lineStart + len(line.rstrip('\r\n')),maskGenotypes(line, masked))
+        for s,writer in writers:
+            if not sets & s:
+                writer.copyTo(lineStart)
+                writer.position = lineEnd
+                continue
+            if sets & ADD_CHR:
+                writer.copyTo(lineStart)
+                writer.outfile.write('chr')
+            if depth >= 0 and stats[s] != None and abs(depth-stats[s][0])/stats[s][1] >= args.stddev:
+                if filterColumn == None:
+                    filterColumn = filterSpan(data, lineStart)
+                start,end = filterColumn
+                filters = data[start:end].split(";")
+                if 'PASS' in filters:
+                    filters.remove('PASS')
+                filters.append('DP Filter')
+                writer.copyTo(start)
+                writer.outfile.write(";".join(filters))
+                writer.position = end
+            if genotypeColumns != None:
+                start,end,text = genotypeColumns
+                writer.copyTo(start)
+                writer.outfile.write(text)
+                writer.position = end
+    for s,writer in writers:
+        writer.close()
+    if scan.samples != None:
+        print "Masked %i genotypes" % numMasked
+    data.close()
+    scan.close()
     print "Done"
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Applies "DPfilter" to variants that are "5 or 6 sigma from the '+
-                                     'mean coverage across all samples" (see GATK best practice v4')
+                                     'mean coverage across all samples" (see GATK best practice v4). Can also write the on-target '+
+                                     '(--purged_out) and unfiltered (--pass_out) subsets, each with its own DP statistics, in the same pass.')
     parser.add_argument('--stddev', type=int, dest="stddev",
                         help='number of standard deviations below which a variant will PASS.')
+    parser.add_argument('--sample_stddev', type=float, dest="sample_stddev",
+                        help='Also mask individual genotypes (to ./.) whose FORMAT DP (or total AD) is at least this many standard deviations from '+
+                        'that sample\'s mean depth. Needs NumPy.')
+    parser.add_argument('--min_gq', type=float, dest="min_gq",
+                        help='Also mask individual genotypes (to ./.) with a FORMAT GQ below this. Needs NumPy.')
     parser.add_argument('--in', type=str, dest="infile",
-                        help='input .vcf file')
+                        help='input .vcf or .vcf.gz file')
     parser.add_argument('--out', type=str, dest="outfile",
                         help='output .vcf file')
+    parser.add_argument('--purged_out', type=str, dest="purged_outfile",
+                        help='Also write the variants inside --targets (or all of them, without --targets) to this .vcf file.')
+    parser.add_argument('--pass_out', type=str, dest="pass_outfile",
+                        help='Also write the --purged_out variants whose FILTER is PASS (or ".") to this .vcf file.')
+    parser.add_argument('--targets', type=str, dest="targets",
+                        help='.bed file of targeted regions (e.g. for exome sequencing) for --purged_out and --pass_out.')
+    parser.add_argument('--basic_contigs', type=str, dest="basic_contigs", nargs="?", const="True", default="False",
+                        help='Leave only chromosomes 1-22,X,Y,M in every output, like removeAlternateContigs.py.')
     
     args = parser.parse_args()
-    run(args)
\ No newline at end of file
+    run(args)
@@ -1,30 +1,23 @@
 #!/usr/bin/env python
-import argparse, sys
-from genome_utils import kgpInterface, countingDict
+import argparse, multiprocessing, os, sys
+from genome_utils import kgpInterface, countingDict, genomeException, plinkRecords, plinkWriter, appendFile, chromosomeOrder
 
-def run(args):
-    kgp = kgpInterface(args.data,sys.path[0] + "/KGP_populations.txt")
-    outfile = open(args.outfile,'wb')
-    freqOnly = args.frequencies_only.lower().startswith('t')
-    
-    wroteHeader = False
-    for line in kgp.iterate():
-        if not wroteHeader:
-            outfile.write('CHROM\tPOS\tID')
-            if not freqOnly:
-                for p in kgp.populations[args.pop]:
-                    outfile.write('\t%s_1\t%s_2' % (p,p))
-            outfile.write('\n')
-            wroteHeader = True
+def extractChromosome(kgp, chrom, samples, freqOnly, outfile=None, plinkFiles=None):
+    # Only the population's genotype columns are ever decoded (see kgpInterface.iterateChromosome), so genotype j
+    # of each line is samples[j]
+    indices = range(len(samples))
+    for line in kgp.iterateChromosome(chrom, [kgp.individualIndices[p] for p in samples]):
+        if plinkFiles != None:
+            plinkFiles.write(plinkRecords(line, indices))
+            continue
         line.extractChrAndPos()
         line.extractAlleles()
         line.extractGenotypes()
-        outfile.write('\t'.join([line.chromosome,str(line.position),line.name]))
+        row = [line.chromosome,str(line.position),line.name]
         if freqOnly:
             counts = countingDict()
             total = 0.0
-            for p in kgp.populations[args.pop]:
-                i = kgp.individualIndices[p]
+            for i in indices:
                 if line.genotypes[i][0] != None:
                     counts[line.genotypes[i][0]] += 1
                     total += 1.0
@@ -32,10 +25,9 @@ def run(args):
                     counts[line.genotypes[i][1]] += 1
                     total += 1.0
             for i,c in counts.iteritems():
-                outfile.write('\t%s:\t%f' % (line.alleles[i],c/total))
+                row.append('%s:\t%f' % (line.alleles[i],c/total))
         else:
-            for p in kgp.populations[args.pop]:
-                i = kgp.individualIndices[p]
+            for i in indices:
                 a1 = line.genotypes[i][0]
                 if a1 == None:
                     a1 = '.'
@@ -46,14 +38,84 @@ def run(args):
                     a2 = '.'
                 else:
                     a2 = line.alleles[a2]
-                
-                outfile.write('\t%s\t%s' % (a1,a2))
+                row.append(a1)
+                row.append(a2)
+        outfile.write('\t'.join(row) + '\n')
+
+def partPath(args, chrom):
+    if args.plink != None:
+        return "%s.%s.part" % (args.plink,chrom)
+    else:
+        return "%s.%s.part" % (args.outfile,chrom)
+
+def extractWorker(job):
+    # Each worker process has its own kgpInterface (gzip files can't be shared), and writes a whole chromosome to
+    # a part file that run() appends in order
+    chrom,args,popPath = job
+    kgp = kgpInterface(args.data,popPath)
+    samples = kgp.populations[args.pop]
+    freqOnly = args.frequencies_only.lower().startswith('t')
+    path = partPath(args, chrom)
+    if args.plink != None:
+        plinkFiles = plinkWriter(path, samples, partial=True)
+        extractChromosome(kgp, chrom, samples, freqOnly, plinkFiles=plinkFiles)
+        plinkFiles.close()
+    else:
+        outfile = open(path,'wb')
+        extractChromosome(kgp, chrom, samples, freqOnly, outfile=outfile)
+        outfile.close()
+    return chrom
+
+def run(args):
+    popPath = sys.path[0] + "/KGP_populations.txt"
+    kgp = kgpInterface(args.data,popPath)
+    if args.plink == None and args.outfile == None:
+        raise genomeException("Either --out or --plink is required")
+    if not kgp.populations.has_key(args.pop):
+        raise genomeException("Unknown population: %s" % args.pop)
+    samples = kgp.populations[args.pop]
+    freqOnly = args.frequencies_only.lower().startswith('t')
+    chromosomes = [c for c in chromosomeOrder if kgp.files.has_key(c)]
+    
+    plinkFiles = None
+    outfile = None
+    if args.plink != None:
+        plinkFiles = plinkWriter(args.plink, samples)
+    else:
+        outfile = open(args.outfile,'wb')
+        outfile.write('CHROM\tPOS\tID')
+        if not freqOnly:
+            for p in samples:
+                outfile.write('\t%s_1\t%s_2' % (p,p))
         outfile.write('\n')
-    outfile.close()
+    
+    if args.workers > 1:
+        # imap hands back the chromosomes in chromosomeOrder, whichever finishes first
+        pool = multiprocessing.Pool(args.workers)
+        for chrom in pool.imap(extractWorker,[(c,args,popPath) for c in chromosomes]):
+            path = partPath(args, chrom)
+            if plinkFiles != None:
+                plinkFiles.appendPartial(path)
+                os.remove(path + '.bim')
+                os.remove(path + '.bed')
+            else:
+                with open(path,'rb') as infile:
+                    appendFile(infile, outfile)
+                os.remove(path)
+        pool.close()
+        pool.join()
+    else:
+        for chrom in chromosomes:
+            extractChromosome(kgp, chrom, samples, freqOnly, outfile, plinkFiles)
+    
+    if plinkFiles != None:
+        plinkFiles.close()
+    else:
+        outfile.close()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generates a .csv file containing all the genotypes for a population in the 1000 Genomes data set.')
-    parser.add_argument('--out', type=str, dest="outfile", required=True,
+    parser.add_argument('--out', type=str, dest="outfile",
                         help='output .csv file')
     parser.add_argument('--data', type=str, dest="data", required=True,
                         help='Path to directory containing 1000 Genomes .vcf.gz files 1-22,X,Y')
@@ -61,6 +123,11 @@ if __name__ == '__main__':
                         help='One of the column headers in KGP_populations.txt. Defaults to kALL.')
     parser.add_argument('--frequencies_only', type=str, dest="frequencies_only", nargs="?", const="True", default="False",
                         help='Instead of dumping all the genotypes, just give a frequency for each allele.')
-        
+    parser.add_argument('--plink', type=str, dest="plink",
+                        help='Instead of a .csv file, write the genotypes as PLINK binary files named with this prefix (prefix.bed, prefix.bim, and prefix.fam). '+
+                        'Variants with more than one ALT allele are split into one line per ALT allele.')
+    parser.add_argument('--workers', type=int, dest="workers", nargs="?", default=1,
+                        help='Number of processes to use; each one extracts a whole chromosome at a time, and the results are put back together in order. Default is 1.')
+    
     args = parser.parse_args()
     run(args)
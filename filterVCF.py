@@ -1,106 +1,517 @@
 #!/usr/bin/env python
-import argparse
-from genome_utils import vcfLine, bedLine
-
-def run(args):
-    
-    infile = open(args.infile,'r')
-    outfile = open(args.outfile,'w')
-    failfile = None
-    if args.failfile != "":
-        failfile = open(args.failfile,'w')
-    errfile = None
-    if args.errfile != "":
-        errfile = open(args.errfile,'w')
-    
-    if args.expression != "":
-        tempfile = open(args.expression,'r')
-        expression = tempfile.readline()
-        tempfile.close()
+import argparse, ast, math, os, re
+from genome_utils import vcfLine, vcfStage, regionSet, genomeException, fileSignature
+try:
+    import numpy
+except ImportError:
+    numpy = None    # --block_size will just fall back to evaluating one variant at a time
+
+PASS = 0
+FAIL = 1
+ERROR = 2
+
+EXPRESSION_GLOBALS = {'__builtins__':__builtins__}
+EXPRESSION_GLOBALS.update((k,v) for k,v in math.__dict__.iteritems() if not k.startswith('_'))
+FORMAT_SPEC = re.compile(r'%[ #0+\-]*(\d*)(\.\d+)?([a-zA-Z%])')
+PLACEHOLDER_NAME = re.compile(r'^_c\d+$')
+STRING_PREFIX = re.compile(r'(?:^|[^\w])([rRuUbB]{1,2})$')
+
+def literalValue(value):
+    # What a value turns into when its text is pasted directly into an expression (e.g. the INFO string "30" becomes 30)
+    if isinstance(value,(int,long,float,list)):
+        return value
+    value = str(value)
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return ast.literal_eval(value)
+    except (ValueError,SyntaxError):
+        raise ValueError("%s isn't a valid Python literal; try quoting it in the expression" % value)
+
+def parseExpression(expression):
+    '''
+    Splits an expression with %s placeholders (and %% for a literal %) into Python source that refers to
+    each placeholder by a parameter name instead. Placeholders inside string literals keep the old string
+    substitution behavior; bare placeholders receive the value itself. Returns (source, [True if the nth
+    placeholder is bare, False if it's inside a string])
+    '''
+    source = ""
+    bare = []
+    i = 0
+    while i < len(expression):
+        c = expression[i]
+        if c in "'\"":
+            # find the end of this string literal (possibly triple-quoted, possibly with escapes); adjacent
+            # literals are kept together, as Python concatenates them before any % formatting happens
+            prefix = STRING_PREFIX.search(source)
+            literal = ""
+            if prefix != None:
+                literal = prefix.group(1)
+                source = source[:prefix.start(1)]
+            j = i
+            while j < len(expression) and expression[j] in "'\"":
+                quote = expression[j:j+3] if expression[j:j+3] in ("'''",'"""') else expression[j]
+                k = j + len(quote)
+                while k < len(expression) and not expression.startswith(quote,k):
+                    if expression[k] == '\\':
+                        k += 1
+                    k += 1
+                k += len(quote)
+                literal += expression[i:k]
+                i = k
+                j = k
+                while j < len(expression) and expression[j].isspace():
+                    j += 1
+            count = len([m for m in FORMAT_SPEC.finditer(literal) if m.group(3) != '%'])
+            if count > 0:
+                names = []
+                for x in xrange(count):
+                    names.append('_c%i' % len(bare))
+                    bare.append(False)
+                source += "(%s %% (%s,))" % (literal,",".join(names))
+            else:
+                try:
+                    source += literal % ()
+                except (TypeError,ValueError):
+                    raise genomeException("Unescaped %% in expression (use %%%% instead): %s" % expression)
+        elif c == '%':
+            spec = FORMAT_SPEC.match(expression,i)
+            if spec != None and spec.group(3) == '%':
+                source += '%'
+            elif spec != None and spec.group(0) == '%s':
+                source += '_c%i' % len(bare)
+                bare.append(True)
+            else:
+                raise genomeException("Only %%s and %%%% are allowed outside of strings in expressions: %s" % expression)
+            i = spec.end()
+        else:
+            source += c
+            i += 1
+    return (source,bare)
+
+def compileExpression(expression):
+    '''
+    Compiles an expression once into a list of (function, [placeholder indices]) conjuncts - one for each
+    part of a top-level "and", so that they can be evaluated separately. Each function takes the values
+    of its placeholders as arguments. The expression can also be a statement that assigns keep_variant
+    (like vcfCleaner's preset filters); that can't be split, so it becomes a single conjunct.
+    '''
+    source,bare = parseExpression(expression.strip())
+    try:
+        tree = ast.parse(source,'<expression>','eval')
+    except SyntaxError:
+        params = ",".join('_c%i' % i for i in xrange(len(bare)))
+        code = "def _filter(%s):\n    keep_variant = None\n    %s\n    return keep_variant\n" % (params,source)
+        namespace = {}
+        exec compile(code,'<expression>','exec') in EXPRESSION_GLOBALS, namespace
+        return [(namespace['_filter'],range(len(bare)))]
+    
+    if isinstance(tree.body,ast.BoolOp) and isinstance(tree.body.op,ast.And):
+        parts = tree.body.values
     else:
-        expression = "True"
+        parts = [tree.body]
+    conjuncts = []
+    for part in parts:
+        indices = set()
+        for node in ast.walk(part):
+            if isinstance(node,ast.Name) and PLACEHOLDER_NAME.match(node.id):
+                indices.add(int(node.id[2:]))
+        indices = sorted(indices)
+        arguments = ast.arguments(args=[ast.Name(id='_c%i' % i,ctx=ast.Param()) for i in indices],vararg=None,kwarg=None,defaults=[])
+        lambdaTree = ast.Expression(body=ast.Lambda(args=arguments,body=part))
+        ast.fix_missing_locations(lambdaTree)
+        conjuncts.append((eval(compile(lambdaTree,'<expression>','eval'),EXPRESSION_GLOBALS),indices))
+    return conjuncts
+
+def extractColumn(line, column):
+    # vcfLine caches what it extracts, so asking for the same column twice is cheap
+    if column == "CHROM":
+        line.extractChrAndPos()
+        return line.chromosome
+    elif column == "POS":
+        line.extractChrAndPos()
+        return line.position
+    elif column == "ID":
+        line.extractChrAndPos()
+        return line.name
+    elif column == "QUAL":
+        line.extractQual()
+        return line.qual
+    elif column == "FILTER":
+        line.extractFilters()
+        return line.filters
+    else:
+        line.extractInfo()
+        return line.info.get(column,".")
+
+class filterPlan:
+    '''
+    Evaluates an expression's conjuncts cheapest first: anything that only looks at CHROM, POS, ID, QUAL,
+    or FILTER runs before anything that needs INFO, so INFO is never parsed for variants that one of the
+    cheap checks already rejected. The result is the same as evaluating the whole expression, except that
+    a variant that fails a cheap check is reported as failing even if an INFO check would have raised an error.
+    '''
+    CHEAP_COLUMNS = set(["CHROM","POS","ID","QUAL","FILTER"])
     
-    columns = []
-    if args.columns != "":
-        tempfile = open(args.columns, 'r')
-        for line in tempfile:
-            line = line.strip()
-            columns.append(line)
-        tempfile.close()
+    def __init__(self, expression, columns):
+        conjuncts = compileExpression(expression)
+        source,bare = parseExpression(expression.strip())
+        if len(bare) > len(columns):
+            raise genomeException("The expression has %i %%s placeholders, but only %i columns were supplied" % (len(bare),len(columns)))
+        converters = [literalValue if b else str for b in bare]
+        
+        self.conjuncts = []   # (original position, function, [(column, converter)])
+        for order,(function,indices) in enumerate(conjuncts):
+            params = [(columns[i],converters[i]) for i in indices]
+            cheap = all(c in filterPlan.CHEAP_COLUMNS for c,convert in params)
+            self.conjuncts.append((0 if cheap else 1,order,function,params))
+        self.conjuncts.sort()
+        self.lastOrder = len(conjuncts)-1
     
-    bedRegions = None
-    if args.bed != "":
-        bedRegions = []
-        tempfile = open(args.bed, 'r')
-        for line in tempfile:
-            bedRegions.append(bedLine(line.split()))
-        tempfile.close()
+    def evaluate(self, line):
+        # Like "a and b and c": the first false-ish value, or else the value of the last conjunct
+        lastValue = True
+        for cost,order,function,params in self.conjuncts:
+            result = function(*[convert(extractColumn(line,c)) for c,convert in params])
+            if not result:
+                return result
+            if order == self.lastOrder:
+                lastValue = result
+        return lastValue
+
+class notVectorizable(Exception):
+    pass
+
+class vectorizedExpression:
+    '''
+    Evaluates simple expressions on a whole block of variants at once with NumPy: comparisons (including
+    chained ones) between columns and numbers or strings, combined with and/or/not. Bare placeholders are
+    treated as numbers and quoted ones ('%s') as strings, just like the per-variant evaluation does.
+    Anything else raises notVectorizable from the constructor. Variants whose values don't convert cleanly
+    (missing values, lists, etc.) are flagged so that they can be evaluated one at a time instead.
+    '''
+    COMPARISONS = {ast.Eq:numpy.equal if numpy else None,
+                   ast.NotEq:numpy.not_equal if numpy else None,
+                   ast.Lt:numpy.less if numpy else None,
+                   ast.LtE:numpy.less_equal if numpy else None,
+                   ast.Gt:numpy.greater if numpy else None,
+                   ast.GtE:numpy.greater_equal if numpy else None}
+    
+    def __init__(self, expression, columns):
+        if numpy == None:
+            raise notVectorizable("NumPy isn't installed")
+        source,bare = parseExpression(expression.strip())
+        try:
+            tree = ast.parse(source,'<expression>','eval').body
+        except SyntaxError:
+            # vcfCleaner's presets are "keep_variant = <expression>"
+            tree = ast.parse(source,'<expression>','exec').body
+            if len(tree) != 1 or not isinstance(tree[0],ast.Assign) or len(tree[0].targets) != 1 or \
+               not isinstance(tree[0].targets[0],ast.Name) or tree[0].targets[0].id != 'keep_variant':
+                raise notVectorizable(source)
+            tree = tree[0].value
+        self.numeric = {}   # placeholder index : column
+        self.strings = {}   # placeholder index : column
+        kind,self.function = self.build(tree)
+        if kind != 'bool':
+            raise notVectorizable(source)
+        for i in self.numeric.iterkeys():
+            if i >= len(columns):
+                raise genomeException("The expression has more %s placeholders than columns")
+            self.numeric[i] = columns[i]
+        for i in self.strings.iterkeys():
+            if i >= len(columns):
+                raise genomeException("The expression has more %s placeholders than columns")
+            self.strings[i] = columns[i]
+    
+    def build(self, node):
+        # returns (kind, function(arrays)) where kind is 'num', 'str', or 'bool'
+        if isinstance(node,ast.BoolOp):
+            parts = [self.build(v) for v in node.values]
+            if any(k != 'bool' for k,f in parts):
+                raise notVectorizable()
+            combine = numpy.logical_and if isinstance(node.op,ast.And) else numpy.logical_or
+            functions = [f for k,f in parts]
+            return ('bool',lambda arrays: reduce(combine,[f(arrays) for f in functions]))
+        elif isinstance(node,ast.UnaryOp) and isinstance(node.op,ast.Not):
+            kind,f = self.build(node.operand)
+            if kind != 'bool':
+                raise notVectorizable()
+            return ('bool',lambda arrays: numpy.logical_not(f(arrays)))
+        elif isinstance(node,ast.Compare):
+            operands = [self.build(node.left)] + [self.build(c) for c in node.comparators]
+            kinds = set(k for k,f in operands)
+            if len(kinds) != 1 or 'bool' in kinds:
+                raise notVectorizable()
+            comparisons = []
+            for i,op in enumerate(node.ops):
+                if not vectorizedExpression.COMPARISONS.has_key(type(op)):
+                    raise notVectorizable()
+                if 'str' in kinds and not isinstance(op,(ast.Eq,ast.NotEq)):
+                    raise notVectorizable()
+                comparisons.append((vectorizedExpression.COMPARISONS[type(op)],operands[i][1],operands[i+1][1]))
+            return ('bool',lambda arrays: reduce(numpy.logical_and,[op(left(arrays),right(arrays)) for op,left,right in comparisons]))
+        elif isinstance(node,ast.Num) and isinstance(node.n,(int,long,float)):
+            value = node.n
+            return ('num',lambda arrays: value)
+        elif isinstance(node,ast.Str):
+            value = node.s
+            return ('str',lambda arrays: value)
+        elif isinstance(node,ast.UnaryOp) and isinstance(node.op,ast.USub) and isinstance(node.operand,ast.Num):
+            value = -node.operand.n
+            return ('num',lambda arrays: value)
+        elif isinstance(node,ast.Name) and PLACEHOLDER_NAME.match(node.id):
+            i = int(node.id[2:])
+            self.numeric[i] = None
+            return ('num',lambda arrays: arrays[i])
+        elif isinstance(node,ast.BinOp) and isinstance(node.op,ast.Mod) and isinstance(node.left,ast.Str) and node.left.s == '%s' and \
+             isinstance(node.right,ast.Tuple) and len(node.right.elts) == 1 and isinstance(node.right.elts[0],ast.Name):
+            # a quoted placeholder, i.e. '%s' % (_c0,)
+            i = int(node.right.elts[0].id[2:])
+            self.strings[i] = None
+            return ('str',lambda arrays: arrays[i])
+        raise notVectorizable()
+    
+    def evaluate(self, lines):
+        ''' Returns (mask of variants that pass, mask of variants that need to be evaluated individually) '''
+        n = len(lines)
+        unconverted = numpy.zeros(n,dtype=bool)
+        columns = set(self.numeric.values() + self.strings.values())
+        values = dict([(column,[None]*n) for column in columns])
+        for j,line in enumerate(lines):
+            try:
+                for column in columns:
+                    values[column][j] = extractColumn(line,column)
+            except Exception:
+                # e.g. a QUAL of "."; classify() will route it to the error output
+                unconverted[j] = True
+        arrays = {}
+        for i,column in self.numeric.iteritems():
+            numbers = numpy.empty(n,dtype=float)
+            for j,v in enumerate(values[column]):
+                try:
+                    if unconverted[j] or isinstance(v,(list,bool)) or v == None:
+                        raise ValueError()
+                    numbers[j] = float(v)
+                except (ValueError,OverflowError):
+                    numbers[j] = numpy.nan
+                    unconverted[j] = True
+            arrays[i] = numbers
+        for i,column in self.strings.iteritems():
+            arrays[i] = numpy.array([str(v) for v in values[column]],dtype=object)
+        with numpy.errstate(invalid='ignore'):
+            mask = numpy.asarray(self.function(arrays),dtype=bool)
+        # an expression that only compares constants gives a single value for the whole block
+        mask = numpy.broadcast_to(mask,(n,))
+        return (mask,unconverted)
+
+class bedFilter:
+    ''' Passes variants that lie within the regions of a .bed file '''
+    def __init__(self, path):
+        self.name = "BED: %s" % path
+        self.settings = fileSignature(path)
+        self.regions = regionSet.fromBed(path)
+        self.blockSize = 1
+    
+    def classifyBlock(self, lines):
+        routes = []
+        for line in lines:
+            line.extractChrAndPos()
+            routes.append(PASS if self.regions.contains(line.chromosome, line.position) else FAIL)
+        return routes
+
+class expressionFilter:
+    ''' Passes variants for which an expression (see --expression) is True '''
+    def __init__(self, expression, columns, blockSize=1):
+        self.name = "EXPRESSION: %s" % expression.strip()
+        self.settings = (expression.strip(),list(columns))
+        self.plan = filterPlan(expression, columns)
+        self.vectorized = None
+        if blockSize > 1:
+            try:
+                self.vectorized = vectorizedExpression(expression, columns)
+            except notVectorizable:
+                pass
+        self.blockSize = blockSize if self.vectorized != None else 1
+    
+    def classify(self, line):
+        try:
+            result = self.plan.evaluate(line)
+            if result == True:
+                return PASS
+            elif result == False:
+                return FAIL
+            else:
+                return ERROR
+        except:
+            return ERROR
+    
+    def classifyBlock(self, lines):
+        if self.vectorized == None or len(lines) <= 1:
+            return [self.classify(line) for line in lines]
+        routes = []
+        mask,unconverted = self.vectorized.evaluate(lines)
+        for i,line in enumerate(lines):
+            if unconverted[i]:
+                routes.append(self.classify(line))
+            else:
+                routes.append(PASS if mask[i] else FAIL)
+        return routes
+
+def sortFilters(filters):
+    # .bed filters are the cheapest, so they go first; expression filters keep their order
+    return sorted(filters, key=lambda f:0 if isinstance(f,bedFilter) else 1)
+
+def routeBlock(lines, filters, tally):
+    # Returns PASS, FAIL, or ERROR for each line; a line stops at the first filter that doesn't pass it
+    routes = [PASS]*len(lines)
+    candidates = range(len(lines))
+    for i,f in enumerate(filters):
+        if len(candidates) == 0:
+            break
+        results = f.classifyBlock([lines[j] for j in candidates])
+        remaining = []
+        for j,route in zip(candidates,results):
+            if route == PASS:
+                remaining.append(j)
+            else:
+                routes[j] = route
+                tally[i][route] += 1
+        candidates = remaining
+    return routes
+
+class filterStage(vcfStage):
+    ''' Drops variants that don't pass every filter (see applyFilters); self.tally counts them afterwards '''
+    def __init__(self, filters):
+        self.filters = sortFilters(filters)
+        self.tally = [[f.name,0,0] for f in self.filters]
+        self.blockSize = max([1] + [f.blockSize for f in self.filters])
+    
+    def configuration(self):
+        return [f.settings for f in self.filters]
+    
+    def process(self, records):
+        block = []
+        for line in records:
+            # Earlier stages may have edited the line; re-parse it so that the filters see exactly what
+            # applyFilters would have read from their output file
+            parsed = vcfLine(str(line).strip().split('\t'))
+            if hasattr(line,'inputOffset'):
+                parsed.inputOffset = line.inputOffset   # so that streamVcf can still tell when it's safe to checkpoint
+            block.append(parsed)
+            if len(block) >= self.blockSize:
+                for line,route in zip(block,routeBlock(block, self.filters, self.tally)):
+                    if route == PASS:
+                        yield line
+                block = []
+        if len(block) > 0:
+            for line,route in zip(block,routeBlock(block, self.filters, self.tally)):
+                if route == PASS:
+                    yield line
+    
+    def checkpoint(self):
+        return self.tally
+    
+    def restore(self, state):
+        self.tally = state
+
+def applyFilters(inpath, outpath, failpath, errpath, filters, tickFunction=None, numTicks=100):
+    '''
+    Applies every filter in one pass: a variant passes if it passes all of them, and otherwise goes to the
+    fail (or error) file as soon as one filter rejects it (or can't evaluate it), so later filters never see
+    it. .bed filters are checked first as they're the cheapest; expression filters keep their order. Returns
+    [(filter name, number of variants it failed, number of variants it couldn't evaluate)]
+    '''
+    filters = sortFilters(filters)
+    tally = [[f.name,0,0] for f in filters]
+    blockSize = max([1] + [f.blockSize for f in filters])
+    
+    infile = open(inpath,'r')
+    outfile = open(outpath,'w')
+    failfile = open(failpath,'w') if failpath != None and failpath != "" else None
+    errfile = open(errpath,'w') if errpath != None and errpath != "" else None
+    outfiles = {PASS:outfile,FAIL:failfile,ERROR:errfile}
+    
+    if tickFunction != None:
+        tickInterval = max(1,os.path.getsize(inpath)/numTicks)
+        nextTick = tickInterval
+        bytesRead = 0
+    
+    block = []
+    def flush():
+        routes = routeBlock([line for text,line in block], filters, tally)
+        for (text,line),route in zip(block,routes):
+            if outfiles[route] != None:
+                outfiles[route].write(text)
+        del block[:]
     
     for line in infile:
+        if tickFunction != None:
+            bytesRead += len(line)
+            if bytesRead >= nextTick:
+                nextTick += tickInterval
+                tickFunction()
         if len(line) <= 1:
             continue
         elif line.startswith("#"):
-            outfile.write(line)
-            if failfile != None:
-                failfile.write(line)
-            if errfile != None:
-                errfile.write(line)
+            for f in outfiles.itervalues():
+                if f != None:
+                    f.write(line)
             continue
         else:
-            line = vcfLine(line.strip().split('\t'))
-            expArgs = []
-            for c in columns:
-                if c == "CHROM":
-                    line.extractChrAndPos()
-                    expArgs.append(line.chromosome)
-                elif c == "POS":
-                    line.extractChrAndPos()
-                    expArgs.append(line.position)
-                elif c == "ID":
-                    line.extractChrAndPos()
-                    expArgs.append(line.name)
-                elif c == "QUAL":
-                    line.extractQual()
-                    expArgs.append(line.qual)
-                elif c == "FILTER":
-                    line.extractFilters()
-                    expArgs.append(line.filters)
-                else:
-                    line.extractInfo()
-                    expArgs.append(line.info.get(c,"."))
-            
-            # first see if it fails the .bed regions
-            if bedRegions != None:
-                passedBed = False
-                line.extractChrAndPos()
-                for bed in bedRegions:
-                    if bed.contains(line.chromosome, line.position):
-                        passedBed = True
-                        break
-                if not passedBed:
-                    if failfile != None:
-                        failfile.write(str(line))
-                    continue
-            
-            exp = expression % tuple(expArgs)
-            try:
-                result = eval(exp)
-                if result == True:
-                    outfile.write(str(line))
-                elif result == False:
-                    if failfile != None:
-                        failfile.write(str(line))
-                else:
-                    if errfile != None:
-                        errfile.write(str(line))
-            except:
-                if errfile != None:
-                    errfile.write(str(line))
+            text = line if line.endswith('\n') else line + '\n'
+            block.append((text,vcfLine(line.strip().split('\t'))))
+            if len(block) >= blockSize:
+                flush()
+    if len(block) > 0:
+        flush()
     
     infile.close()
-    outfile.close()
-    if errfile != None:
-        errfile.close()
+    for f in outfiles.itervalues():
+        if f != None:
+            f.close()
+    return [tuple(t) for t in tally]
+
+def readExpression(expressionPath, columnsPath):
+    if expressionPath != "":
+        tempfile = open(expressionPath,'r')
+        expression = tempfile.readline()
+        tempfile.close()
+    else:
+        expression = "True"
+    
+    columns = []
+    if columnsPath != "":
+        tempfile = open(columnsPath, 'r')
+        for line in tempfile:
+            line = line.strip()
+            columns.append(line)
+        tempfile.close()
+    return (expression,columns)
+
+def run(args, tickFunction=None, numTicks=100):
+    filters = []
+    if args.bed != None:
+        for path in args.bed:
+            filters.append(bedFilter(path))
+    if args.expression != "" or args.columns != "":
+        expression,columns = readExpression(args.expression, args.columns)
+        filters.append(expressionFilter(expression, columns, args.block_size))
+    if args.filters != None:
+        for expressionPath,columnsPath in args.filters:
+            expression,columns = readExpression(expressionPath, columnsPath)
+            filters.append(expressionFilter(expression, columns, args.block_size))
+    
+    tally = applyFilters(args.infile, args.outfile, args.failfile, args.errfile, filters, tickFunction, numTicks)
+    for name,failed,errors in tally:
+        print "%s: %i failed, %i errors" % (name,failed,errors)
+    return tally
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Extracts a subset of a .vcf file using a custom expression.\n'+
@@ -112,17 +523,19 @@ if __name__ == '__main__':
     parser.add_argument('--out', type=str, dest="outfile",
                         help='File to write lines that pass --expression')
     parser.add_argument('--fail', type=str, dest="failfile", nargs="?", default="",
-                        help='File to write lines that fail --expression')
+                        help='File to write lines that fail --expression, --filter, or --bed')
     parser.add_argument('--err', type=str, dest="errfile", nargs="?", default="",
                         help='File to write lines on which --expression generates an\nerror or produces a non-boolean result')
     parser.add_argument('--expression', type=str, dest="expression", nargs="?", default="",
                         help="File containing a Python-syntax expression to evaluate, e.g.:\n\n"+
-                        "'%%s' == 'match this string' and %%s %% %%s == 0\n\n"+
+                        "'%%s' == 'match this string' and %%s %%%% %%s == 0\n\n"+
                         "would evaluate to true (and the line would be included)\n"+
                         "if the first column in --columns matches 'match this string'\n"+
                         "exactly and the second column in --columns is an integer\n"+
                         "that can be evenly divided by the third column in --columns.\n"+
-                        "Any valid python eval() code is permitted.")
+                        "Any valid python eval() code is permitted. The expression is compiled\n"+
+                        "once; a bare %%s receives the column's value (numeric strings become\n"+
+                        "numbers), and a %%s inside a string is replaced with the value's text.")
     parser.add_argument('--columns', type=str, dest="columns", nargs="?", default="",
                         help="File containing INFO field IDs or 'CHROM', 'POS', 'ID', 'QUAL' or 'FILTER' to\n"+
                         "use in --expression. CHROM will always be converted to a string beginning\n"+
@@ -132,9 +545,22 @@ if __name__ == '__main__':
                         "be a string (this could change from row to row). QUAL will be converted to a\n"+
                         "float. Any missing values will yield a string of a single period \".\"\n"+
                         "You'll need to consider conversions/error checking in your expressions.")
-    parser.add_argument('--bed', type=str, dest="bed", nargs="?", default="",
+    parser.add_argument('--filter', type=str, dest="filters", nargs=2, action="append",
+                        metavar=("EXPRESSION","COLUMNS"),
+                        help="Additional expression filter, as a pair of files like --expression and\n"+
+                        "--columns; may be used multiple times. All filters are applied in one pass,\n"+
+                        "and a variant must pass every one of them.")
+    parser.add_argument('--bed', type=str, dest="bed", nargs="+",
                         help="In addition to --expression filters, this allows you to only include variants\n"+
-                        "that lie within the regions specified in a .bed file.")
+                        "that lie within the regions specified in one or more .bed files. The merged\n"+
+                        "regions are cached in a .regions file next to each .bed file, so later runs\n"+
+                        "can skip parsing it.")
+    parser.add_argument('--block_size', type=int, dest="block_size", nargs="?", default=10000,
+                        help="If NumPy is installed, simple expressions (columns compared to numbers or\n"+
+                        "strings, combined with and/or/not) are evaluated on this many variants at a\n"+
+                        "time. Other expressions are evaluated one variant at a time, as are variants\n"+
+                        "with values that aren't plain numbers. 0 always evaluates one at a time.\n"+
+                        "Default is 10000.")
     
     args = parser.parse_args()
     run(args)
\ No newline at end of file
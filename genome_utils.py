@@ -1,7 +1,14 @@
 #!/usr/bin/env python
-import os, gzip, math
+import os, gzip, math, heapq, bisect, cPickle, hashlib, shutil, time
+from array import array
 
 MAX_INFO_STRINGS=40
+MAX_TRACKED_CATEGORIES=1024
+QUANTILE_ACCURACY=0.01
+HISTOGRAM_BINS=20
+CHECKPOINT_SECONDS=120
+COPY_BYTES=16*1024*1024
+CHUNK_BYTES=16*1024*1024
 
 chromosomeOrder = ['chr1',
                    'chr2',
@@ -36,6 +43,19 @@ for i,c in enumerate(chromosomeOrder):
 class genomeException(Exception):
     pass
 
+def chromosomeKey(chrom):
+    # sort.py's chromosome order: 1-22,X,Y,M, then everything else alphabetically
+    return (chromosomeRank.get(chrom,len(chromosomeRank)),chrom)
+
+def appendFile(infile, outfile):
+    # Copies the rest of infile onto the end of outfile, COPY_BYTES at a time
+    shutil.copyfileobj(infile, outfile, COPY_BYTES)
+
+def fileSignature(path):
+    # Enough to tell whether a file that a run depends on has been replaced or edited since
+    stats = os.stat(path)
+    return (os.path.abspath(path),stats.st_size,stats.st_mtime)
+
 def parsePopulations(path):
     with open(path,'rb') as infile:
         populations = {}
@@ -65,6 +85,49 @@ class countingDict(dict):
         self[key] = returnValue
         return returnValue
 
+def metaID(line):
+    # returns the (pragma type, ID) pair for ##INFO, ##FILTER, ##FORMAT, and ##contig lines, None for anything else
+    if not line.startswith('##') or not '=<' in line:
+        return None
+    pragma = line[2:line.find('=<')].upper()
+    if pragma not in ('INFO','FILTER','FORMAT','CONTIG'):
+        return None
+    newTag = line[line.find("ID=")+3:]
+    for terminator in (',','>'):
+        if terminator in newTag:
+            newTag = newTag[:newTag.find(terminator)]
+    return (pragma,newTag)
+
+def readHeader(infile):
+    # Only reads up to and including the #CHROM line, so the file is left positioned at the first variant
+    metaLines = []
+    while True:
+        line = infile.readline()
+        if line == '':
+            raise genomeException("Missing a header line in %s" % infile.name)
+        elif len(line) <= 1:
+            continue
+        elif line.startswith('##'):
+            metaLines.append(line)
+        elif line.startswith('#'):
+            return (metaLines,line)
+        else:
+            raise genomeException("Missing a header line or something else is wrong in %s" % infile.name)
+
+def pragmaNumber(line):
+    number = line[line.find("Number=")+7:]
+    for terminator in (',','>'):
+        if terminator in number:
+            number = number[:number.find(terminator)]
+    return number
+
+def iterateChunks(infile, chunkBytes=CHUNK_BYTES):
+    while True:
+        lines = infile.readlines(chunkBytes)
+        if len(lines) == 0:
+            break
+        yield lines
+
 class vcfLine:
     @staticmethod
     def constructLine(chromosome,position,name=".",alleles=["N","N"],info={},qual=0.0,filters=["."],format=["GT"],number_of_genotypes=0):
@@ -294,11 +357,317 @@ class vcfLine:
         
         return outline + '\n'
 
+PLINK_MAGIC = '\x6c\x1b\x01'    # .bed file, variant-major
+PLINK_CODES = (3,2,0)   # number of ALT copies : 2-bit .bed code (1 means missing)
+
+def plinkRecords(line, indices):
+    ''' Packs the genotypes of the samples at indices (column offsets, as in extractGenotypes) into PLINK .bed rows.
+    PLINK is biallelic, so a variant with several ALT alleles becomes one (.bim line, .bed row) pair per ALT allele,
+    where samples carrying one of the other ALT alleles are missing '''
+    line.extractChrAndPos()
+    line.extractAlleles()
+    line.extractGenotypes(indices)
+    results = []
+    for k in xrange(1,len(line.alleles)):
+        packed = bytearray((len(indices) + 3)/4)
+        for j,i in enumerate(indices):
+            allele0,allele1,phased,attrs = line.genotypes[i]  # @UnusedVariable
+            if allele1 == -1:
+                allele1 = allele0   # haploid calls count as homozygous, like PLINK does
+            if allele0 == None or (allele0 != 0 and allele0 != k) or (allele1 != 0 and allele1 != k):
+                code = 1
+            else:
+                code = PLINK_CODES[(allele0 == k) + (allele1 == k)]
+            packed[j >> 2] |= code << ((j & 3)*2)
+        alt = '0' if line.alleles[k] == '.' else line.alleles[k]
+        bim = '\t'.join([line.chromosome,line.name,'0',str(line.position),alt,line.alleles[0]]) + '\n'
+        results.append((bim,str(packed)))
+    return results
+
+class plinkWriter:
+    ''' Writes genotypes in PLINK's binary layout: prefix.bed (2 bits per genotype, a row of bytes per variant, so it can be
+    memory-mapped), prefix.bim (the variants, ALT allele first), and prefix.fam (the samples). With partial=True, only
+    the variant rows are written (no .fam file or .bed header), so they can be appended to a full set with appendPartial '''
+    def __init__(self, prefix, samples, partial=False):
+        if not partial:
+            famFile = open(prefix + '.fam','wb')
+            for s in samples:
+                famFile.write('%s\t%s\t0\t0\t0\t-9\n' % (s,s))
+            famFile.close()
+        self.bedFile = open(prefix + '.bed','wb')
+        if not partial:
+            self.bedFile.write(PLINK_MAGIC)
+        self.bimFile = open(prefix + '.bim','wb')
+    
+    def write(self, records):
+        ''' records should come from plinkRecords '''
+        for bim,bed in records:
+            self.bimFile.write(bim)
+            self.bedFile.write(bed)
+    
+    def appendPartial(self, prefix):
+        for extension,outfile in (('.bim',self.bimFile),('.bed',self.bedFile)):
+            with open(prefix + extension,'rb') as infile:
+                appendFile(infile, outfile)
+    
+    def close(self):
+        self.bedFile.close()
+        self.bimFile.close()
+
+class hyperLogLog:
+    '''
+    Estimates how many distinct values have been added in a fixed 2^precision bytes (the standard error
+    is about 1.04/sqrt(2^precision), i.e. ~1.6% for the default)
+    '''
+    MASK64 = (1 << 64) - 1
+    
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+    
+    @staticmethod
+    def hash64(value):
+        # Python's own string hash doesn't spread its bits very well, so scramble it (splitmix64's finalizer)
+        x = hash(value) & hyperLogLog.MASK64
+        x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & hyperLogLog.MASK64
+        x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & hyperLogLog.MASK64
+        return x ^ (x >> 31)
+    
+    def add(self, value):
+        x = hyperLogLog.hash64(value)
+        index = x >> (64 - self.precision)
+        rest = x & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+    
+    def merge(self, other):
+        for i,r in enumerate(other.registers):
+            if r > self.registers[i]:
+                self.registers[i] = r
+    
+    def estimate(self):
+        m = float(len(self.registers))
+        alpha = 0.7213/(1.0 + 1.079/m)
+        estimate = alpha*m*m/sum(2.0**-r for r in self.registers)
+        zeros = self.registers.count('\x00')
+        if estimate <= 2.5*m and zeros > 0:
+            estimate = m*math.log(m/zeros)  # linear counting is better for small counts
+        return estimate
+
+class categoryCounter:
+    '''
+    Counts how often each string shows up in a fixed amount of memory: up to capacity distinct values are
+    counted exactly; after that, the space-saving algorithm replaces the least frequent value with each new
+    one (so the most frequent values, and their approximate counts, are always kept), and the number of
+    distinct values is estimated with a hyperLogLog. len() is the (estimated) number of distinct values.
+    '''
+    def __init__(self, capacity=MAX_TRACKED_CATEGORIES):
+        self.capacity = capacity
+        self.counts = {}
+        self.distinct = None    # only needed once we can't count exactly anymore
+    
+    def add(self, value, count=1):
+        if self.distinct != None:
+            self.distinct.add(value)
+        if self.counts.has_key(value):
+            self.counts[value] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[value] = count
+        else:
+            if self.distinct == None:
+                # everything we've seen so far is in counts, so this is the same as having added every value
+                self.distinct = hyperLogLog()
+                for v in self.counts.iterkeys():
+                    self.distinct.add(v)
+                self.distinct.add(value)
+                self.heap = [(c,v) for v,c in self.counts.iteritems()]
+                heapq.heapify(self.heap)
+            # The heap has one (count,value) pair per tracked value, but counts only go up, so a pair can be
+            # stale; fix those as they reach the top until the smallest one is current
+            while self.heap[0][0] != self.counts[self.heap[0][1]]:
+                v = self.heap[0][1]
+                heapq.heapreplace(self.heap,(self.counts[v],v))
+            smallest,v = self.heap[0]
+            del self.counts[v]
+            self.counts[value] = smallest + count
+            heapq.heapreplace(self.heap,(smallest + count,value))
+    
+    def merge(self, other):
+        ''' Adds another counter's values (e.g. from a different part of the same file); exact as long as neither
+        counter has run out of room '''
+        for v,c in other.counts.iteritems():
+            self.add(v,c)
+        if other.distinct != None:
+            if self.distinct == None:
+                self.distinct = hyperLogLog()
+                for v in self.counts.iterkeys():
+                    self.distinct.add(v)
+                self.heap = [(c,v) for v,c in self.counts.iteritems()]
+                heapq.heapify(self.heap)
+            self.distinct.merge(other.distinct)
+    
+    def isExact(self):
+        return self.distinct == None
+    
+    def __len__(self):
+        if self.distinct == None:
+            return len(self.counts)
+        return max(len(self.counts),int(round(self.distinct.estimate())))
+    
+    def __contains__(self, value):
+        return value in self.counts
+    
+    def mostFrequent(self):
+        ''' The tracked values, most frequent first (ties are alphabetical) '''
+        return sorted(self.counts.iterkeys(),key=lambda v:(-self.counts[v],v))
+
+class quantileSketch:
+    '''
+    Summarizes the distribution of a stream of numbers in a small, fixed set of logarithmic buckets (a
+    DDSketch): any quantile comes back within a relative error of accuracy (1% by default) of a true value
+    at that rank, and as every sketch uses the same buckets, sketches of different parts of a file can be
+    merged into exactly the sketch of the whole file. The number of buckets only depends on the range of
+    magnitudes (e.g. ~2000 to cover 1e-9 to 1e9 at 1%), never on the number of values.
+    '''
+    MIN_MAGNITUDE = 1e-9    # anything closer to zero than this counts as zero
+    PENDING_VALUES = 1024   # distinct values that are counted as-is before they're put in buckets
+    
+    def __init__(self, accuracy=QUANTILE_ACCURACY):
+        self.accuracy = accuracy
+        self.gamma = (1.0 + accuracy)/(1.0 - accuracy)
+        self.logGamma = math.log(self.gamma)
+        self.positive = {}  # bucket index : count
+        self.negative = {}  # bucket index (of the magnitude) : count
+        self.zeros = 0
+        self.count = 0
+        self.pending = {}   # value : count, not in a bucket yet
+    
+    def add(self, v, count=1):
+        # Most fields repeat the same few values (e.g. DP), so finding a value's bucket (a math.log) is put off
+        # until PENDING_VALUES distinct values have piled up, and then done once per distinct value
+        self.count += count
+        self.pending[v] = self.pending.get(v,0) + count
+        if len(self.pending) >= quantileSketch.PENDING_VALUES:
+            self.flush()
+    
+    def flush(self):
+        for v,count in self.pending.iteritems():
+            if v > quantileSketch.MIN_MAGNITUDE:
+                i = int(math.ceil(math.log(v)/self.logGamma))
+                self.positive[i] = self.positive.get(i,0) + count
+            elif v < -quantileSketch.MIN_MAGNITUDE:
+                i = int(math.ceil(math.log(-v)/self.logGamma))
+                self.negative[i] = self.negative.get(i,0) + count
+            else:
+                self.zeros += count
+        self.pending = {}
+    
+    def merge(self, other):
+        if other.accuracy != self.accuracy:
+            raise genomeException("Can't merge quantile sketches with different accuracies")
+        self.flush()
+        other.flush()
+        for i,c in other.positive.iteritems():
+            self.positive[i] = self.positive.get(i,0) + c
+        for i,c in other.negative.iteritems():
+            self.negative[i] = self.negative.get(i,0) + c
+        self.zeros += other.zeros
+        self.count += other.count
+    
+    def bucketValue(self, i):
+        # the value in the middle (relatively speaking) of bucket i, i.e. within accuracy of everything in it
+        return 2.0*self.gamma**i/(self.gamma + 1.0)
+    
+    def buckets(self):
+        ''' (representative value, count) for every non-empty bucket, in ascending order '''
+        self.flush()
+        results = [(-self.bucketValue(i),self.negative[i]) for i in sorted(self.negative.iterkeys(),reverse=True)]
+        if self.zeros > 0:
+            results.append((0.0,self.zeros))
+        results.extend([(self.bucketValue(i),self.positive[i]) for i in sorted(self.positive.iterkeys())])
+        return results
+    
+    def quantile(self, q):
+        ''' The value at quantile q (0 to 1), or None if nothing has been added '''
+        if self.count == 0:
+            return None
+        rank = q*(self.count - 1)
+        seen = 0
+        for value,c in self.buckets():
+            seen += c
+            if seen > rank:
+                return value
+        return value
+
+class binnedHistogram:
+    '''
+    Exact counts of a stream of numbers in at most maxBins equal-width bins, filled in as the values arrive
+    without knowing their range up front. Bins are [k*width,(k+1)*width) for a power-of-two width, and
+    whenever the values span more than maxBins bins, the width doubles and neighbouring bins are combined.
+    As every width is a power of two, the bins of any two histograms line up, so histograms of different
+    parts of a file merge into exactly the histogram of the whole file.
+    '''
+    START_BITS = 30     # the first value's bins start out this many powers of two narrower than the value
+    
+    def __init__(self, maxBins=HISTOGRAM_BINS):
+        self.maxBins = maxBins
+        self.exponent = None    # bins are 2**exponent wide
+        self.counts = {}    # bin index : count
+        self.low = None     # lowest and highest bin indices seen
+        self.high = None
+    
+    def add(self, v, count=1):
+        if self.exponent == None:
+            self.exponent = math.frexp(v)[1] - binnedHistogram.START_BITS
+        b = int(math.floor(math.ldexp(v,-self.exponent)))
+        if b in self.counts:
+            self.counts[b] += count     # the usual case; the range can't have changed
+        else:
+            self.addBin(b,count)
+    
+    def addBin(self, b, count):
+        self.counts[b] = self.counts.get(b,0) + count
+        if self.low == None or b < self.low:
+            self.low = b
+        if self.high == None or b > self.high:
+            self.high = b
+        while self.high - self.low >= self.maxBins:
+            self.widen()
+    
+    def widen(self):
+        counts = {}
+        for b,c in self.counts.iteritems():
+            counts[b >> 1] = counts.get(b >> 1,0) + c
+        self.counts = counts
+        self.exponent += 1
+        self.low >>= 1
+        self.high >>= 1
+    
+    def merge(self, other):
+        if other.exponent == None:
+            return
+        if self.exponent == None:
+            self.exponent = other.exponent
+        while self.exponent < other.exponent:
+            self.widen()
+        shift = self.exponent - other.exponent
+        for b,c in other.counts.iteritems():
+            self.addBin(b >> shift,c)
+    
+    def bins(self):
+        ''' (low edge, high edge, count) for every bin from the lowest value seen to the highest '''
+        if self.exponent == None:
+            return []
+        return [(math.ldexp(b,self.exponent),math.ldexp(b+1,self.exponent),self.counts.get(b,0)) for b in xrange(self.low,self.high+1)]
+
 class infoDetails:
     def __init__(self, id, maxCategories, countSeparate):
         self.ranges = []    # nth column : (low,high) or None, indicating that the column exists, but there are no numerical values
-        self.categories = []    # nth column : set(possible keys) or None, indicating that the column exists, but there are no strings
-                
+        self.distributions = []     # nth column : quantileSketch of the numerical values or None (filled in alongside ranges)
+        self.histograms = []    # nth column : binnedHistogram of the numerical values or None (likewise)
+        self.categories = []    # nth column : categoryCounter of possible keys or None, indicating that the column exists, but there are no strings
+        
         self.name = id
         self.maxCategories = maxCategories
         self.countSeparate = countSeparate
@@ -329,11 +698,17 @@ class infoDetails:
             i = 0
         while i >= len(self.ranges):
             self.ranges.append(None)
+            self.distributions.append(None)
+            self.histograms.append(None)
         
         if self.ranges[i] == None:
             self.ranges[i] = (v,v)
+            self.distributions[i] = quantileSketch()
+            self.histograms[i] = binnedHistogram()
         else:
             self.ranges[i] = (min(v,self.ranges[i][0]),max(v,self.ranges[i][1]))
+        self.distributions[i].add(v)
+        self.histograms[i].add(v)
     
     def addCategory(self, v, i):
         if self.maxedOut:
@@ -345,12 +720,63 @@ class infoDetails:
             self.categories.append(None)
         
         if self.categories[i] == None:
-            self.categories[i] = set()
+            # with a limit, make sure we can count exactly up to it; otherwise memory is capped at MAX_TRACKED_CATEGORIES values
+            self.categories[i] = categoryCounter(max(MAX_TRACKED_CATEGORIES,self.maxCategories+1))
         self.categories[i].add(v)
         
         if self.maxCategories > 0 and len(self.categories[i]) > self.maxCategories:
             self.maxedOut = True
     
+    def quantile(self, q, i=0):
+        ''' Approximate value at quantile q (0 to 1) of column i's numerical values (see quantileSketch) '''
+        if i >= len(self.distributions) or self.distributions[i] == None:
+            return None
+        return self.distributions[i].quantile(q)
+    
+    def histogram(self, i=0):
+        ''' (low edge, high edge, count) for each of column i's equal-width bins (see binnedHistogram) '''
+        if i >= len(self.histograms) or self.histograms[i] == None:
+            return None
+        return self.histograms[i].bins()
+    
+    def describeDistribution(self, i=0):
+        ''' A short summary of column i's numerical values for display, or "" if it doesn't have any '''
+        if i >= len(self.distributions) or self.distributions[i] == None:
+            return ""
+        return "5%%: %g, median: %g, 95%%: %g" % tuple([self.quantile(q,i) for q in (0.05,0.5,0.95)])
+    
+    def merge(self, other):
+        ''' Adds what another infoDetails for the same field saw (e.g. in a different shard of the same file) '''
+        self.numColumns = max(self.numColumns,other.numColumns)
+        self.maxedOut = self.maxedOut or other.maxedOut
+        for i,r in enumerate(other.ranges):
+            if r == None:
+                continue
+            while i >= len(self.ranges):
+                self.ranges.append(None)
+                self.distributions.append(None)
+                self.histograms.append(None)
+            if self.ranges[i] == None:
+                self.ranges[i] = r
+                self.distributions[i] = quantileSketch(other.distributions[i].accuracy)
+                self.histograms[i] = binnedHistogram(other.histograms[i].maxBins)
+            else:
+                self.ranges[i] = (min(r[0],self.ranges[i][0]),max(r[1],self.ranges[i][1]))
+            self.distributions[i].merge(other.distributions[i])
+            self.histograms[i].merge(other.histograms[i])
+        if self.maxedOut:
+            return
+        for i,c in enumerate(other.categories):
+            if c == None:
+                continue
+            while i >= len(self.categories):
+                self.categories.append(None)
+            if self.categories[i] == None:
+                self.categories[i] = categoryCounter(c.capacity)
+            self.categories[i].merge(c)
+            if self.maxCategories > 0 and len(self.categories[i]) > self.maxCategories:
+                self.maxedOut = True
+    
     def hasCategory(self, value, i=0):
         return value in self.categories[i]
     
@@ -385,12 +811,61 @@ class infoDetails:
                 pragmaString += "\t(%f,%f)" % self.ranges[i]
             
             if self.categories[i] != None:
-                # TODO: sort categories by their frequency?
-                pragmaString += "\t" + "\t".join(sorted(self.categories[i]))
+                # most frequent first; past MAX_TRACKED_CATEGORIES distinct values, only the most frequent ones are listed
+                pragmaString += "\t" + "\t".join(self.categories[i].mostFrequent())
             
             results.append(pragmaString)
         return results
 
+class profileCache:
+    '''
+    Keeps the results of scanning a whole .vcf file (e.g. the infoDetails from cleanVCF.extractInfoFields)
+    in a sidecar next to it, so that opening a file we've already seen doesn't need another full scan. A
+    sidecar can hold several profiles, each stored under a key describing how it was built (e.g. which
+    max_strings setting was used); they're all discarded as soon as the file's size or modification time
+    changes.
+    '''
+    CACHE_EXTENSION = '.profile'
+    CACHE_VERSION = 4
+    
+    @staticmethod
+    def signature(path):
+        stats = os.stat(path)
+        return (profileCache.CACHE_VERSION,stats.st_size,stats.st_mtime)
+    
+    @staticmethod
+    def infoKey(max_strings):
+        ''' The key for a plain count of every ##INFO field's values (see cleanVCF.extractInfoFields) '''
+        return ('info',max_strings)
+    
+    @staticmethod
+    def loadAll(path):
+        cachePath = path + profileCache.CACHE_EXTENSION
+        if os.path.exists(cachePath):
+            try:
+                with open(cachePath,'rb') as cachefile:
+                    cachedSignature,profiles = cPickle.load(cachefile)
+                if cachedSignature == profileCache.signature(path):
+                    return profiles
+            except Exception:
+                pass    # a stale or broken cache is no worse than no cache
+        return {}
+    
+    @staticmethod
+    def load(path, key):
+        ''' Returns the profile stored under key, or None if there isn't an up-to-date one '''
+        return profileCache.loadAll(path).get(key,None)
+    
+    @staticmethod
+    def save(path, key, profile):
+        profiles = profileCache.loadAll(path)
+        profiles[key] = profile
+        try:
+            with open(path + profileCache.CACHE_EXTENSION,'wb') as cachefile:
+                cPickle.dump((profileCache.signature(path),profiles),cachefile,cPickle.HIGHEST_PROTOCOL)
+        except (IOError,OSError):
+            pass    # e.g. a read-only directory; we'll just scan again next time
+
 class kgpInterface:
     BYTES_TO_ITERATE=8*4096
     def __init__(self, dataPath, popPath):
@@ -453,29 +928,54 @@ class kgpInterface:
                 else:
                     yield vcfLine(line.strip().split('\t'))
     
+    def iterateChromosome(self, chrom, indices=None):
+        ''' Every variant in one chromosome's file. If indices is supplied, only those individuals' genotype columns
+        are kept (in that order, so genotype i of each line is individual indices[i]), and the rest of each line
+        isn't even split '''
+        infile = self.files[chrom]
+        infile.seek(0)
+        keep = None
+        maxsplit = -1
+        if indices != None:
+            keep = [9 + i for i in indices]
+            maxsplit = max(keep) + 1 if len(keep) > 0 else 9
+        passedHeader = False
+        for line in infile:
+            if not passedHeader:
+                passedHeader = line.startswith('#CHROM')
+                continue
+            columns = line.strip().split('\t',maxsplit)
+            if keep != None:
+                columns = columns[:9] + [columns[k] for k in keep]
+            yield vcfLine(columns)
+    
     def iterateVcf(self, vcfPath, tickFunction=None, numTicks=100):
         ''' Useful for iterating through a sorted .vcf file and finding matches in KGP; the vcf file should be
         base pair position-ordered (the chromosome order is irrelevant) '''
-        infile = open(vcfPath,'rb')
-        tickInterval = os.path.getsize(vcfPath)/numTicks
+        return self.iterateRecords(iterateVcfRecords(vcfPath, tickFunction, numTicks))
+    
+    def iterateRecords(self, records, cursor=None):
+        ''' Same as iterateVcf, but for vcfLine objects from somewhere else (e.g. an earlier streamVcf stage). To pick
+        up where an earlier iteration left off, pass what cursor() returned at that point '''
         # We take advantage of the fact that the KGP .vcf files are bp-ordered
         self.startAtZero()
-        return self._iterateVcf(infile, tickFunction, tickInterval)            
+        self.offsets = {}
+        if cursor != None:
+            for c,offset in cursor.iteritems():
+                self.files[c].seek(offset)
+                self.offsets[c] = offset
+        return self._iterateRecords(records)
     
-    def _iterateVcf(self, infile, tickFunction, tickInterval):
-        nextTick = 0
+    def cursor(self):
+        ''' Where iterateRecords is in each KGP file (the start of the last line it read) '''
+        return dict(self.offsets)
+    
+    def _iterateRecords(self, records):
         kgpLines = {}
         for f in self.files.iterkeys():
             kgpLines[f] = None
-                
-        for vline in infile:
-            vline = vline.strip()
-            if len(vline) <= 1 or vline.startswith("#"):
-                continue
-            if tickFunction != None and infile.tell() >= nextTick:
-                nextTick += tickInterval
-                tickFunction()
-            vline = vcfLine(vline.split('\t'))
+        
+        for vline in records:
             vline.extractChrAndPos()
             
             # If we're missing data for a particular chromosome (e.g. chrMT, etc), just harmlessly return that that line is missing
@@ -487,6 +987,7 @@ class kgpInterface:
             # until we match or pass the .vcf line
             eof = False
             while kgpLines[vline.chromosome] == None or kgpLines[vline.chromosome].position < vline.position:
+                offset = self.files[vline.chromosome].tell()
                 text = self.files[vline.chromosome].readline()
                 if text == '':
                     eof = True
@@ -498,6 +999,7 @@ class kgpInterface:
                     kgpLines[vline.chromosome] = vcfLine(text.split('\t'))
                     kgpLines[vline.chromosome].extractChrAndPos()
                     assert kgpLines[vline.chromosome].chromosome == vline.chromosome
+                    self.offsets[vline.chromosome] = offset
             if eof:
                 yield (vline,None)
                 continue
@@ -507,9 +1009,241 @@ class kgpInterface:
             else:
                 yield (vline,None)
                 continue
-        # way out here, the .vcf file is depleted; close the file and we're done
-        infile.close()
-        raise StopIteration
+
+def iterateVcfRecords(path, tickFunction=None, numTicks=100, start=0):
+    ''' Yields a vcfLine for every variant in a .vcf file (starting at byte start), calling tickFunction numTicks
+    times along the way. Each line's inputOffset is the byte just past it '''
+    tickInterval = os.path.getsize(path)/numTicks
+    nextTick = start
+    offset = start
+    infile = open(path,'rb')
+    infile.seek(start)
+    for line in infile:
+        offset += len(line)
+        line = line.strip()
+        if len(line) <= 1 or line.startswith("#"):
+            continue
+        if tickFunction != None and offset >= nextTick:
+            nextTick += tickInterval
+            tickFunction()
+        line = vcfLine(line.split('\t'))
+        line.inputOffset = offset
+        yield line
+    infile.close()
+
+class vcfStage:
+    '''
+    One step of a streamVcf pipeline. header() gets a chance to edit the header before any variants are
+    read (e.g. to add ##INFO lines), and process() turns a stream of vcfLine objects into another one (it
+    can modify, drop, or add variants). This base class passes everything through unchanged.
+    
+    Stages that need to remember something to resume from a streamVcf checkpoint should return it from
+    checkpoint() and pick it back up in restore() (which is called after header(), before process()).
+    Anything that can be rebuilt by reading ahead from the resumed position (e.g. a sorted .bed file)
+    doesn't need to be saved. configuration() should describe every setting that changes a stage's output
+    (thresholds, column names, the fileSignature of any file it reads), so that a checkpoint is never
+    resumed with different ones.
+    '''
+    def header(self, metaLines, headerline):
+        return (metaLines,headerline)
+    
+    def process(self, records):
+        return records
+    
+    def configuration(self):
+        return None
+    
+    def checkpoint(self):
+        return None
+    
+    def restore(self, state):
+        pass
+
+def streamVcf(inpath, outpath, stages, tickFunction=None, numTicks=100, checkpointPath=None, resume=False, checkpointSeconds=CHECKPOINT_SECONDS):
+    '''
+    Runs a sorted .vcf file through a chain of vcfStages in a single pass: all the header edits happen up
+    front, then each variant flows through every stage before it's written, so no intermediate files are
+    needed.
+    
+    If checkpointPath is given, every checkpointSeconds the output is flushed and the input and output
+    offsets, the last position, and each stage's checkpoint() are saved there; with resume=True, a run
+    starts from that checkpoint instead (truncating whatever was written after it). The checkpoint file
+    is deleted once the run finishes.
+    '''
+    metaLines = []
+    headerline = None
+    infile = open(inpath,'rb')
+    for line in infile:
+        if len(line) <= 1:
+            continue
+        elif line.startswith("##"):
+            metaLines.append(line)
+        elif line.startswith("#"):
+            headerline = line
+            break
+        else:
+            raise genomeException("Missing a header line or something else is wrong...")
+    infile.close()
+    if headerline == None:
+        raise genomeException("Missing a header line or something else is wrong...")
+    
+    for s in stages:
+        metaLines,headerline = s.header(metaLines,headerline)
+    
+    inputStats = os.stat(inpath)
+    # The stages' settings and the header they produce have to match too, or the resumed output would be
+    # joined onto output from a different configuration
+    settings = hashlib.sha1(repr(([s.configuration() for s in stages],metaLines,headerline))).hexdigest()
+    signature = (inputStats.st_size,inputStats.st_mtime,len(stages),settings)
+    checkpoint = None
+    if resume and checkpointPath != None and os.path.exists(checkpointPath):
+        with open(checkpointPath,'rb') as checkfile:
+            checkpoint = cPickle.load(checkfile)
+        if checkpoint['signature'] != signature:
+            raise genomeException("%s is from a different input file or set of stage settings; delete it to start over" % checkpointPath)
+        if not os.path.exists(outpath) or os.path.getsize(outpath) < checkpoint['outputOffset']:
+            raise genomeException("%s is missing or shorter than when %s was saved; delete the checkpoint to start over" % (outpath,checkpointPath))
+        for s,state in zip(stages,checkpoint['stages']):
+            s.restore(state)
+    
+    lastRead = [checkpoint['inputOffset'] if checkpoint != None else 0]
+    def reading(records):
+        for line in records:
+            lastRead[0] = line.inputOffset
+            yield line
+    records = reading(iterateVcfRecords(inpath, tickFunction, numTicks, lastRead[0]))
+    for s in stages:
+        records = s.process(records)
+    
+    if checkpoint != None:
+        outfile = open(outpath,'r+b')
+        outfile.truncate(checkpoint['outputOffset'])
+        outfile.seek(checkpoint['outputOffset'])
+    else:
+        outfile = open(outpath,'wb')
+        outfile.writelines(metaLines)
+        outfile.write(headerline)
+    lastCheckpoint = time.time()
+    for line in records:
+        outfile.write(str(line))
+        # Only save a checkpoint when nothing is held up inside a stage (e.g. a filterVCF block), so that
+        # everything up to the input offset really has been written
+        if checkpointPath != None and lastRead[0] == getattr(line,'inputOffset',None) and time.time() - lastCheckpoint >= checkpointSeconds:
+            outfile.flush()
+            os.fsync(outfile.fileno())
+            line.extractChrAndPos()
+            state = {'signature':signature,
+                     'inputOffset':line.inputOffset,
+                     'outputOffset':outfile.tell(),
+                     'chromosome':line.chromosome,
+                     'position':line.position,
+                     'stages':[s.checkpoint() for s in stages]}
+            with open(checkpointPath + '.partial','wb') as checkfile:
+                cPickle.dump(state,checkfile,cPickle.HIGHEST_PROTOCOL)
+            os.rename(checkpointPath + '.partial',checkpointPath)
+            lastCheckpoint = time.time()
+    outfile.close()
+    if checkpointPath != None and os.path.exists(checkpointPath):
+        os.remove(checkpointPath)
+
+class teeStage(vcfStage):
+    ''' Also writes everything that reaches it to path, e.g. to keep an intermediate result without a separate pass '''
+    def __init__(self, path):
+        self.path = path
+        self.resumeOffset = None
+    
+    def configuration(self):
+        return os.path.abspath(self.path)
+    
+    def header(self, metaLines, headerline):
+        self.headerLines = list(metaLines) + [headerline]
+        return (metaLines,headerline)
+    
+    def process(self, records):
+        if self.resumeOffset != None:
+            self.outfile = open(self.path,'r+b')
+            self.outfile.truncate(self.resumeOffset)
+            self.outfile.seek(self.resumeOffset)
+        else:
+            self.outfile = open(self.path,'wb')
+            self.outfile.writelines(self.headerLines)
+        for line in records:
+            self.outfile.write(str(line))
+            yield line
+        self.outfile.close()
+    
+    def checkpoint(self):
+        self.outfile.flush()
+        os.fsync(self.outfile.fileno())
+        return self.outfile.tell()
+    
+    def restore(self, state):
+        self.resumeOffset = state
+
+class stageCache:
+    '''
+    A persistent directory of stage outputs, keyed by a hash of a stage's input and its arguments, so that
+    a run can skip any stage whose result we already have (e.g. after a crash, or when only a later stage's
+    arguments changed). When the directory gets bigger than maxBytes, the least recently used outputs are
+    thrown away.
+    '''
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+    
+    @staticmethod
+    def fileKey(path):
+        ''' Hashes a file's contents (so the same data under a different name or time stamp still matches) '''
+        digest = hashlib.sha1()
+        with open(path,'rb') as infile:
+            while True:
+                chunk = infile.read(1 << 20)
+                if not chunk:
+                    break
+                digest.update(chunk)
+        return digest.hexdigest()
+    
+    @staticmethod
+    def key(*parts):
+        ''' Combines input keys and arguments into a new key; parts should have a stable repr() '''
+        return hashlib.sha1(repr(parts)).hexdigest()
+    
+    def path(self, key):
+        return os.path.join(self.directory, key)
+    
+    def fetch(self, key, outpath):
+        ''' Copies a cached output to outpath, returning False if there isn't one '''
+        cachePath = self.path(key)
+        if not os.path.exists(cachePath):
+            return False
+        os.utime(cachePath, None)   # mark it as recently used
+        shutil.copyfile(cachePath, outpath)
+        return True
+    
+    def store(self, key, path):
+        ''' Copies a stage's output into the cache, then makes room if needed '''
+        cachePath = self.path(key)
+        tempPath = cachePath + '.partial'
+        shutil.copyfile(path, tempPath)
+        os.rename(tempPath, cachePath)  # a crash mid-copy never leaves a truncated entry behind
+        self.evict()
+    
+    def evict(self):
+        entries = []
+        totalBytes = 0
+        for name in os.listdir(self.directory):
+            if name.endswith('.partial'):
+                continue
+            stats = os.stat(os.path.join(self.directory, name))
+            entries.append((stats.st_mtime,stats.st_size,name))
+            totalBytes += stats.st_size
+        entries.sort()
+        while totalBytes > self.maxBytes and len(entries) > 0:
+            mtime,size,name = entries.pop(0)
+            os.remove(os.path.join(self.directory, name))
+            totalBytes -= size
 
 class bedLine:
     def __init__(self, columns):
@@ -542,3 +1276,223 @@ class bedLine:
             outline += "\t" + "\t".join(self.columns[5:])
         
         return outline + "\n"
+
+
+class bedIndex:
+    '''
+    Per-chromosome interval index for bedLine features, so that looking up the features that overlap a
+    position costs O(log(features) + hits) instead of a scan through every feature. Each chromosome's
+    features are sorted by start and laid out as an implicit, augmented binary search tree (every node
+    also stores the highest stop in its subtree - see Heng Li's cgranges for the idea). Call index()
+    after the last add() and before querying; results come back in the order the features were added.
+    '''
+    SCAN_LEVEL = 3  # subtrees this small are just scanned linearly
+    
+    def __init__(self, features=[]):
+        self.features = {}  # chromosome : [(start, stop, order, feature)], sorted by start once indexed
+        self.maxStops = {}  # chromosome : [highest stop in the subtree rooted at each position]
+        self.maxLevels = {}
+        self.count = 0
+        for f in features:
+            self.add(f)
+        self.index()
+    
+    def add(self, feature):
+        if not self.features.has_key(feature.chromosome):
+            self.features[feature.chromosome] = []
+        self.features[feature.chromosome].append((feature.start,feature.stop,self.count,feature))
+        self.count += 1
+    
+    def index(self):
+        for c,features in self.features.iteritems():
+            features.sort(key=lambda x:(x[0],x[2]))
+            n = len(features)
+            maxStops = [f[1] for f in features]
+            self.maxStops[c] = maxStops
+            if n == 0:
+                self.maxLevels[c] = -1
+                continue
+            lastIndex = 2*((n-1)/2)
+            last = maxStops[lastIndex]
+            k = 1
+            while 1 << k <= n:
+                x = 1 << (k-1)
+                for i in xrange((x << 1) - 1, n, x << 2):
+                    right = maxStops[i+x] if i+x < n else last
+                    maxStops[i] = max(maxStops[i],maxStops[i-x],right)
+                # move lastIndex up to its parent
+                if (lastIndex >> k) & 1 == 1:
+                    lastIndex -= x
+                else:
+                    lastIndex += x
+                if lastIndex < n and maxStops[lastIndex] > last:
+                    last = maxStops[lastIndex]
+                k += 1
+            self.maxLevels[c] = k-1
+    
+    def overlapping(self, chromosome, start, stop=None):
+        ''' Returns every feature that overlaps [start,stop) on chromosome (1-based, like bedLine); if stop
+        is omitted, this returns the features that contain the single position start '''
+        if stop == None:
+            stop = start+1
+        features = self.features.get(chromosome,None)
+        if features == None or len(features) == 0:
+            return []
+        maxStops = self.maxStops[chromosome]
+        n = len(features)
+        k = self.maxLevels[chromosome]
+        hits = []
+        stack = [(k,(1 << k) - 1,False)]
+        while len(stack) > 0:
+            k,x,leftDone = stack.pop()
+            if k <= bedIndex.SCAN_LEVEL:
+                i = x >> k << k
+                end = min(i + (1 << (k+1)) - 1, n)
+                while i < end and features[i][0] < stop:
+                    if start < features[i][1]:
+                        hits.append(features[i])
+                    i += 1
+            elif not leftDone:
+                y = x - (1 << (k-1))
+                stack.append((k,x,True))
+                if y >= n or maxStops[y] > start:
+                    stack.append((k-1,y,False))
+            elif x < n and features[x][0] < stop:
+                if start < features[x][1]:
+                    hits.append(features[x])
+                stack.append((k-1,x + (1 << (k-1)),False))
+        hits.sort(key=lambda x:x[2])
+        return [h[3] for h in hits]
+    
+    def overlappingVariant(self, line):
+        ''' Returns every feature that overlaps the REF allele of a vcfLine '''
+        line.extractChrAndPos()
+        line.extractAlleles()
+        return self.overlapping(line.chromosome,line.position,line.position+max(1,len(line.alleles[0])))
+
+class bedSweep:
+    '''
+    Sweep-line alternative to bedIndex for when both the .bed features and the queries are sorted the
+    same way (see sort.py). Features are pulled from the iterable as the queries pass them, and only the
+    ones that could still overlap a later query are kept (in a heap ordered by stop), so memory depends
+    on how deeply the features overlap rather than on the size of the .bed file. Query starts must never
+    decrease; as with bedIndex, results come back in the order the features were read.
+    '''
+    def __init__(self, features):
+        self.features = iter(features)
+        self.active = []    # heap of (stop, order, feature)
+        self.chromosome = None
+        self.count = 0
+        self.lastStart = None
+        self.nextFeature = None
+        self.advance()
+    
+    def advance(self):
+        previous = self.nextFeature
+        try:
+            self.nextFeature = self.features.next()
+        except StopIteration:
+            self.nextFeature = None
+            return
+        if previous != None and (chromosomeKey(self.nextFeature.chromosome),self.nextFeature.start) < (chromosomeKey(previous.chromosome),previous.start):
+            raise genomeException(".bed file isn't sorted (run sort.py on it first)")
+    
+    def overlapping(self, chromosome, start, stop=None):
+        ''' Same as bedIndex.overlapping, but calls must be made in sorted order '''
+        if stop == None:
+            stop = start+1
+        if chromosome != self.chromosome:
+            if self.chromosome != None and chromosomeKey(chromosome) < chromosomeKey(self.chromosome):
+                raise genomeException("Variants aren't sorted (run sort.py on the .vcf file first)")
+            self.chromosome = chromosome
+            self.active = []
+            self.lastStart = None
+            while self.nextFeature != None and chromosomeKey(self.nextFeature.chromosome) < chromosomeKey(chromosome):
+                self.advance()
+        elif self.lastStart != None and start < self.lastStart:
+            raise genomeException("Variants aren't sorted (run sort.py on the .vcf file first)")
+        self.lastStart = start
+        
+        while self.nextFeature != None and self.nextFeature.chromosome == chromosome and self.nextFeature.start < stop:
+            heapq.heappush(self.active,(self.nextFeature.stop,self.count,self.nextFeature))
+            self.count += 1
+            self.advance()
+        while len(self.active) > 0 and self.active[0][0] <= start:
+            heapq.heappop(self.active)
+        
+        hits = [a for a in self.active if a[2].start < stop]
+        hits.sort(key=lambda x:x[1])
+        return [h[2] for h in hits]
+    
+    def overlappingVariant(self, line):
+        line.extractChrAndPos()
+        line.extractAlleles()
+        return self.overlapping(line.chromosome,line.position,line.position+max(1,len(line.alleles[0])))
+
+class regionSet:
+    '''
+    Answers "is this position inside any of these .bed regions?" with a single bisect: overlapping regions
+    are merged into sorted, non-overlapping start/stop arrays for each chromosome (1-based, stop exclusive,
+    like bedLine). As parsing a big target .bed file is the expensive part, the compiled arrays are cached
+    next to the .bed file and reused as long as its size and modification time haven't changed.
+    '''
+    CACHE_EXTENSION = '.regions'
+    CACHE_VERSION = 1
+    
+    def __init__(self, regions={}):
+        self.starts = {}    # chromosome : array of starts
+        self.stops = {}     # chromosome : array of stops
+        for c,intervals in regions.iteritems():
+            intervals = sorted(intervals)
+            starts = array('l')
+            stops = array('l')
+            for start,stop in intervals:
+                if len(stops) > 0 and start <= stops[-1]:
+                    stops[-1] = max(stops[-1],stop)
+                else:
+                    starts.append(start)
+                    stops.append(stop)
+            self.starts[c] = starts
+            self.stops[c] = stops
+    
+    @staticmethod
+    def fromBed(path, useCache=True):
+        cachePath = path + regionSet.CACHE_EXTENSION
+        stats = os.stat(path)
+        signature = (regionSet.CACHE_VERSION,stats.st_size,stats.st_mtime)
+        if useCache and os.path.exists(cachePath):
+            try:
+                with open(cachePath,'rb') as cachefile:
+                    cachedSignature,starts,stops = cPickle.load(cachefile)
+                if cachedSignature == signature:
+                    result = regionSet()
+                    result.starts = starts
+                    result.stops = stops
+                    return result
+            except Exception:
+                pass    # a stale or broken cache is no worse than no cache
+        
+        regions = {}
+        with open(path,'rb') as infile:
+            for line in infile:
+                columns = line.split()
+                if len(columns) < 3 or columns[0].startswith('#') or columns[0] in ('track','browser'):
+                    continue
+                line = bedLine(columns)
+                regions.setdefault(line.chromosome,[]).append((line.start,line.stop))
+        result = regionSet(regions)
+        
+        if useCache:
+            try:
+                with open(cachePath,'wb') as cachefile:
+                    cPickle.dump((signature,result.starts,result.stops),cachefile,cPickle.HIGHEST_PROTOCOL)
+            except (IOError,OSError):
+                pass    # e.g. a read-only directory; we just won't have a cache next time
+        return result
+    
+    def contains(self, chromosome, position):
+        starts = self.starts.get(chromosome,None)
+        if starts == None:
+            return False
+        i = bisect.bisect_right(starts,position)-1
+        return i >= 0 and position < self.stops[chromosome][i]
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+import argparse
+from genome_utils import vcfLine, genomeException, chromosomeKey, metaID, readHeader, pragmaNumber
+from mergeVCF import mergeHeaders
+
+ALLELE_SPECIFIC_NUMBERS = set(['A','R','G'])
+
+def positionKey(line):
+    # Same ordering as sort.vcfKey
+    return (chromosomeKey(line.chromosome),line.position)
+
+class sampleReader:
+    def __init__(self, path):
+        self.infile = open(path,'rb')
+        self.metaLines,headerline = readHeader(self.infile)
+        self.samples = headerline.strip().split('\t')[9:]
+        self.current = None
+        self.advance()
+    
+    def advance(self):
+        previous = self.current
+        self.current = None
+        for line in self.infile:
+            line = line.strip()
+            if len(line) <= 1:
+                continue
+            self.current = vcfLine(line.split('\t'))
+            self.current.extractChrAndPos()
+            if previous != None and positionKey(self.current) < positionKey(previous):
+                raise genomeException("%s isn't sorted (run sort.py on it first)" % self.infile.name)
+            return
+        self.infile.close()
+    
+    def takePosition(self, key):
+        # Pops every record at the current position (there can be more than one, e.g. a SNP and an indel)
+        results = []
+        while self.current != None and positionKey(self.current) == key:
+            results.append(self.current)
+            self.advance()
+        return results
+
+def mergeRecords(records, readers, sampleOffsets, numSamples, alleleSpecificInfo, alleleSpecificFormat):
+    # records is a list of (reader index, vcfLine) pairs that share a position and REF allele
+    first = records[0][1]
+    seen = set()
+    for r,line in records:
+        if r in seen:
+            raise genomeException("%s has more than one record at %s:%i with REF %s (join them into one multi-allelic record first)" % \
+                                  (readers[r].infile.name,first.chromosome,first.position,first.alleles[0]))
+        seen.add(r)
+    
+    alleles = [first.alleles[0]]
+    for r,line in records:
+        for a in line.alleles[1:]:
+            if a != '.' and a not in alleles:
+                alleles.append(a)
+    
+    name = '.'
+    qual = None
+    qualText = '.'
+    filters = set()
+    hasPass = False
+    info = None
+    infoOrder = []
+    format = ['GT']
+    for r,line in records:
+        if name == '.' and line.name != '.':
+            name = line.name
+        if line.columns[5] != '.':
+            line.extractQual()
+            if qual == None or line.qual > qual:
+                # keep the text as written (e.g. 50, not 50.0)
+                qual = line.qual
+                qualText = line.columns[5]
+        line.extractFilters()
+        for f in line.filters:
+            if f == 'PASS':
+                hasPass = True
+            elif f != '.':
+                filters.add(f)
+        line.extractFormat()
+        for f in line.format:
+            if f not in format:
+                format.append(f)
+    
+    # Only keep INFO values that every input agrees on (and allele-specific ones only if nobody's alleles moved)
+    remapped = {}
+    for r,line in records:
+        alleleMap = [alleles.index(a) if a in alleles else None for a in line.alleles]
+        # an input with fewer alleles than the merged record counts as remapped too, since its A/R/G values are too short
+        remapped[r] = alleleMap != range(len(alleles))
+        line.alleleMap = alleleMap
+        line.extractInfo()
+        if info == None:
+            info = dict(line.info)
+            infoOrder = line.columns[7].split(';')
+            infoOrder = [i.split('=')[0] for i in infoOrder]
+        else:
+            for k in info.keys():
+                if not line.info.has_key(k) or line.info[k] != info[k]:
+                    del info[k]
+    if True in remapped.itervalues():
+        for k in info.keys():
+            if k in alleleSpecificInfo:
+                del info[k]
+    
+    columns = [first.chromosome,
+               str(first.position),
+               name,
+               alleles[0],
+               ','.join(alleles[1:]) if len(alleles) > 1 else '.',
+               qualText,
+               ';'.join(sorted(filters)) if len(filters) > 0 else ('PASS' if hasPass else '.')]
+    infostrs = []
+    for k in infoOrder:
+        if not info.has_key(k):
+            continue
+        v = info[k]
+        if v == None:
+            infostrs.append(k)
+        elif isinstance(v,list):
+            infostrs.append(k + "=" + ','.join(v))
+        else:
+            infostrs.append(k + "=" + v)
+    columns.append(';'.join(infostrs) if len(infostrs) > 0 else '.')
+    columns.append(':'.join(format))
+    
+    genotypes = ['./.']*numSamples
+    for r,line in records:
+        line.extractGenotypes()
+        for i in xrange(len(readers[r].samples)):
+            allele0,allele1,phased,attrs = line.genotypes[i]
+            if allele0 == None:
+                gt = './.'
+            else:
+                gt = str(line.alleleMap[allele0])
+                if allele1 != -1:
+                    gt += ('|' if phased else '/') + str(line.alleleMap[allele1])
+            values = [gt]
+            for f in format[1:]:
+                if f not in line.format or line.format.index(f)-1 >= len(attrs):
+                    values.append('.')
+                elif remapped[r] and f in alleleSpecificFormat:
+                    values.append('.')
+                else:
+                    values.append(attrs[line.format.index(f)-1])
+            while len(values) > 1 and values[-1] == '.':
+                values.pop()
+            genotypes[sampleOffsets[r]+i] = ':'.join(values)
+    columns.extend(genotypes)
+    return '\t'.join(columns) + '\n'
+
+def run(args):
+    readers = [sampleReader(path) for path in args.infiles]
+    
+    samples = []
+    sampleOffsets = []
+    for r in readers:
+        sampleOffsets.append(len(samples))
+        for s in r.samples:
+            if s in samples:
+                raise genomeException("Sample %s appears in more than one input file" % s)
+            samples.append(s)
+    
+    metaLines = mergeHeaders([(r.infile.name,r.metaLines) for r in readers])
+    alleleSpecificInfo = set()
+    alleleSpecificFormat = set()
+    for line in metaLines:
+        key = metaID(line)
+        if key != None and pragmaNumber(line) in ALLELE_SPECIFIC_NUMBERS:
+            if key[0] == 'INFO':
+                alleleSpecificInfo.add(key[1])
+            elif key[0] == 'FORMAT':
+                alleleSpecificFormat.add(key[1])
+    
+    outfile = open(args.outfile,'wb')
+    outfile.writelines(metaLines)
+    outfile.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t%s\n' % '\t'.join(samples))
+    
+    while True:
+        key = None
+        for r in readers:
+            if r.current != None and (key == None or positionKey(r.current) < key):
+                key = positionKey(r.current)
+        if key == None:
+            break
+        
+        # Group everything at this position by REF allele
+        groups = {}
+        for i,r in enumerate(readers):
+            for line in r.takePosition(key):
+                line.extractAlleles()
+                groups.setdefault(line.alleles[0],[]).append((i,line))
+        for ref in sorted(groups.iterkeys()):
+            outfile.write(mergeRecords(groups[ref], readers, sampleOffsets, len(samples), alleleSpecificInfo, alleleSpecificFormat))
+    outfile.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Combines the samples of several sorted .vcf files (e.g. one per sample) into one multi-sample .vcf file in a single pass. '+
+                                     'Records at the same position with the same REF allele are merged, and ALT alleles are renumbered as needed; samples without a call '+
+                                     'at a position are written as ./. QUAL is the highest QUAL of the merged records, FILTER is the union of their filters, and INFO '+
+                                     'fields are only kept if all merged records agree. Allele-specific (Number=A, R, or G) INFO and FORMAT values are dropped when '+
+                                     'alleles have to be renumbered.')
+    parser.add_argument('--in', type=str, dest="infiles", nargs="+", required=True,
+                        help='Sorted .vcf files to combine')
+    parser.add_argument('--out', type=str, dest="outfile", required=True,
+                        help='Path to output .vcf file')
+    
+    args = parser.parse_args()
+    run(args)
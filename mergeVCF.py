@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+import argparse, heapq, sys
+from genome_utils import genomeException, metaID, readHeader
+from sort import vcfKey
+from recipe576755 import Keyed
+
+def mergeHeaders(headers):
+    # ##INFO/##FILTER/##FORMAT/##contig lines are reconciled by ID (the first definition wins), and everything
+    # else is kept once in order of appearance
+    fileformat = None
+    metaLines = []
+    seenIDs = {}
+    seenLines = set()
+    for path,lines in headers:
+        for line in lines:
+            if line.lower().startswith('##fileformat'):
+                if fileformat == None:
+                    fileformat = line
+                continue
+            key = metaID(line)
+            if key != None:
+                if not seenIDs.has_key(key):
+                    seenIDs[key] = line
+                    metaLines.append(line)
+                elif seenIDs[key].strip() != line.strip():
+                    sys.stderr.write("WARNING: Conflicting ##%s definitions for %s; keeping the first one:\n%s" % (key[0],key[1],seenIDs[key]))
+            elif line not in seenLines:
+                seenLines.add(line)
+                metaLines.append(line)
+    if fileformat != None:
+        metaLines.insert(0,fileformat)
+    return metaLines
+
+def iterateSorted(infile):
+    # Yields keyed variant lines, making sure the input really is sorted (heapq.merge would silently produce garbage otherwise)
+    lastKey = None
+    for line in infile:
+        if len(line) <= 1:
+            continue
+        if not line.endswith('\n'):
+            line += '\n'
+        key = vcfKey(line)
+        if lastKey is not None and key < lastKey:
+            raise genomeException("%s isn't sorted (run sort.py on it first)" % infile.name)
+        lastKey = key
+        yield Keyed(key,line)
+
+def run(args):
+    infiles = [open(path,'rb') for path in args.infiles]
+    try:
+        headers = [(f.name,readHeader(f)) for f in infiles]
+        headerline = headers[0][1][1]
+        for path,(lines,columnLine) in headers:
+            if columnLine.strip().split('\t') != headerline.strip().split('\t'):
+                raise genomeException("Samples in %s don't match the other input files" % path)
+        metaLines = mergeHeaders([(path,lines) for path,(lines,columnLine) in headers])
+        
+        outfile = open(args.outfile,'wb')
+        outfile.writelines(metaLines)
+        outfile.write(headerline)
+        for element in heapq.merge(*[iterateSorted(f) for f in infiles]):
+            outfile.write(element.obj)
+        outfile.close()
+    finally:
+        for f in infiles:
+            f.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merges any number of sorted .vcf files with the same samples into one sorted .vcf file (see sort.py). '+
+                                     'Only a line from each file is held in memory at a time. ##INFO, ##FILTER, ##FORMAT, and ##contig lines are '+
+                                     'combined by ID; if two files define the same ID differently, the first definition is kept.')
+    parser.add_argument('--in', type=str, dest="infiles", nargs="+", required=True,
+                        help='Sorted .vcf files to merge')
+    parser.add_argument('--out', type=str, dest="outfile", required=True,
+                        help='Path to output .vcf file')
+    
+    args = parser.parse_args()
+    run(args)
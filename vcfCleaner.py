@@ -4,7 +4,7 @@ from collections import defaultdict
 from PySide.QtCore import Qt, QFile
 from PySide.QtUiTools import QUiLoader
 from PySide.QtGui import QApplication, QFileDialog, QProgressDialog, QMessageBox, QComboBox, QTableWidgetItem, QTreeWidgetItem, QPushButton, QColor, QPalette, QBrush, QInputDialog, QLineEdit
-from genome_utils import genomeException, parsePopulations, MAX_INFO_STRINGS
+from genome_utils import genomeException, parsePopulations, streamVcf, teeStage, stageCache, MAX_INFO_STRINGS
 import sort,cleanVCF,calcStats,addBEDtoVCF,addCSVtoVCF,filterVCF,VCFtoCVF
 
 PYTHON_WORDS = ["and","assert","break","class","continue",
@@ -25,6 +25,7 @@ PRESET_FILTERS = {'FILTER == PASS': 'keep_variant = FILTER == "PASS"',
                   'QUAL >= 30': 'keep_variant = QUAL >= 30'}
 
 TICKS_PER_PROCESS = 100
+FILTER_BLOCK_SIZE = 10000
 TICKS_FOR_LONG_PROCESSES = 1000
 
 MAX_FILTER_STRING = 50
@@ -55,6 +56,10 @@ with open(os.path.join(TMP_DIR,'README.txt'),'wb') as readme:
     readme.close()
 
 PURGE_TMP_DIR = True
+
+# Stage outputs from earlier runs (see genome_utils.stageCache); unlike TMP_DIR, this outlives each run
+CACHE_DIR = tempfile.gettempdir() + "/VCF_Cleaner_cache"
+CACHE_MAX_BYTES = 20*1024*1024*1024
 ERROR_DETAILS = "This is the error Python gave me:\n\n%s\n\n" + \
                 "If you'd like help, copy this message and post it at https://github.com/yasashiku/genepi_ngs_scripts/issues\n\n" + \
                 "You may be able to salvage something by snooping in %s, but if you run again everything in there will be obliterated."
@@ -670,9 +675,10 @@ class gui:
             
             for f in self.infoFields.itervalues():
                 if f.maxedOut:
-                    self.excludeAttribute(attribute(f.id, fileName, ">%i VALUES!" % MAX_INFO_STRINGS))
+                    self.excludeAttribute(attribute(f.name, fileName, ">%i VALUES!" % MAX_INFO_STRINGS))
                 else:
-                    self.includeAttribute(attribute(f.id, fileName))
+                    # numeric fields show where most of their values lie, to help pick filter thresholds
+                    self.includeAttribute(attribute(f.name, fileName, f.describeDistribution()))
             
             self.calculatedAttributes = []
             self.updateAttrLists()
@@ -1045,11 +1051,7 @@ class gui:
         # Run if we need to
         if hasOutput:
             numTicks = TICKS_PER_PROCESS * len(sourceFiles)
-            numTicks += TICKS_PER_PROCESS
             numTicks += TICKS_FOR_LONG_PROCESSES
-            numTicks += TICKS_PER_PROCESS*len(bedAttribFiles)
-            numTicks += TICKS_PER_PROCESS*len(csvAttribFiles)
-            numTicks += TICKS_PER_PROCESS*len(self.variantFilters)
             numTicks += TICKS_PER_PROCESS
             
             # Okay, we've sorted out how many ticks we need, now show the dialog
@@ -1065,8 +1067,16 @@ class gui:
                 progress.setValue(newValue)
                 return True
             
+            # Every stage's output is cached by a hash of its input and arguments (the same things the log file
+            # records), so anything that hasn't changed since an earlier (or crashed) run is just copied
+            try:
+                cache = stageCache(CACHE_DIR,CACHE_MAX_BYTES)
+            except (IOError,OSError):
+                cache = None    # e.g. an unwritable temp directory; we'll just redo everything
+            
             # Sort first
             tempTicks = 0
+            sortedKeys = {}
             for f in sourceFiles:
                 progress.setLabelText("Sorting %s..." % f)
                 progress.setValue(tempTicks)
@@ -1076,7 +1086,12 @@ class gui:
                 args.infile = f
                 args.outfile = os.path.join(TMP_DIR,baseName)
                 try:
-                    sort.run(args,tick,TICKS_PER_PROCESS)
+                    if cache != None:
+                        sortedKeys[f] = stageCache.key('sort',stageCache.fileKey(f))
+                    if cache == None or not cache.fetch(sortedKeys[f],args.outfile):
+                        sort.run(args,tick,TICKS_PER_PROCESS)
+                        if cache != None:
+                            cache.store(sortedKeys[f],args.outfile)
                 except Exception, e:
                     progress.close()
                     if e.message != 'Cancel clicked.':
@@ -1090,190 +1105,141 @@ class gui:
                 
                 tempTicks += TICKS_PER_PROCESS
             
+            # Everything between sorting and conversion is done in one streaming pass, so each variant is only
+            # parsed and written once (see genome_utils.streamVcf)
+            stages = []
+            stageArgs = []  # what each annotation stage's output depends on, for the cache
+            
             # Throw out fields we explicitly decided we want to remove
             if not isCvf and len(self.removedAttributes) > 0:
-                progress.setLabelText("Cleaning fields...")
-                progress.setValue(TICKS_PER_PROCESS * len(sourceFiles))
+                removeFields = set(a.name for a in self.removedAttributes)
+                stages.append(cleanVCF.cleanStage(removeFields=removeFields))
+                stageArgs.append(('clean',sorted(removeFields)))
                 
-                args = argObj()
-                args.infile = os.path.join(TMP_DIR,vcfPath)
-                args.outfile = os.path.join(TMP_DIR,"temp_"+vcfPath)
-                args.max_strings = 0
-                args.remove_info = " ".join(a.name for a in self.removedAttributes)
-                try:
-                    cleanVCF.run(args)
-                except Exception, e:
-                    progress.close()
-                    if e.message != 'Cancel clicked.':
-                        m = QMessageBox()
-                        m.setText("The run couldn't complete because of an error.")
-                        PURGE_TMP_DIR = False
-                        m.setDetailedText(ERROR_DETAILS % (traceback.format_exc(),TMP_DIR))
-                        m.setIcon(QMessageBox.Critical)
-                        m.exec_()
-                    return
-                os.rename(os.path.join(TMP_DIR,"temp_" + vcfPath),os.path.join(TMP_DIR,vcfPath))
-            
-            # Calculate statistics
-            if len(statsToCalculate) > 1:
-                progress.setLabelText("Calculating Statistics...")
-                progress.setValue(TICKS_PER_PROCESS * len(sourceFiles) + TICKS_PER_PROCESS)
-                
-                args = argObj()
-                args.infile = os.path.join(TMP_DIR,vcfPath)
-                args.outfile = os.path.join(TMP_DIR,"temp_"+vcfPath)
-                if not os.path.exists(logPath):
-                    logPath = os.path.join(TMP_DIR,"tmpLogFile.sh")
-                dataPath = self.window.kgpPathField.text()
-                if dataPath != "":
-                    args.data = dataPath
-                else:
-                    args.data = None
-                args.popFile = logPath
-                args.calculate_AF = []
-                args.calculate_Carriage = []
-                args.calculate_Samples_w_calls = []
-                for a in self.includedAttributes:
-                    if isinstance(a,statistic):
-                        calculation = [a.targetPop]
-                        if a.backPop != "ALT":
-                            calculation.append(a.backPop)
-                            if a.ascending == True:
-                                calculation.append("ASC")
+            try:
+                # Calculate statistics
+                if len(statsToCalculate) > 1:
+                    args = argObj()
+                    args.infile = os.path.join(TMP_DIR,vcfPath)
+                    if not os.path.exists(logPath):
+                        logPath = os.path.join(TMP_DIR,"tmpLogFile.sh")
+                    dataPath = self.window.kgpPathField.text()
+                    if dataPath != "":
+                        args.data = dataPath
+                    else:
+                        args.data = None
+                    args.popFile = logPath
+                    args.calculate_AF = []
+                    args.calculate_Carriage = []
+                    args.calculate_Samples_w_calls = []
+                    for a in self.includedAttributes:
+                        if isinstance(a,statistic):
+                            calculation = [a.targetPop]
+                            if a.backPop != "ALT":
+                                calculation.append(a.backPop)
+                                if a.ascending == True:
+                                    calculation.append("ASC")
+                                else:
+                                    calculation.append("DEC")
+                                if a.revertHack == True:
+                                    calculation.append("True")
+                            if a.function == calcStats.allStats.STAT_NAMES[calcStats.allStats.AF]:
+                                args.calculate_AF.append(calculation)
+                            elif a.function == calcStats.allStats.STAT_NAMES[calcStats.allStats.Carriage]:
+                                args.calculate_Carriage.append(calculation)
+                            elif a.function == calcStats.allStats.STAT_NAMES[calcStats.allStats.Samples_w_calls]:
+                                args.calculate_Samples_w_calls.append(calculation)
                             else:
-                                calculation.append("DEC")
-                            if a.revertHack == True:
-                                calculation.append("True")
-                        if a.function == calcStats.allStats.STAT_NAMES[calcStats.allStats.AF]:
-                            args.calculate_AF.append(calculation)
-                        elif a.function == calcStats.allStats.STAT_NAMES[calcStats.allStats.Carriage]:
-                            args.calculate_Carriage.append(calculation)
-                        elif a.function == calcStats.allStats.STAT_NAMES[calcStats.allStats.Samples_w_calls]:
-                            args.calculate_Samples_w_calls.append(calculation)
-                        else:
-                            raise Exception("Unknown Statistic: %s" % a.function)
-                try:
-                    calcStats.run(args,tick,TICKS_FOR_LONG_PROCESSES)
-                except Exception, e:
-                    progress.close()
-                    if e.message != 'Cancel clicked.':
-                        m = QMessageBox()
-                        m.setText("The run couldn't complete because of an error.")
-                        PURGE_TMP_DIR = False
-                        m.setDetailedText(ERROR_DETAILS % (traceback.format_exc(),TMP_DIR))
-                        m.setIcon(QMessageBox.Critical)
-                        m.exec_()
-                    return
-                os.rename(os.path.join(TMP_DIR,"temp_" + vcfPath),os.path.join(TMP_DIR,vcfPath))
-            
-            # Add any .bed stats
-            tempTicks = TICKS_PER_PROCESS * len(sourceFiles) + TICKS_PER_PROCESS + TICKS_FOR_LONG_PROCESSES
-            for f,attribs in bedAttribFiles.iteritems():
-                progress.setLabelText("Applying .bed Attributes...")
-                progress.setValue(tempTicks)
-                
-                args = argObj()
-                args.infile = os.path.join(TMP_DIR,vcfPath)
-                args.outfile = os.path.join(TMP_DIR,"temp_"+vcfPath)
-                baseName = os.path.split(f)[1]
-                args.bedfile = os.path.join(TMP_DIR,baseName)
-                args.names = [a.name for a in attribs]
-                
-                try:
-                    addBEDtoVCF.run(args)
-                except Exception, e:
-                    progress.close()
-                    if e.message != 'Cancel clicked.':
-                        m = QMessageBox()
-                        m.setText("The run couldn't complete because of an error.")
-                        PURGE_TMP_DIR = False
-                        m.setDetailedText(ERROR_DETAILS % (traceback.format_exc(),TMP_DIR))
-                        m.setIcon(QMessageBox.Critical)
-                        m.exec_()
-                    return
-                os.rename(os.path.join(TMP_DIR,"temp_" + vcfPath),os.path.join(TMP_DIR,vcfPath))
-                
-                tempTicks += TICKS_PER_PROCESS
+                                raise Exception("Unknown Statistic: %s" % a.function)
+                    stages.append(calcStats.statsStage(args))
+                    # The log file doubles as the population file, but it also names this run's TMP_DIR, so only its populations count
+                    populations = sorted(parsePopulations(logPath)[0].iteritems()) if os.path.exists(logPath) else None
+                    stageArgs.append(('stats',statsToCalculate,args.data,populations))
             
-            # Add any .csv stats
-            tempTicks = TICKS_PER_PROCESS * len(sourceFiles) + TICKS_PER_PROCESS + TICKS_FOR_LONG_PROCESSES + TICKS_PER_PROCESS * len(bedAttribFiles)
-            for f,attribs in csvAttribFiles.iteritems():
-                progress.setLabelText("Applying .csv Attributes...")
-                progress.setValue(tempTicks)
-                
-                args = argObj()
-                args.infile = os.path.join(TMP_DIR,vcfPath)
-                args.outfile = os.path.join(TMP_DIR,"temp_"+vcfPath)
-                baseName = os.path.split(f)[1]
-                args.csvFile = os.path.join(TMP_DIR,baseName)
-                args.exact = []
-                args.nearest = []
-                args.interpolate = []
-                
-                for a in attribs:
-                    if a.additionalText == 'Exact':
-                        args.exact.append(a.name)
-                    elif a.additionalText == 'Copy':
-                        args.nearest.append(a.name)
-                    elif a.additionalText == 'Interpolate':
-                        args.interpolate.append(a.name)
-                    else:
-                        raise Exception('Unknown csv additionalText: %s' % str(a.additionalText))
+                # Add any .bed stats (we sorted the .bed files above)
+                for f,attribs in bedAttribFiles.iteritems():
+                    baseName = os.path.split(f)[1]
+                    names = sorted(a.name for a in attribs)
+                    stages.append(addBEDtoVCF.bedStage(os.path.join(TMP_DIR,baseName),names,True))
+                    stageArgs.append(('bed',sortedKeys.get(f),names))
                 
-                try:
-                    addCSVtoVCF.run(args)
-                except Exception, e:
-                    progress.close()
-                    if e.message != 'Cancel clicked.':
-                        m = QMessageBox()
-                        m.setText("The run couldn't complete because of an error.")
-                        PURGE_TMP_DIR = False
-                        m.setDetailedText(ERROR_DETAILS % (traceback.format_exc(),TMP_DIR))
-                        m.setIcon(QMessageBox.Critical)
-                        m.exec_()
-                    return
-                os.rename(os.path.join(TMP_DIR,"temp_" + vcfPath),os.path.join(TMP_DIR,vcfPath))
-                
-                tempTicks += TICKS_PER_PROCESS
-            
-            # Now apply the filters
-            tempTicks = TICKS_PER_PROCESS * len(sourceFiles) + TICKS_PER_PROCESS + TICKS_FOR_LONG_PROCESSES + TICKS_PER_PROCESS * len(bedAttribFiles) + TICKS_PER_PROCESS * len(csvAttribFiles)
-            for f in self.variantFilters:
-                progress.setLabelText("Applying filters...")
-                progress.setValue(tempTicks)
+                # Add any .csv stats
+                for f,attribs in csvAttribFiles.iteritems():
+                    baseName = os.path.split(f)[1]
+                    exact = []
+                    nearest = []
+                    interpolate = []
+                    for a in attribs:
+                        if a.additionalText == 'Exact':
+                            exact.append(a.name)
+                        elif a.additionalText == 'Copy':
+                            nearest.append(a.name)
+                        elif a.additionalText == 'Interpolate':
+                            interpolate.append(a.name)
+                        else:
+                            raise Exception('Unknown csv additionalText: %s' % str(a.additionalText))
+                    stages.append(addCSVtoVCF.csvStage(os.path.join(TMP_DIR,baseName),exact,nearest,interpolate,True))
+                    stageArgs.append(('csv',sortedKeys.get(f),sorted(exact),sorted(nearest),sorted(interpolate)))
                 
-                args = argObj()
-                args.infile = os.path.join(TMP_DIR,vcfPath)
-                args.outfile = os.path.join(TMP_DIR,"temp_"+vcfPath)
-                if isinstance(f,filterBed):
-                    args.bed = f.path
-                else:
-                    expressionNumber = 2
-                    temp = "expression.py"
-                    while os.path.exists(os.path.join(TMP_DIR,temp)):
-                        temp = "expression%i.py" % expressionNumber
-                        expressionNumber += 1
-                    args.expression = temp
-                    args.columns = f.columns
+                # Now apply the filters
+                filterArgs = []
+                if len(self.variantFilters) > 0:
+                    filters = []
+                    for f in self.variantFilters:
+                        if isinstance(f,filterBed):
+                            filters.append(filterVCF.bedFilter(f.path))
+                            filterArgs.append(('bed',stageCache.fileKey(f.path) if cache != None else None))
+                        else:
+                            filters.append(filterVCF.expressionFilter(f.expression,f.columns,FILTER_BLOCK_SIZE))
+                            filterArgs.append(('expression',f.expression,list(f.columns)))
                 
-                try:
-                    filterVCF.run(args)
-                except Exception, e:
-                    progress.close()
-                    if e.message != 'Cancel clicked.':
-                        m = QMessageBox()
-                        m.setText("The run couldn't complete because of an error.")
-                        PURGE_TMP_DIR = False
-                        m.setDetailedText(ERROR_DETAILS % (traceback.format_exc(),TMP_DIR))
-                        m.setIcon(QMessageBox.Critical)
-                        m.exec_()
-                    return
-                os.rename(os.path.join(TMP_DIR,"temp_" + vcfPath),os.path.join(TMP_DIR,vcfPath))
+                annotating = len(stages) > 0
+                filtering = len(filterArgs) > 0
+                inPath = os.path.join(TMP_DIR,vcfPath)
+                annotatedPath = os.path.join(TMP_DIR,"annotated_"+vcfPath)
+                tempPath = os.path.join(TMP_DIR,"temp_"+vcfPath)
+                if cache != None:
+                    annotatedKey = sortedKeys[self.window.vcfPathField.text()]
+                    if annotating:
+                        annotatedKey = stageCache.key('annotate',annotatedKey,stageArgs)
+                    filteredKey = annotatedKey
+                    if filtering:
+                        filteredKey = stageCache.key('filter',annotatedKey,filterArgs)
                 
-                tempTicks += TICKS_PER_PROCESS
+                if annotating or filtering:
+                    progress.setLabelText("Processing variants...")
+                    progress.setValue(TICKS_PER_PROCESS * len(sourceFiles))
+                    if cache == None or not cache.fetch(filteredKey,tempPath):
+                        if annotating and filtering and cache != None:
+                            if cache.fetch(annotatedKey,annotatedPath):
+                                # only the filters changed; start from the cached annotations
+                                inPath = annotatedPath
+                                stages = []
+                            else:
+                                # keep the annotated variants on the side so that changing only the filters doesn't redo them
+                                stages.append(teeStage(annotatedPath))
+                        if filtering:
+                            stages.append(filterVCF.filterStage(filters))
+                        streamVcf(inPath,tempPath,stages,tick,TICKS_FOR_LONG_PROCESSES)
+                        if cache != None:
+                            if annotating and filtering and inPath != annotatedPath:
+                                cache.store(annotatedKey,annotatedPath)
+                            cache.store(filteredKey,tempPath)
+            except Exception, e:
+                progress.close()
+                if e.message != 'Cancel clicked.':
+                    m = QMessageBox()
+                    m.setText("The run couldn't complete because of an error.")
+                    PURGE_TMP_DIR = False
+                    m.setDetailedText(ERROR_DETAILS % (traceback.format_exc(),TMP_DIR))
+                    m.setIcon(QMessageBox.Critical)
+                    m.exec_()
+                return
+            if annotating or filtering:
+                os.rename(tempPath,os.path.join(TMP_DIR,vcfPath))
             
             # We're almost done... convert to .cvf or copy to the target destination
-            tempTicks = TICKS_PER_PROCESS * len(sourceFiles) + TICKS_PER_PROCESS + TICKS_FOR_LONG_PROCESSES + TICKS_PER_PROCESS * len(bedAttribFiles) + TICKS_PER_PROCESS * len(csvAttribFiles) + TICKS_PER_PROCESS * len(self.variantFilters)
+            tempTicks = TICKS_PER_PROCESS * len(sourceFiles) + TICKS_FOR_LONG_PROCESSES
 
             if isCvf:
                 progress.setLabelText("Converting to .cvf...")
@@ -1380,7 +1346,7 @@ class gui:
             baseName = os.path.split(f)[1]
             featureNames = " ".join(a.name for a in attribs)
             outfile.write('echo "Running addBEDtoVCF.py..."\n')
-            outfile.write('python $APP_DIR/addBEDtoVCF.py --in $TMP_DIR/%s --out $TMP_DIR/temp_%s --bed $TMP_DIR/%s --names %s\n' % (vcfPath,vcfPath,baseName,featureNames))
+            outfile.write('python $APP_DIR/addBEDtoVCF.py --in $TMP_DIR/%s --out $TMP_DIR/temp_%s --bed $TMP_DIR/%s --names %s --sorted\n' % (vcfPath,vcfPath,baseName,featureNames))
             outfile.write('mv $TMP_DIR/temp_%s $TMP_DIR/%s\n' % (vcfPath,vcfPath))
         # Add any .csv stats
         for f,attribs in csvAttribFiles.iteritems():
@@ -1407,22 +1373,23 @@ class gui:
             outfile.write('echo "Running addCSVtoVCF.py..."\n')
             outfile.write('python $APP_DIR/addCSVtoVCF.py --in $TMP_DIR/%s --out $TMP_DIR/temp_%s --csv $TMP_DIR/%s --omit_mismatches %s\n' % (vcfPath,vcfPath,baseName,columnList))
             outfile.write('mv $TMP_DIR/temp_%s $TMP_DIR/%s\n' % (vcfPath,vcfPath))
-        # Now apply the filters
-        for f in self.variantFilters:
-            if isinstance(f,filterBed):
-                outfile.write('echo "Running filterVCF.py..."\n')
-                outfile.write('python $APP_DIR/filterVCF.py --in $TMP_DIR/%s --out $TMP_DIR/temp_%s --bed %s\n' % (vcfPath,vcfPath,f.path))
-                outfile.write('mv $TMP_DIR/temp_%s $TMP_DIR/%s\n' % (vcfPath,vcfPath))
-            else:
-                expressionNumber = 2
-                temp = "expression.py"
-                while os.path.exists(os.path.join(TMP_DIR,temp)):
-                    temp = "expression%i.py" % expressionNumber
-                    expressionNumber += 1
-                outfile.write('echo "%s" > $TMP_DIR/%s\n' % (f.expression.replace('"','\\"'),temp))
-                outfile.write('echo "Running filterVCF.py..."\n')
-                outfile.write('python $APP_DIR/filterVCF.py --in $TMP_DIR/%s --out $TMP_DIR/temp_%s --expression $TMP_DIR/%s --columns %s\n' % (vcfPath,vcfPath,temp," ".join(f.columns)))
-                outfile.write('mv $TMP_DIR/temp_%s $TMP_DIR/%s\n' % (vcfPath,vcfPath))
+        # Now apply the filters (all in one pass)
+        if len(self.variantFilters) > 0:
+            filterArgs = ""
+            expressionNumber = 1
+            for f in self.variantFilters:
+                if isinstance(f,filterBed):
+                    continue
+                outfile.write('echo "%s" > $TMP_DIR/expression%i.py\n' % (f.expression.replace('"','\\"'),expressionNumber))
+                outfile.write('echo "%s" > $TMP_DIR/columns%i.txt\n' % ("\n".join(f.columns),expressionNumber))
+                filterArgs += " --filter $TMP_DIR/expression%i.py $TMP_DIR/columns%i.txt" % (expressionNumber,expressionNumber)
+                expressionNumber += 1
+            bedPaths = [f.path for f in self.variantFilters if isinstance(f,filterBed)]
+            if len(bedPaths) > 0:
+                filterArgs += " --bed %s" % " ".join(bedPaths)
+            outfile.write('echo "Running filterVCF.py..."\n')
+            outfile.write('python $APP_DIR/filterVCF.py --in $TMP_DIR/%s --out $TMP_DIR/temp_%s%s\n' % (vcfPath,vcfPath,filterArgs))
+            outfile.write('mv $TMP_DIR/temp_%s $TMP_DIR/%s\n' % (vcfPath,vcfPath))
         # Convert to .cvf or just copy the .vcf
         if isCvf:
             attsToRemove = " ".join(a.name for a in self.removedAttributes)